@@ -0,0 +1,421 @@
+import argparse
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+
+import db
+from blob_store import BlobWriter, BLOB_CHUNK_SIZE, remove_unreferenced_blobs
+from handle_docs import make_file_info, format_context, join_context
+from main import (
+    load_chat_model,
+    load_vector_store,
+    get_chain,
+    get_ingestion_queue,
+    get_model_warmer,
+    warm_up_preferred_models,
+)
+from metrics import start_metrics_server
+from pipeline import Turn, reasoning_option
+from sidebar_area import generate_unique_name
+from vector_stores import drop_chat_vectors
+
+# ----------------- HTTP API -----------------
+# the same chats as the streamlit app, without streamlit: chats and messages as json, uploads and prompts as
+# server-sent events (progress while files are indexed, the answer token by token). the turn runs through
+# pipeline.Turn like in chat_area; its blocking steps (parsing, embedding, sqlite, retrieval) run in a thread
+# pool so that the event loop keeps streaming other requests, generation is streamed with chain.astream.
+#
+#   python src/api.py --port 8000
+#
+#   GET    /health
+#   GET    /chats?user_id=0
+#   POST   /chats                          {"user_id": 0, "name": "..."}
+#   DELETE /chats/{chat_id}?user_id=0
+#   GET    /chats/{chat_id}/messages?limit=30&before=<sent_at>,<id>
+#   POST   /chats/{chat_id}/files          multipart (files), events: queued, progress, done
+#   GET    /chats/{chat_id}/ingestion?unfinished=1
+#   POST   /chats/{chat_id}/messages       {"prompt": "...", "job_id": <upload's job>}, events: status, thinking,
+#                                          token, done (or error)
+
+API_HOST = "127.0.0.1"
+API_PORT = 8000
+# metrics of the turns served by the api (see metrics.py), next to the streamlit app's on METRICS_PORT
+API_METRICS_PORT = 9465
+# threads running the blocking parts of requests
+API_WORKERS = 8
+# most messages returned per page
+MAX_PAGE_SIZE = 200
+# largest upload accepted, same as the streamlit uploader
+MAX_UPLOAD_MB = 800
+# seconds between progress checks of an upload's indexing job
+INGESTION_POLL_SECONDS = 0.5
+# highest temperature accepted, same as the streamlit slider
+MAX_TEMPERATURE = 2.0
+
+_executor = ThreadPoolExecutor(max_workers=API_WORKERS, thread_name_prefix="api")
+
+
+def run_blocking(fn, *args):
+    return asyncio.get_running_loop().run_in_executor(_executor, fn, *args)
+
+
+class EventStream:
+    # server-sent events: "event: <name>" and a json "data:" line per event
+    def __init__(self, request: web.Request):
+        self.response = web.StreamResponse(
+            headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
+        self.request = request
+
+    async def __aenter__(self):
+        await self.response.prepare(self.request)
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.response.write_eof()
+
+    async def send(self, event: str, data):
+        await self.response.write(f"event: {event}\ndata: {json.dumps(data)}\n\n".encode())
+
+
+async def run_with_events(stream: EventStream, fn, *args):
+    # runs fn(*args, emit) in the pool, sending what it emits from its thread as events while it runs
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+
+    def emit(event, data):
+        loop.call_soon_threadsafe(queue.put_nowait, (event, data))
+
+    future = run_blocking(fn, *args, emit)
+    future.add_done_callback(lambda _: loop.call_soon_threadsafe(queue.put_nowait, None))
+
+    while (item := await queue.get()) is not None:
+        await stream.send(*item)
+
+    return await future
+
+
+def settings(user_id: int, body: dict):
+    # the user's preferences, overridden by the request
+    preferences = db.get_user_info(user_id)
+    try:
+        temperature = float(body.get("temperature", preferences["temperature"]))
+    except (TypeError, ValueError):
+        raise web.HTTPBadRequest(reason="temperature must be a number")
+    if not 0.0 <= temperature <= MAX_TEMPERATURE:  # also false for nan
+        raise web.HTTPBadRequest(reason=f"temperature must be between 0 and {MAX_TEMPERATURE}")
+
+    chosen = {
+        "chat_model": body.get("chat_model") or preferences["chat_model"],
+        "embedding_model": body.get("embedding_model") or preferences["embedding_model"],
+        "temperature": temperature,
+        "style": body.get("style") or preferences["style"] or "Normal",
+        "reasoning": body.get("reasoning", "Default"),
+    }
+
+    # models requests use are kept loaded from then on, like the ones picked in the app's preferences
+    warmer = get_model_warmer()
+    warmer.watch(chosen["chat_model"], "chat")
+    warmer.watch(chosen["embedding_model"], "embedding")
+
+    return chosen
+
+
+def get_user_id(request: web.Request, body=None):
+    try:
+        return int((body or {}).get("user_id", request.query.get("user_id", 0)))
+    except ValueError:
+        raise web.HTTPBadRequest(reason="user_id must be an integer")
+
+
+def get_chat(user_id: int, chat_id: int):
+    for chat in db.get_chats(user_id):
+        if chat["id"] == chat_id:
+            return chat
+    raise web.HTTPNotFound(reason=f"chat {chat_id} not found")
+
+
+async def read_json(request: web.Request):
+    if not request.can_read_body:
+        return {}
+    try:
+        body = await request.json()
+    except json.JSONDecodeError:
+        raise web.HTTPBadRequest(reason="invalid json")
+    if not isinstance(body, dict):
+        raise web.HTTPBadRequest(reason="expected a json object")
+    return body
+
+
+# ----------------- CHATS -----------------
+
+
+async def health(request: web.Request):
+    return web.json_response({"status": "ok"})
+
+
+async def list_chats(request: web.Request):
+    user_id = get_user_id(request)
+    return web.json_response(await run_blocking(db.get_chats, user_id))
+
+
+async def create_chat(request: web.Request):
+    body = await read_json(request)
+    user_id = get_user_id(request, body)
+    name = body.get("name") or generate_unique_name()
+    chat_id = await run_blocking(db.create_chat, name, user_id)
+    return web.json_response(await run_blocking(get_chat, user_id, chat_id), status=201)
+
+
+async def delete_chat(request: web.Request):
+    user_id = get_user_id(request)
+    chat_id = int(request.match_info["chat_id"])
+    await run_blocking(get_chat, user_id, chat_id)
+
+    def delete():
+        db.delete_chat(chat_id)
+        drop_chat_vectors(user_id, chat_id)
+        remove_unreferenced_blobs()
+
+    await run_blocking(delete)
+    return web.Response(status=204)
+
+
+async def list_messages(request: web.Request):
+    chat_id = int(request.match_info["chat_id"])
+    await run_blocking(get_chat, get_user_id(request), chat_id)
+
+    try:
+        limit = min(int(request.query.get("limit", 30)), MAX_PAGE_SIZE)
+    except ValueError:
+        raise web.HTTPBadRequest(reason="limit must be an integer")
+    if limit < 1:
+        raise web.HTTPBadRequest(reason="limit must be positive")
+
+    before = request.query.get("before")
+    if before:
+        try:
+            sent_at, id = before.split(",")
+            before = (int(sent_at), int(id))
+        except ValueError:
+            raise web.HTTPBadRequest(reason="before must be a <sent_at>,<id> cursor")
+
+    messages, cursor = await run_blocking(db.get_chat_messages_page, chat_id, limit, before)
+    return web.json_response({"messages": messages, "before": f"{cursor[0]},{cursor[1]}" if cursor else None})
+
+
+# ----------------- UPLOADS -----------------
+
+
+async def upload_files(request: web.Request):
+    # saves the files and queues them for indexing into the chat's documents (see ingestion.py), streaming the
+    # job's progress until it's done. the job_id is then sent with a prompt so that the human message lists the
+    # files, prompts sent before that answer from what's indexed so far
+    user_id = get_user_id(request)
+    chat_id = int(request.match_info["chat_id"])
+    await run_blocking(get_chat, user_id, chat_id)
+    preferences = await run_blocking(settings, user_id, dict(request.query))
+
+    # each file is streamed into the blob store chunk by chunk as it arrives
+    files_info = []
+    reader = await request.multipart()
+    while (part := await reader.next()) is not None:
+        if not part.filename:
+            continue
+
+        writer = await run_blocking(BlobWriter)
+        try:
+            while chunk := await part.read_chunk(BLOB_CHUNK_SIZE):
+                await run_blocking(writer.write, chunk)
+        except BaseException:
+            await run_blocking(writer.abort)
+            raise
+
+        hash, path, size = await run_blocking(writer.commit)
+        files_info.append(make_file_info(part.filename, hash, path, size))
+    if not files_info:
+        raise web.HTTPBadRequest(reason="no files attached")
+
+    # into the store the chat is searched with (see IngestionQueue.embedding_model_for)
+    ingestion_queue = get_ingestion_queue()
+    embedding_model = await run_blocking(
+        ingestion_queue.embedding_model_for, user_id, chat_id, preferences["embedding_model"]
+    )
+    job_id = await run_blocking(ingestion_queue.submit, user_id, chat_id, embedding_model, files_info)
+
+    async with EventStream(request) as stream:
+        await stream.send("queued", {"job_id": job_id, "files_info": files_info})
+
+        last = None
+        while True:
+            job = await run_blocking(get_ingestion_job, chat_id, job_id)
+            if job != last:
+                await stream.send("progress", job)
+                last = job
+            if job["state"] not in {"queued", "running"}:
+                break
+            await asyncio.sleep(INGESTION_POLL_SECONDS)
+
+        await stream.send("done", {"job_id": job_id, "state": job["state"], "files_info": files_info})
+
+    return stream.response
+
+
+def get_ingestion_job(chat_id: int, job_id: int):
+    for job in db.get_ingestion_jobs(chat_id):
+        if job["id"] == job_id:
+            return job
+    raise web.HTTPNotFound(reason=f"job {job_id} not found")
+
+
+async def list_ingestion_jobs(request: web.Request):
+    # the chat's indexing jobs with per file progress, ?unfinished=1 for the ones still queued or running
+    chat_id = int(request.match_info["chat_id"])
+    await run_blocking(get_chat, get_user_id(request), chat_id)
+    unfinished_only = request.query.get("unfinished") in {"1", "true"}
+    return web.json_response(await run_blocking(db.get_ingestion_jobs, chat_id, unfinished_only))
+
+
+# ----------------- PROMPTS -----------------
+
+
+async def send_message(request: web.Request):
+    body = await read_json(request)
+    user_id = get_user_id(request, body)
+    chat_id = int(request.match_info["chat_id"])
+    prompt = (body.get("prompt") or "").strip()
+    job_id = body.get("job_id")
+    if not prompt and job_id is None:
+        raise web.HTTPBadRequest(reason="prompt or job_id is required")
+
+    await run_blocking(get_chat, user_id, chat_id)
+
+    # the files are those the server saved for one of this chat's uploads, never paths from the request
+    files_info = []
+    if job_id is not None:
+        if not isinstance(job_id, int):
+            raise web.HTTPBadRequest(reason="job_id must be an integer")
+        job = await run_blocking(get_ingestion_job, chat_id, job_id)
+        if job["kind"] != "upload":
+            raise web.HTTPBadRequest(reason=f"job {job_id} is not an upload")
+        files_info = [file["file_info"] for file in job["files"]]
+    preferences = await run_blocking(settings, user_id, body)
+
+    try:
+        # the model the chat's documents are embedded with until they're re-embedded with the requested one
+        embedding_model = await run_blocking(
+            get_ingestion_queue().embedding_model_for, user_id, chat_id, preferences["embedding_model"]
+        )
+        vector_stores = await run_blocking(load_vector_store, embedding_model)
+        chat_model = await run_blocking(
+            lambda: load_chat_model(
+                preferences["chat_model"],
+                temperature=preferences["temperature"],
+                reasoning=reasoning_option(preferences["reasoning"]),
+            )
+        )
+    except Exception as e:
+        raise web.HTTPBadRequest(reason=str(e))
+
+    turn = Turn(user_id, chat_id, prompt, chat_model, vector_stores, preferences["style"])
+
+    def prepare(emit):
+        # files were indexed by their upload, only the concurrent stages and context are left
+        turn.start_history()
+        turn.start_web_search()
+        turn.start_document_search()
+
+        statuses = []
+        if turn.is_web_search:
+            state = turn.web_search_state()
+            statuses.append({"label": ":material/web: Searching Web", "content": "", "state": state, "type": "web_search"})
+            emit("status", {"type": "web_search", "state": state})
+
+        context_string = join_context(format_context(turn.context()))
+        emit("status", {"type": "context", "state": "complete", "content": context_string})
+
+        model_chat_history = turn.history()
+        turn.save_prompt(files_info)
+        return turn.chain_input(context_string, model_chat_history, has_files=bool(files_info)), context_string, statuses
+
+    async with EventStream(request) as stream:
+        try:
+            input, context_string, statuses = await run_with_events(stream, prepare)
+
+            response = ""
+            thinking = ""
+            async for chunk in get_chain(chat_model=chat_model).astream(input=input):
+                reasoning_content = chunk.additional_kwargs.get("reasoning_content")
+                if reasoning_content:
+                    thinking += reasoning_content
+                    await stream.send("thinking", {"content": reasoning_content})
+                if chunk.content:
+                    turn.on_token()
+                    response += chunk.content
+                    await stream.send("token", {"content": chunk.content})
+
+            thinking_type = "processing" if preferences["reasoning"] in {"Default", "Off"} else "thinking"
+            statuses.extend(
+                [
+                    {
+                        "label": ":material/document_search: Finding relevant context",
+                        "content": context_string,
+                        "state": "complete",
+                        "type": "context",
+                    },
+                    {
+                        "label": ":material/memory: Processing" if thinking_type == "processing" else ":material/lightbulb: Thinking",
+                        "content": thinking,
+                        "state": "complete",
+                        "type": thinking_type,
+                    },
+                ]
+            )
+            await run_blocking(turn.save_answer, response, statuses)
+            await stream.send("done", {"content": response, "timings": turn.timings.to_dict()})
+        except Exception as e:
+            await stream.send("error", {"message": str(e)})
+
+    return stream.response
+
+
+def create_app():
+    app = web.Application(client_max_size=MAX_UPLOAD_MB * 1024 * 1024)
+    app.add_routes(
+        [
+            web.get("/health", health),
+            web.get("/chats", list_chats),
+            web.post("/chats", create_chat),
+            web.delete("/chats/{chat_id:\\d+}", delete_chat),
+            web.get("/chats/{chat_id:\\d+}/messages", list_messages),
+            web.post("/chats/{chat_id:\\d+}/messages", send_message),
+            web.post("/chats/{chat_id:\\d+}/files", upload_files),
+            web.get("/chats/{chat_id:\\d+}/ingestion", list_ingestion_jobs),
+        ]
+    )
+    app.on_startup.append(warm_up_models)
+    return app
+
+
+async def warm_up_models(app: web.Application):
+    # the user's models start loading in ollama when the server starts, not on its first request (see warmup.py)
+    await run_blocking(warm_up_preferred_models)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ChatDocs HTTP API")
+    parser.add_argument("--host", default=API_HOST)
+    parser.add_argument("--port", type=int, default=API_PORT)
+    parser.add_argument("--metrics-port", type=int, default=API_METRICS_PORT)
+    args = parser.parse_args()
+
+    db.migrate()
+    remove_unreferenced_blobs()
+    get_ingestion_queue()  # takes over jobs of a stopped server once their lease runs out
+    try:
+        start_metrics_server(port=args.metrics_port)
+    except OSError as e:
+        print("Metrics server not started:", e)  # e.g. port taken by another instance
+    web.run_app(create_app(), host=args.host, port=args.port)
@@ -0,0 +1,496 @@
+import argparse
+import csv
+import hashlib
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+from langchain_core.documents import Document
+
+from fake_ollama import FakeOllama
+
+# ----------------- OFFLINE BENCHMARKS -----------------
+# runs the app's own pipeline against fake_ollama.py (no ollama or models needed) in a throw away directory and
+# prints the results as json, e.g.
+#   python src/benchmark.py --output before.json
+#   python src/benchmark.py --corpus-sizes 1000 10000 --tokens-per-second 30 --output after.json
+# measures ingest throughput per file type, retrieval latency vs corpus size, db latency vs history length and
+# end to end time to first token.
+
+CHAT_MODEL = "fake-chat"
+EMBEDDING_MODEL = "fake-embedding"
+USER_ID = 0
+
+QUERIES = [
+    "how are retries handled when the service is overloaded",
+    "what does the report say about quarterly revenue growth",
+    "explain the difference between the two storage engines",
+    "which settings control the cache size",
+    "summarize the section about security reviews",
+    "ERR-4021",
+    "parse_config_file",
+    '"connection pool"',
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline ChatDocs benchmarks against a fake Ollama server")
+    parser.add_argument("--output", help="json file to write (printed to stdout as well)")
+    parser.add_argument("--file-kb", type=int, default=256, help="size of each generated file for the ingest benchmark")
+    parser.add_argument("--file-types", nargs="+", default=["txt", "md", "csv", "pdf", "docx"])
+    parser.add_argument("--corpus-sizes", type=int, nargs="+", default=[100, 1000, 5000], help="chunks per chat")
+    parser.add_argument("--history-lengths", type=int, nargs="+", default=[10, 100, 1000, 5000], help="messages")
+    parser.add_argument("--repeat", type=int, default=20, help="timed repetitions of each query")
+    parser.add_argument("--turns", type=int, default=5, help="end to end turns")
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    parser.add_argument("--first-token-delay", type=float, default=0.2, help="seconds the fake model 'thinks'")
+    parser.add_argument("--response-tokens", type=int, default=60)
+    parser.add_argument("--embed-delay", type=float, default=0.0, help="seconds added to every embed request")
+    parser.add_argument("--backend", choices=["chroma", "faiss"], help="vector backend (default: vector_stores')")
+    parser.add_argument("--keep", action="store_true", help="keep (and print) the working directory")
+    args = parser.parse_args()
+
+    fake = FakeOllama(
+        models=(CHAT_MODEL, EMBEDDING_MODEL),
+        tokens_per_second=args.tokens_per_second,
+        first_token_delay=args.first_token_delay,
+        response_tokens=args.response_tokens,
+        embed_delay=args.embed_delay,
+    ).start()
+    os.environ["OLLAMA_HOST"] = fake.url
+
+    output_path = os.path.abspath(args.output) if args.output else None
+
+    # db, vector stores, caches and uploads all use paths relative to the working directory
+    workdir = tempfile.mkdtemp(prefix="chatdocs-benchmark-")
+    os.chdir(workdir)
+
+    import db
+    import vector_stores
+
+    if args.backend:
+        vector_stores.VECTOR_BACKEND = args.backend
+    db.setup()
+
+    results = {
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "config": {**vars(args), "backend": vector_stores.VECTOR_BACKEND},
+    }
+
+    try:
+        results["ingest"] = benchmark_ingest(args.file_types, args.file_kb)
+        results["retrieval"] = benchmark_retrieval(args.corpus_sizes, args.repeat)
+        results["db"] = benchmark_db(args.history_lengths, args.repeat)
+        results["end_to_end"] = benchmark_end_to_end(args.turns)
+        results["fake_ollama_requests"] = fake.requests
+    finally:
+        fake.stop()
+        if args.keep:
+            print("working directory:", workdir, file=sys.stderr)
+        else:
+            os.chdir(os.path.dirname(output_path or workdir))
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(results, indent=2)
+    if output_path:
+        with open(output_path, "w") as f:
+            f.write(output)
+    print(output)
+
+
+# ----------------- INGEST -----------------
+
+
+def benchmark_ingest(file_types, file_kb: int):
+    import db
+    from handle_docs import read_files_and_extract_chunks, ingest_chunks
+
+    store = load_store()
+    results = []
+    for ext in file_types:
+        chat_id = db.create_chat(f"benchmark ingest {ext}", USER_ID)
+        try:
+            file_info = generate_file(ext, file_kb * 1024)
+        except ImportError as e:
+            results.append({"file_type": ext, "skipped": str(e)})
+            continue
+
+        vector_store = store.get(USER_ID, chat_id)
+
+        # parsing and (split + embed + add) timed separately, this is what the ingestion queue does through
+        # iter_file_chunks / ingest_chunks
+        try:
+            with quiet():
+                started_at = time.perf_counter()
+                docs = read_files_and_extract_chunks([file_info], USER_ID, chat_id)
+                parsed_at = time.perf_counter()
+                chunks = ingest_chunks(iter(docs), vector_store)
+                ingested_at = time.perf_counter()
+        except Exception as e:
+            # e.g. unstructured needing nltk data that isn't downloaded, the other types are still measured
+            results.append({"file_type": ext, "error": f"{type(e).__name__}: {e}"[:500]})
+            continue
+
+        total = ingested_at - started_at
+        results.append(
+            {
+                "file_type": ext,
+                "bytes": file_info["file_size"],
+                "docs": len(docs),
+                "chunks": chunks,
+                "parse_seconds": parsed_at - started_at,
+                "split_embed_add_seconds": ingested_at - parsed_at,
+                "total_seconds": total,
+                "chunks_per_second": chunks / total if total else None,
+                "megabytes_per_second": file_info["file_size"] / 1_048_576 / total if total else None,
+            }
+        )
+
+    return results
+
+
+def generate_file(ext: str, size: int):
+    os.makedirs("uploaded_files", exist_ok=True)
+    path = os.path.join("uploaded_files", f"benchmark.{ext}")
+    rng = random.Random(ext)
+
+    if ext == "txt":
+        with open(path, "w") as f:
+            while f.tell() < size:
+                f.write(paragraph(rng) + "\n\n")
+    elif ext == "md":
+        with open(path, "w") as f:
+            section = 0
+            while f.tell() < size:
+                section += 1
+                f.write(f"# Chapter {section}\n\n{paragraph(rng)}\n\n## Details {section}\n\n{paragraph(rng)}\n\n")
+    elif ext == "csv":
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["id", "name", "category", "description"])
+            row = 0
+            while f.tell() < size:
+                row += 1
+                writer.writerow([row, sentence(rng, 3), rng.choice(["a", "b", "c"]), sentence(rng, 20)])
+    elif ext == "pdf":
+        write_pdf(path, [paragraph(rng, sentences=30) for _ in range(max(1, size // 3000))])
+    elif ext in ("docx", "doc"):
+        import docx
+
+        document = docx.Document()
+        written = 0
+        while written < size:
+            text = paragraph(rng)
+            document.add_paragraph(text)
+            written += len(text)
+        document.save(path)
+    else:
+        raise ValueError(f"Can't generate .{ext} files")
+
+    with open(path, "rb") as f:
+        data = f.read()
+
+    return {
+        "filename": os.path.basename(path),
+        "file_size": len(data),
+        "mime_type": "",
+        "file_path": path,
+        "ext": ext,
+        "sha256": hashlib.sha256(data).hexdigest(),
+    }
+
+
+def write_pdf(path: str, pages):
+    # smallest pdf pypdf extracts text from: one helvetica text object per page, wrapped at ~90 characters
+    objects = []
+    page_ids = []
+    for text in pages:
+        words, lines, line = text.split(), [], ""
+        for word in words:
+            if len(line) + len(word) > 90:
+                lines.append(line)
+                line = ""
+            line += word + " "
+        lines.append(line)
+
+        escaped = [l.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)") for l in lines[:60]]
+        stream = "BT /F1 10 Tf 12 TL 40 800 Td " + " ".join(f"({l}) Tj T*" for l in escaped) + " ET"
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+        content_id = len(objects) + 2  # 1 is the catalog, 2 the page tree
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Contents {content_id} 0 R "
+                       f"/Resources << /Font << /F1 {{font}} 0 R >> >> >>")  # fmt: skip
+        page_ids.append(content_id + 1)
+
+    font_id = len(objects) + 3
+    body = [
+        "<< /Type /Catalog /Pages 2 0 R >>",
+        f"<< /Type /Pages /Kids [{' '.join(f'{i} 0 R' for i in page_ids)}] /Count {len(page_ids)} >>",
+        *[obj.replace("{font}", str(font_id)) for obj in objects],
+        "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+
+    out = b"%PDF-1.4\n"
+    offsets = []
+    for number, obj in enumerate(body, start=1):
+        offsets.append(len(out))
+        out += f"{number} 0 obj\n{obj}\nendobj\n".encode("latin-1")
+    xref_at = len(out)
+    out += f"xref\n0 {len(body) + 1}\n0000000000 65535 f \n".encode()
+    out += "".join(f"{offset:010d} 00000 n \n" for offset in offsets).encode()
+    out += f"trailer\n<< /Size {len(body) + 1} /Root 1 0 R >>\nstartxref\n{xref_at}\n%%EOF\n".encode()
+
+    with open(path, "wb") as f:
+        f.write(out)
+
+
+# ----------------- RETRIEVAL -----------------
+
+
+def benchmark_retrieval(corpus_sizes, repeat: int):
+    import db
+    from handle_docs import embed_and_add_to_store
+    from retrieval import hybrid_search, assemble_context, FETCH_K
+
+    store = load_store()
+    results = []
+    for size in corpus_sizes:
+        chat_id = db.create_chat(f"benchmark retrieval {size}", USER_ID)
+        vector_store = store.get(USER_ID, chat_id)
+        rng = random.Random(size)
+
+        started_at = time.perf_counter()
+        for start in range(0, size, 256):
+            chunks = [
+                Document(
+                    page_content=paragraph(rng, sentences=6),
+                    metadata={"source": f"doc{i // 50}.txt", "page": i % 50, "user_id": USER_ID, "chat_id": chat_id},
+                )
+                for i in range(start, min(start + 256, size))
+            ]
+            embed_and_add_to_store(chunks, vector_store)
+        indexed_seconds = time.perf_counter() - started_at
+
+        search_times, assemble_times = [], []
+        for _ in range(repeat):
+            for query in QUERIES:
+                started_at = time.perf_counter()
+                found = hybrid_search(vector_store, query, USER_ID, chat_id, k=FETCH_K)
+                searched_at = time.perf_counter()
+                assemble_context(found)
+                search_times.append(searched_at - started_at)
+                assemble_times.append(time.perf_counter() - searched_at)
+
+        results.append(
+            {
+                "chunks": size,
+                "index_seconds": indexed_seconds,
+                "search": summarize_times(search_times),
+                "assemble_context": summarize_times(assemble_times),
+            }
+        )
+
+    return results
+
+
+# ----------------- DB -----------------
+
+
+def benchmark_db(history_lengths, repeat: int):
+    import db
+    from history import get_model_history
+    from main import load_chat_model
+
+    chat_model = load_chat_model(CHAT_MODEL)
+    results = []
+    for length in history_lengths:
+        chat_id = db.create_chat(f"benchmark {length}", USER_ID)
+        rng = random.Random(length)
+
+        started_at = time.perf_counter()
+        for i in range(length):
+            db.insert_chat_message(
+                chat_id=chat_id,
+                content=paragraph(rng, sentences=3),
+                role="human" if i % 2 == 0 else "ai",
+                files_info=[],
+                statuses=[] if i % 2 == 0 else [{"label": "x", "content": "", "state": "complete", "type": "context"}],
+            )
+        insert_seconds = time.perf_counter() - started_at
+
+        # the first call folds older messages into the summary (one request to the fake model), later ones
+        # only read what came after it
+        started_at = time.perf_counter()
+        get_model_history(chat_id, chat_model)
+        first_history_seconds = time.perf_counter() - started_at
+
+        timings = {"get_chats": [], "get_chat_messages_page": [], "get_chat_history": [], "get_model_history": []}
+        for _ in range(repeat):
+            timings["get_chats"].append(timed(db.get_chats, USER_ID))
+            timings["get_chat_messages_page"].append(timed(db.get_chat_messages_page, chat_id, 30))
+            timings["get_chat_history"].append(timed(db.get_chat_history, chat_id))
+            timings["get_model_history"].append(timed(get_model_history, chat_id, chat_model))
+
+        results.append(
+            {
+                "messages": length,
+                "insert_seconds": insert_seconds,
+                "first_get_model_history_seconds": first_history_seconds,
+                **{name: summarize_times(times) for name, times in timings.items()},
+            }
+        )
+
+    return results
+
+
+# ----------------- END TO END -----------------
+
+
+def benchmark_end_to_end(turns: int):
+    # the steps chat_area runs for a prompt in an existing chat with documents: concurrent history + retrieval,
+    # context assembly and streaming the answer, up to the first token and to the end of the stream
+    import db
+    from handle_docs import embed_and_add_to_store, retrieve_documents, retrieve_context
+    from history import get_model_history
+    from main import load_chat_model, prompt_template
+    from pregeneration import PregenerationStage
+    from retrieval import assemble_context
+
+    store = load_store()
+    chat_model = load_chat_model(CHAT_MODEL)
+    chain = prompt_template | chat_model
+
+    chat_id = db.create_chat("benchmark end to end", USER_ID)
+    vector_store = store.get(USER_ID, chat_id)
+    rng = random.Random("end to end")
+    embed_and_add_to_store(
+        [
+            Document(page_content=paragraph(rng, sentences=6), metadata={"source": "doc.txt", "user_id": USER_ID, "chat_id": chat_id})
+            for _ in range(500)
+        ],
+        vector_store,
+    )
+
+    runs = []
+    for turn in range(turns):
+        prompt = QUERIES[turn % len(QUERIES)]
+        started_at = time.perf_counter()
+
+        stage = PregenerationStage()
+        stage.start("history", get_model_history, chat_id, chat_model)
+        stage.start("documents", retrieve_documents, vector_store, prompt, USER_ID, chat_id)
+        results = retrieve_context(vector_store, prompt, USER_ID, chat_id, document_results=stage.result("documents", []))
+        context = "\n---\n\n".join(doc.page_content for doc in assemble_context(results))
+        history = stage.result("history", [])
+        prepared_at = time.perf_counter()
+
+        first_token_at = None
+        response = ""
+        tokens = 0
+        for chunk in chain.stream(
+            {"style_rule": "", "attachments": context, "human_input": prompt, "chat_history": history}
+        ):
+            if chunk.content:
+                if first_token_at is None:
+                    first_token_at = time.perf_counter()
+                tokens += 1
+                response += chunk.content  # pyright: ignore
+        finished_at = time.perf_counter()
+
+        db.insert_chat_message(chat_id=chat_id, content=prompt, role="human", files_info=[], statuses=[])
+        db.insert_chat_message(chat_id=chat_id, content=response, role="ai", files_info=[], statuses=[])
+
+        streaming_seconds = finished_at - (first_token_at or finished_at)
+        runs.append(
+            {
+                "prepare_seconds": prepared_at - started_at,
+                "time_to_first_token_seconds": (first_token_at or finished_at) - started_at,
+                "total_seconds": finished_at - started_at,
+                "tokens": tokens,
+                "tokens_per_second": tokens / streaming_seconds if streaming_seconds else None,
+            }
+        )
+
+    return {
+        "turns": runs,
+        "prepare": summarize_times([run["prepare_seconds"] for run in runs]),
+        "time_to_first_token": summarize_times([run["time_to_first_token_seconds"] for run in runs]),
+        "total": summarize_times([run["total_seconds"] for run in runs]),
+    }
+
+
+# ----------------- HELPERS -----------------
+
+
+def load_store():
+    # same as main.load_vector_store, without going through streamlit's resource cache
+    from langchain_ollama import OllamaEmbeddings
+    from embedding_cache import CachedEmbeddings
+    import vector_stores
+
+    embeddings = CachedEmbeddings(OllamaEmbeddings(model=EMBEDDING_MODEL), model=EMBEDDING_MODEL)
+    return vector_stores.PartitionedVectorStore(embeddings, EMBEDDING_MODEL, backend=vector_stores.VECTOR_BACKEND)
+
+
+# made up words plus a few real ones the queries look for, so that the full text index finds something
+_rng = random.Random(0)
+WORDS = [
+    "".join(_rng.choice(["ka", "lo", "mi", "ter", "sun", "ra", "vel", "do", "pri", "an"]) for _ in range(_rng.randint(2, 4)))
+    for _ in range(3000)
+] + ["cache", "retry", "storage", "revenue", "security", "config", "connection", "pool", "report", "engine"]
+
+
+def sentence(rng: random.Random, words: int = 12):
+    return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize() + "."
+
+
+def paragraph(rng: random.Random, sentences: int = 8):
+    return " ".join(sentence(rng, rng.randint(6, 18)) for _ in range(sentences))
+
+
+def timed(fn, *args):
+    started_at = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - started_at
+
+
+def summarize_times(times):
+    ordered = sorted(times)
+    return {
+        "count": len(ordered),
+        "mean_ms": statistics.fmean(ordered) * 1000,
+        "p50_ms": ordered[len(ordered) // 2] * 1000,
+        "p95_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000,
+        "max_ms": ordered[-1] * 1000,
+    }
+
+
+@contextmanager
+def quiet():
+    # handle_docs prints every parsed doc (worker processes too), keeping that out of the json on stdout
+    sys.stdout.flush()
+    saved = os.dup(1)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        os.dup2(saved, 1)
+        os.close(devnull)
+        os.close(saved)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+import hashlib
+import os
+import tempfile
+import time
+from pathlib import Path
+
+from filelock import FileLock
+
+import db
+
+# ----------------- CONTENT ADDRESSED BLOB STORE -----------------
+# uploaded files are stored once per content, at uploaded_files/<first 2 hex>/<next 2 hex>/<sha256>, however many
+# chats they're attached to. they're streamed to a temporary file in chunks while being hashed (never held in
+# memory whole) and then moved into place. the blobs table counts the files_info entries of messages referring to
+# each blob, blobs nobody refers to anymore are removed when a chat is deleted (and when the app starts).
+
+BLOB_DIRECTORY = "uploaded_files"
+# bytes read and written at a time
+BLOB_CHUNK_SIZE = 1024 * 1024
+# seconds a blob is kept after its last upload even if nothing refers to it, uploads are only referred to once
+# their message is saved (which, for the http api, is a separate request)
+BLOB_GRACE_SECONDS = 60 * 60
+
+# moving blobs into place and removing unreferenced ones don't interleave, in any process (the streamlit app and
+# the http api share the store), so a blob that is uploaded again while being removed is never left without its file
+_lock = FileLock(os.path.join(BLOB_DIRECTORY, "blobs.lock"))
+
+
+def blob_path(hash: str):
+    return os.path.join(BLOB_DIRECTORY, hash[:2], hash[2:4], hash)
+
+
+class BlobWriter:
+    # usage: writer = BlobWriter(); writer.write(chunk) ...; hash, path, size = writer.commit()
+    def __init__(self):
+        tmp_dir = Path(BLOB_DIRECTORY) / "tmp"
+        tmp_dir.mkdir(parents=True, exist_ok=True)
+        self._file = tempfile.NamedTemporaryFile(delete=False, dir=tmp_dir)
+        self._hash = hashlib.sha256()
+        self.size = 0
+
+    def write(self, chunk: bytes):
+        self._file.write(chunk)
+        self._hash.update(chunk)
+        self.size += len(chunk)
+
+    def commit(self):
+        self._file.close()
+        hash = self._hash.hexdigest()
+        path = blob_path(hash)
+
+        with _lock:
+            if os.path.exists(path):
+                os.remove(self._file.name)  # same content stored already
+            else:
+                Path(path).parent.mkdir(parents=True, exist_ok=True)
+                os.replace(self._file.name, path)
+            db.add_blob(hash, self.size)
+
+        return hash, path, self.size
+
+    def abort(self):
+        self._file.close()
+        os.remove(self._file.name)
+
+
+def write_blob(file):
+    # file is any binary file-like object (e.g. streamlit's UploadedFile), read from the start in chunks
+    file.seek(0)
+    writer = BlobWriter()
+    try:
+        while chunk := file.read(BLOB_CHUNK_SIZE):
+            writer.write(chunk)
+    except BaseException:
+        writer.abort()
+        raise
+
+    return writer.commit()
+
+
+def remove_unreferenced_blobs(grace_seconds: float = BLOB_GRACE_SECONDS):
+    # blobs no message refers to anymore and not uploaded within grace_seconds
+    with _lock:
+        hashes = db.delete_unreferenced_blobs(int(time.time() - grace_seconds))
+        for hash in hashes:
+            Path(blob_path(hash)).unlink(missing_ok=True)
+
+    return hashes
@@ -1,17 +1,18 @@
 import streamlit as st
-from handle_docs import (
-    read_files_and_extract_chunks,
-    save_files,
-    get_context_from_attachments,
-    get_web_results,
-    split_and_add_to_store,
-)
-from main import load_chat_model, load_vector_store, get_chain, embedding_models, chat_models
+from handle_docs import save_files, get_context_from_attachments
+from main import load_chat_model, load_vector_store, get_chain, get_ingestion_queue, embedding_models, chat_models
 import time
 from random import random
 import db
+from pipeline import Turn, reasoning_option
+from ingestion import ingestion_progress
+from vector_stores import drop_chat_vectors
+from blob_store import remove_unreferenced_blobs
 from sidebar_area import create_new_chat
 
+# number of messages rendered when a chat is opened and loaded each time "Load older messages" is clicked
+HISTORY_PAGE_SIZE = 30
+
 
 def render_statuses(statuses):
     for status in statuses:
@@ -55,6 +56,55 @@ def convert_file_size(filename, file_size):
     return file_size, unit, label
 
 
+@st.fragment(run_every=2)
+def ingestion_status(chat_id, job_ids):
+    # progress of the chat's attachments being indexed (or its documents re-embedded) in the background, polled
+    # every few seconds
+    jobs = [job for job in db.get_ingestion_jobs(chat_id) if job["id"] in job_ids]
+    # finished ones aren't shown again from the next rerun on
+    finished_ids = {job["id"] for job in jobs if job["state"] in {"done", "error"}}
+    if finished_ids:
+        st.session_state["ingestion_job_ids"] = [
+            id for id in st.session_state.get("ingestion_job_ids", []) if id not in finished_ids
+        ]
+    uploads = [job for job in jobs if job["kind"] == "upload"]
+    reembeds = [job for job in jobs if job["kind"] == "reembed"]
+
+    done, total = ingestion_progress(uploads)
+    if total:
+        files = [file for job in uploads for file in job["files"]]
+        if done < total:
+            label, state = f":material/document_scanner: Indexing documents ({done}/{total} files)", "running"
+        elif any(file["state"] == "error" for file in files):
+            label, state = ":material/document_scanner: Some documents could not be indexed", "error"
+        else:
+            label, state = ":material/document_scanner: Documents indexed", "complete"
+
+        with st.status(label, state=state):
+            for file in files:
+                filename = file["file_info"]["filename"]
+                if file["state"] == "error":
+                    st.write(f"`{filename}`: {file['error']}")
+                elif file["state"] == "queued":
+                    st.write(f"`{filename}`: waiting")
+                else:
+                    throughput = f", {file['chunks_per_second']:.1f} chunks/s" if file["chunks_per_second"] else ""
+                    st.write(
+                        f"`{filename}`: {file['chunks_added']} chunks from {file['docs_read']} pages/sections{throughput} ({file['state']})"
+                    )
+
+    for job in reembeds:
+        chunks_total = sum(file["file_info"]["chunk_count"] for file in job["files"])
+        chunks_done = sum(
+            file["file_info"]["chunk_count"] if file["state"] == "done" else file["chunks_added"] for file in job["files"]
+        )
+        label = f":material/autorenew: Re-embedding documents with {job['embedding_model']} ({chunks_done}/{chunks_total} chunks)"
+        if job["state"] in {"queued", "running"}:
+            st.progress(chunks_done / chunks_total if chunks_total else 0.0, text=label)
+        elif job["state"] == "error":
+            st.error(f"Re-embedding documents with {job['embedding_model']} failed: {job['error']}", icon=":material/error:")
+
+
 # class Message:
 #     def __init__(
 #         self,
@@ -86,11 +136,15 @@ def main():
 
     user_id = st.session_state["user_id"]
 
+    # only the latest page of messages is loaded and rendered, older ones are loaded on demand
     if "current_chat_history" not in st.session_state:
         if current_chat_id == 0:
             st.session_state["current_chat_history"] = []
+            st.session_state["history_cursor"] = None
         else:
-            st.session_state["current_chat_history"] = db.get_chat_messages(current_chat_id)
+            messages, cursor = db.get_chat_messages_page(current_chat_id, HISTORY_PAGE_SIZE)
+            st.session_state["current_chat_history"] = messages
+            st.session_state["history_cursor"] = cursor
 
     current_chat_history = st.session_state["current_chat_history"]
 
@@ -103,6 +157,8 @@ def main():
                 delete_btn = st.button(":material/delete:")
                 if delete_btn:
                     db.delete_chat(current_chat_id)
+                    drop_chat_vectors(user_id, current_chat_id)
+                    remove_unreferenced_blobs()
                     create_new_chat()
 
     # ---------------- PREFERENCES ----------------
@@ -112,9 +168,9 @@ def main():
             "Ensure models are downloaded locally: `ollama pull <model_name>` (unless the model_name is ending with `cloud` which requires login in Ollama software instead.)\n\nYou can manually type a different model from Ollama library below as well.",
             icon=":material/info:",
         )
-        st.warning(
-            "Changing embedding model would require you to either re-upload documents or start a new chat for it to work properly",
-            icon=":material/warning:",
+        st.info(
+            "Changing embedding model re-embeds the chat's documents in the background, they are searched with the previous model until that's done",
+            icon=":material/info:",
         )
 
         with st.form("preferences", clear_on_submit=False, border=False):
@@ -173,6 +229,14 @@ def main():
             f'<div style="display:flex;flex-direction:column;justify-content:center;align-items:center;min-height:max(275px,100%);margin-top:auto;opacity:1;"><p style="font-size:1.2rem;">{st.session_state["greeting_msg"]}</p><p style="opacity:0.8;">💡 Start prompt with /search to enable web search.<p/></div>'
         )
     else:
+        if st.session_state.get("history_cursor") is not None:
+            if st.button("Load older messages", icon=":material/history:", type="tertiary"):
+                messages, cursor = db.get_chat_messages_page(
+                    current_chat_id, HISTORY_PAGE_SIZE, before=st.session_state["history_cursor"]
+                )
+                current_chat_history[:0] = messages
+                st.session_state["history_cursor"] = cursor
+
         for item in current_chat_history:
             if item["role"] == "human":
                 with st.chat_message("human"):
@@ -187,6 +251,39 @@ def main():
                         render_statuses(item["statuses"])
                     st.markdown(item["content"])
 
+    # ----------------- DOCUMENTS STILL BEING INDEXED -----------------
+
+    # the chat's documents are searched with the model they are embedded with until they're re-embedded with the
+    # selected one (queued here the first time the chat is opened with it). checked when the chat or the selected
+    # model changes (and again while the documents are still being re-embedded), not on every rerun, along with
+    # the chat's jobs still running, which are shown until they're done (see ingestion_status)
+    search_embedding_model = selected_embedding_model
+    if current_chat_id != 0:
+        check_key = (current_chat_id, selected_embedding_model)
+        if (
+            st.session_state.get("embedding_check_key") != check_key
+            or st.session_state["search_embedding_model"] != selected_embedding_model
+        ):
+            st.session_state["search_embedding_model"] = get_ingestion_queue().embedding_model_for(
+                user_id, current_chat_id, selected_embedding_model
+            )
+            unfinished_jobs = db.get_ingestion_jobs(current_chat_id, unfinished_only=True)
+            st.session_state["ingestion_job_ids"] = [job["id"] for job in unfinished_jobs]
+            st.session_state["legacy_attachments"] = db.get_legacy_attachments(
+                current_chat_id, selected_embedding_model
+            )
+            st.session_state["embedding_check_key"] = check_key
+
+        search_embedding_model = st.session_state["search_embedding_model"]
+        if st.session_state["legacy_attachments"]:
+            filenames = ", ".join(f"`{filename}`" for filename in st.session_state["legacy_attachments"])
+            st.warning(
+                f"{filenames} were attached before documents could be re-embedded. Changing embedding model would require you to either re-upload them or start a new chat for it to work properly",
+                icon=":material/warning:",
+            )
+        if st.session_state["ingestion_job_ids"]:
+            ingestion_status(current_chat_id, list(st.session_state["ingestion_job_ids"]))
+
     # ----------------- PROMPT INPUT ELEMENT -----------------
 
     prompt_input = st.chat_input(
@@ -211,16 +308,12 @@ def main():
             greetings_div.empty()
 
             try:
-                vector_store = load_vector_store(selected_embedding_model)
+                vector_stores = load_vector_store(search_embedding_model)
 
                 chat_model = load_chat_model(
                     selected_chat_model,
                     temperature=selected_temperature,
-                    reasoning=(
-                        None
-                        if selected_reasoning == "Default"
-                        else False if selected_reasoning == "Off" else selected_reasoning.lower()
-                    ),
+                    reasoning=reasoning_option(selected_reasoning),
                 )
             except Exception as e:
                 st.error(str(e))
@@ -231,29 +324,51 @@ def main():
             finally:
                 st.session_state["disabled"] = False
 
+            # the steps of this turn, shared with the http api (see pipeline.py), rendered here as they run
+            turn = Turn(user_id, current_chat_id, original_prompt_text, chat_model, vector_stores, selected_style)
+            timings = turn.timings
+
+            # -------------- history for the model (within its token budget, older turns summarized) ------------
+
+            turn.start_history()
+
             # -------------- create new chat and update the session state ------------
 
             if len(current_chat_history) == 0:
-                new_chat_id = db.create_chat(current_chat["name"], user_id)
+                new_chat_id = turn.create_chat(current_chat["name"])
                 current_chat_id = new_chat_id
                 st.session_state["current_chat_id"] = new_chat_id
                 for chat in st.session_state["chats"]:
                     if chat["id"] == 0:
                         chat["id"] = new_chat_id
 
+            # ------------- WEB SEARCH (fetched and indexed while attachments are handled) -------------
+
+            turn.start_web_search()
+
             with st.chat_message("human"):
                 # ----------------- SAVING FILES -----------------
 
                 files_info = []
                 if files:
-                    with st.status(":material/document_scanner: Handling attached documents"):
-                        with st.status(":material/save: Saving files & getting their contents & info"):
+                    with st.status(":material/save: Saving files & getting their contents & info"):
+                        with timings.span("save_files"):
                             files_info = save_files(files)
 
-                        # ----------------- READING FILES AND EXTRACTING CHUNKS -----------------
+                    # ----------------- INDEXING FILES (in the background) -----------------
+
+                    ingestion_queue = get_ingestion_queue()
+                    # into the store searched this turn, re-embedding brings it to the selected model if that's another
+                    job_id = ingestion_queue.submit(user_id, current_chat_id, search_embedding_model, files_info)
+                    st.session_state.setdefault("ingestion_job_ids", []).append(job_id)
+                    ingestion_status(current_chat_id, [job_id])
+                    # small uploads are answered with all of their chunks, bigger ones from what's indexed by then
+                    ingestion_queue.wait(job_id, current_chat_id)
+
+                # ----------------- SEARCHING THE CHAT'S DOCUMENTS (in the background) -----------------
+
+                turn.start_document_search()
 
-                        chunks = read_files_and_extract_chunks(files_info, user_id, current_chat_id)
-                        split_and_add_to_store(chunks, vector_store)
                 # ---------------- FILE DOWNLOAD BUTTONS ----------------
 
                 if files_info:
@@ -269,51 +384,32 @@ def main():
 
                 # ------------- WEB SEARCH -------------
 
-                if original_prompt_text.startswith("/search"):
-                    # original_prompt_text = original_prompt_text[7:]
+                if turn.is_web_search:
                     status_label = ":material/web: Searching Web"
-
-                    try:
-                        with st.status(status_label):
-                            chunks = get_web_results(original_prompt_text, chat_id=current_chat_id, user_id=user_id)
-                            split_and_add_to_store(chunks, vector_store)
-
-                        status_state = "complete"
-
-                    except:
-                        status_state = "error"
-                    finally:
-                        statuses.append(
-                            {
-                                "label": status_label,
-                                "content": "",
-                                "state": status_state,
-                                "type": "web_search",
-                            }
-                        )
+                    status_state = turn.web_search_state()
+                    with st.status(status_label, state=status_state):
+                        pass
+
+                    statuses.append(
+                        {
+                            "label": status_label,
+                            "content": "",
+                            "state": status_state,
+                            "type": "web_search",
+                        }
+                    )
 
                 # --------------- VECTOR DB RETRIEVAL AND CONTEXT BUILDING ---------------
 
-                context_string = get_context_from_attachments(
-                    vector_store, original_prompt_text, chat_id=current_chat_id, user_id=user_id
-                )
+                context_string = get_context_from_attachments(turn.context())
+
+                model_chat_history = turn.history()
 
                 # -------------- GETTING CHAIN AND STREAMING --------------
 
                 chain = get_chain(chat_model=chat_model)
 
-                input = {
-                    "style_rule": f"- Adopt a {selected_style} tone" if selected_style != "Normal" else "",
-                    "attachments": (
-                        f"Following contents were found from documents attached. Use them to answer user query. Also reference them.\n\n---\n{context_string.strip()}"
-                        if context_string.strip()
-                        else ""
-                    ),
-                    "human_input": (
-                        "I have attached some attachments" if files and not original_prompt_text else original_prompt_text
-                    ),
-                    "chat_history": current_chat_history,
-                }
+                input = turn.chain_input(context_string, model_chat_history, has_files=bool(files))
 
                 # testing prompt
                 # print("FINAL PROMPT BEING SENT\n", prompt_template.format_messages(**input))
@@ -322,9 +418,7 @@ def main():
 
                 # ------------ inserting original message to db and history ---------------------
 
-                db.insert_chat_message(
-                    chat_id=current_chat_id, content=original_prompt_text, role="human", files_info=files_info, statuses=[]
-                )
+                new_time = turn.save_prompt(files_info)
                 original_message = {"content": original_prompt_text, "role": "human", "files_info": files_info}
                 current_chat_history.append(original_message)
 
@@ -332,8 +426,6 @@ def main():
 
                 for chat in st.session_state["chats"]:
                     if chat["id"] == current_chat_id:
-                        new_time = int(time.time())
-                        db.update_last_interaction(chat_id=current_chat_id, new_time=new_time)
                         chat["last_interaction"] = new_time
                         break
 
@@ -377,6 +469,7 @@ def main():
                                     thinking_placeholder.markdown(final_thinking_content)
 
                                 if chunk.content:
+                                    turn.on_token()
                                     if processing_end_time is None:
                                         processing_end_time = time.time()
                                         final_thinking_status_state = "complete"
@@ -398,6 +491,7 @@ def main():
                                     label=final_thinking_status_label,
                                     state=final_thinking_status_state,
                                 )
+                                turn.on_token()
                                 response += chunk
                                 yield chunk
 
@@ -417,9 +511,15 @@ def main():
                                 },
                             ]
                         )
-                        current_chat_history.append({"content": response, "role": "ai", "files_info": [], "statuses": statuses})
-                        db.insert_chat_message(
-                            chat_id=current_chat_id, content=response, role="ai", files_info=[], statuses=statuses
+                        turn.save_answer(response, statuses)
+                        current_chat_history.append(
+                            {
+                                "content": response,
+                                "role": "ai",
+                                "files_info": [],
+                                "statuses": statuses,
+                                "timings": timings.to_dict(),
+                            }
                         )
 
                     except Exception as e:
@@ -449,3 +549,8 @@ def main():
                 st.write_stream(stream_generator(chunks))
 
         st.session_state["disabled"] = False
+
+        # the sidebar was rendered before this chat was created / moved to the top, rerunning so that it shows
+        # the new order right away (the chat list comes from memory, so this costs no db query)
+        if [c["id"] for c in db.get_chats(user_id)] != st.session_state.get("sidebar_chat_ids"):
+            st.rerun()
@@ -1,11 +1,50 @@
 import sqlite3
+import queue
+import threading
+from array import array
+from contextlib import contextmanager
 
+DB_PATH = "chatdocs.db"
+POOL_SIZE = 8
 
-def get_conn():
-    conn = sqlite3.connect("chatdocs.db")
+# ----------------- CONNECTION POOL -----------------
+# streamlit runs every rerun of every session in its own thread, so connections are kept in a shared pool
+# instead of per thread. each connection keeps its own prepared statement cache (cached_statements) which is
+# only useful because connections are long lived now.
+
+_pool = queue.LifoQueue(maxsize=POOL_SIZE)
+
+
+def connect():
+    conn = sqlite3.connect(DB_PATH, timeout=10, check_same_thread=False, cached_statements=256)
+    conn.execute("PRAGMA journal_mode = WAL")  # readers don't block the writer and vice versa
+    conn.execute("PRAGMA synchronous = NORMAL")  # safe with WAL, fsync only on checkpoints
+    conn.execute("PRAGMA busy_timeout = 10000")
     return conn
 
 
+@contextmanager
+def get_conn():
+    # usage: with get_conn() as conn: ...
+    # for writes use `with conn:` inside as well, which commits (or rolls back) the transaction
+    try:
+        conn = _pool.get_nowait()
+    except queue.Empty:
+        conn = connect()
+
+    try:
+        yield conn
+    except Exception:
+        if conn.in_transaction:
+            conn.rollback()
+        raise
+    finally:
+        try:
+            _pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+
 def setup():
     query = """
         PRAGMA foreign_keys = ON;
@@ -51,160 +90,527 @@ def setup():
         ) values (0, "Abdullah", "password");
     """
 
-    conn = get_conn()
-    cursor = conn.cursor()
+    # not a pooled connection since the script changes connection level pragmas (foreign_keys)
+    conn = connect()
+    conn.executescript(query)  # executescript commits by itself
+    conn.close()
 
-    cursor.executescript(query)
+    migrate()
 
-    conn.commit()
-    conn.close()
 
+# ----------------- MIGRATIONS -----------------
+# changes to the schema after setup go here instead of setup's script, so that existing databases get them too.
+# migration N runs once, when PRAGMA user_version is below N. only ever append to this list.
 
-def create_chat(name: str, user_id: int) -> int:
-    conn = get_conn()
-    cursor = conn.cursor()
+MIGRATIONS = [
+    # 1: content addressed document cache
+    # documents are keyed by sha256 of the uploaded bytes so the same file is parsed & split only once
+    # chunk_embeddings are float32 blobs, one set per embedding model
+    [
+        """
+        create table if not exists documents (
+            hash TEXT PRIMARY KEY,
+            ext TEXT,
+            chunk_count INTEGER NOT NULL,
+            created_at INTEGER DEFAULT (unixepoch())
+        )
+        """,
+        """
+        create table if not exists document_chunks (
+            hash TEXT REFERENCES documents(hash),
+            position INTEGER,
+            content TEXT,
+            metadata TEXT CHECK(json_valid(metadata)),
+            PRIMARY KEY (hash, position)
+        )
+        """,
+        """
+        create table if not exists chunk_embeddings (
+            hash TEXT REFERENCES documents(hash),
+            position INTEGER,
+            embedding_model TEXT,
+            embedding BLOB,
+            PRIMARY KEY (hash, position, embedding_model)
+        )
+        """,
+    ],
+    # 2: indexes for the sidebar chat list and for loading a chat's messages
+    # (chats one also covers get_chats' columns so it never touches the table)
+    [
+        "create index if not exists chats_user_id_last_interaction on chats (user_id, last_interaction DESC, name)",
+        "create index if not exists chat_messages_chat_id_sent_at on chat_messages (chat_id, sent_at)",
+    ],
+    # 3: running summary of the messages that no longer fit in the model's history budget
+    # until_sent_at, until_id is the (sent_at, id) cursor of the last message folded into the summary
+    [
+        """
+        create table if not exists chat_summaries (
+            chat_id INTEGER PRIMARY KEY REFERENCES chats(id),
+            summary TEXT NOT NULL,
+            until_sent_at INTEGER NOT NULL,
+            until_id INTEGER NOT NULL,
+            updated_at INTEGER DEFAULT (unixepoch())
+        )
+        """,
+    ],
+    # 4: number of chunks each chat has in each embedding model's vector store, so that retrieval can be skipped
+    # for chats without any
+    [
+        """
+        create table if not exists chat_chunk_counts (
+            user_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            embedding_model TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, chat_id, embedding_model)
+        )
+        """,
+    ],
+    # 5: full text index of chunk text alongside the vector store, for exact term (bm25) retrieval
+    # chunk_id is the id of the same chunk in the vector store. '_' is kept inside tokens for identifiers
+    [
+        """
+        create virtual table if not exists chunks_fts using fts5(
+            content,
+            chunk_id UNINDEXED,
+            user_id UNINDEXED,
+            chat_id UNINDEXED,
+            embedding_model UNINDEXED,
+            metadata UNINDEXED,
+            tokenize = "unicode61 tokenchars '_'"
+        )
+        """,
+    ],
+    # 6: per stage latency of the turn an ai message answered (save_files, parse, embed, retrieval, ttft ...),
+    # json like statuses. null for human messages and messages from before
+    [
+        "alter table chat_messages add column timings TEXT CHECK(timings is null or json_valid(timings))",
+    ],
+    # 7: background ingestion queue, a job per upload and a row per file of it with its progress
+    # job state: queued -> running -> done | error, file state: queued -> indexing -> done | error
+    [
+        """
+        create table if not exists ingestion_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            embedding_model TEXT NOT NULL,
+            state TEXT NOT NULL DEFAULT 'queued',
+            error TEXT,
+            created_at INTEGER DEFAULT (unixepoch()),
+            started_at INTEGER,
+            finished_at INTEGER
+        )
+        """,
+        """
+        create table if not exists ingestion_files (
+            job_id INTEGER REFERENCES ingestion_jobs(id),
+            position INTEGER,
+            file_info TEXT CHECK(json_valid(file_info)),
+            state TEXT NOT NULL DEFAULT 'queued',
+            docs_read INTEGER NOT NULL DEFAULT 0,
+            chunks_added INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            PRIMARY KEY (job_id, position)
+        )
+        """,
+        "create index if not exists ingestion_jobs_state on ingestion_jobs (state, id)",
+        "create index if not exists ingestion_jobs_chat_id on ingestion_jobs (chat_id, id)",
+    ],
+    # 8: re-embedding a chat's documents when the embedding model changes
+    # chat_documents are the cached documents (by hash) indexed into each chat, per embedding model. filled in
+    # from the files_info of messages from before, for the models the chat has chunks in (narrowed down by 13).
+    # ingestion_jobs.kind is upload, or reembed for jobs adding a chat's documents to another embedding model's store
+    [
+        """
+        create table if not exists chat_documents (
+            user_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            hash TEXT NOT NULL REFERENCES documents(hash),
+            embedding_model TEXT NOT NULL,
+            file_info TEXT CHECK(json_valid(file_info)),
+            added_at INTEGER DEFAULT (unixepoch()),
+            PRIMARY KEY (chat_id, hash, embedding_model)
+        )
+        """,
+        """
+        insert or ignore into chat_documents (user_id, chat_id, hash, embedding_model, file_info)
+        select chats.user_id, chat_messages.chat_id, documents.hash, chat_chunk_counts.embedding_model, file.value
+        from chat_messages
+        join chats on chats.id = chat_messages.chat_id
+        join json_each(chat_messages.files_info) as file
+        join documents on documents.hash = json_extract(file.value, '$.sha256')
+        join chat_chunk_counts on chat_chunk_counts.chat_id = chat_messages.chat_id
+            and chat_chunk_counts.user_id = chats.user_id and chat_chunk_counts.count > 0
+        order by chat_messages.sent_at, chat_messages.id
+        """,
+        "alter table ingestion_jobs add column kind TEXT NOT NULL DEFAULT 'upload'",
+    ],
+    # 9: content addressed blob store of uploaded files (see blob_store.py), ref_count is the number of files_info
+    # entries of messages referring to the blob (marked blob_ref since 14). files uploaded before are left where
+    # they are
+    [
+        """
+        create table if not exists blobs (
+            hash TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            ref_count INTEGER NOT NULL DEFAULT 0,
+            uploaded_at INTEGER DEFAULT (unixepoch())
+        )
+        """,
+        "create index if not exists blobs_ref_count on blobs (ref_count, uploaded_at)",
+    ],
+    # 10: version of the chats table, bumped by every change to it (from any process), so that the chat list cached
+    # in memory by each process (see get_chats) notices chats created, renamed or deleted by another
+    [
+        "create table if not exists chats_version (version INTEGER NOT NULL)",
+        "insert into chats_version (version) select 0 where not exists (select 1 from chats_version)",
+        """
+        create trigger if not exists chats_version_insert after insert on chats
+        begin update chats_version set version = version + 1; end
+        """,
+        """
+        create trigger if not exists chats_version_update after update on chats
+        begin update chats_version set version = version + 1; end
+        """,
+        """
+        create trigger if not exists chats_version_delete after delete on chats
+        begin update chats_version set version = version + 1; end
+        """,
+    ],
+    # 11: embedding throughput (chunks/s) of each file being indexed, shown with its progress
+    [
+        "alter table ingestion_files add column chunks_per_second REAL",
+    ],
+    # 12: ingestion jobs are leased by the queue (process) running them, owner being that queue and
+    # lease_expires_at when another may take the job over (see ingestion.py)
+    [
+        "alter table ingestion_jobs add column owner TEXT",
+        "alter table ingestion_jobs add column lease_expires_at INTEGER",
+    ],
+    # 13: 8 filled in chat_documents for every model the chat has chunks in, whether the document was indexed
+    # into that model's store or not. only rows of models that embedded the document are kept: its chunks are in
+    # the chat's full text index under the model, or (chats indexed before 5, without any in it) the document
+    # has embeddings of the model. documents without chunks are left alone
+    [
+        """
+        delete from chat_documents
+        where hash in (select hash from documents where chunk_count > 0)
+        and (chat_id, embedding_model, hash) not in (
+            select chat_id, embedding_model, json_extract(metadata, '$.file_hash') from chunks_fts
+            where json_extract(metadata, '$.file_hash') is not null
+        )
+        and not (
+            (chat_id, hash) not in (
+                select chat_id, json_extract(metadata, '$.file_hash') from chunks_fts
+                where json_extract(metadata, '$.file_hash') is not null
+            )
+            and exists (
+                select 1 from chunk_embeddings
+                where chunk_embeddings.hash = chat_documents.hash
+                and chunk_embeddings.embedding_model = chat_documents.embedding_model
+            )
+        )
+        """,
+    ],
+    # 14: files_info entries counted in blobs.ref_count are marked blob_ref (see insert_chat_message), those saved
+    # since 9 are the ones at their blob's path. ref_count is counted again from them, deleting chats with
+    # attachments from before 9 used to release refs that were never added
+    [
+        """
+        update chat_messages set files_info = (
+            select json_group_array(json(
+                case
+                    when replace(json_extract(file.value, '$.file_path'), '\\', '/') = 'uploaded_files/'
+                        || substr(blobs.hash, 1, 2) || '/' || substr(blobs.hash, 3, 2) || '/' || blobs.hash
+                    then json_set(file.value, '$.blob_ref', json('true'))
+                    else file.value
+                end
+            ))
+            from json_each(chat_messages.files_info) as file
+            left join blobs on blobs.hash = json_extract(file.value, '$.sha256')
+        )
+        where json_array_length(files_info) > 0
+        """,
+        "update blobs set ref_count = 0",
+        """
+        update blobs set ref_count = refs.count
+        from (
+            select json_extract(file.value, '$.sha256') as hash, count(*) as count
+            from chat_messages join json_each(chat_messages.files_info) as file
+            where json_extract(file.value, '$.blob_ref')
+            group by hash
+        ) as refs
+        where blobs.hash = refs.hash
+        """,
+    ],
+]
+
+
+def migrate():
+    with get_conn() as conn:
+        for version, statements in enumerate(MIGRATIONS, start=1):
+            with conn:
+                # immediate so that two processes starting at once don't both run the same migration
+                conn.execute("BEGIN IMMEDIATE")
+                if conn.execute("PRAGMA user_version").fetchone()[0] >= version:
+                    continue
+
+                for statement in statements:
+                    conn.execute(statement)
+                conn.execute(f"PRAGMA user_version = {version}")
+
+
+# ----------------- CHAT LIST CACHE -----------------
+# the sidebar needs the chat list on every rerun, so it is kept in memory per user and the functions below that
+# change chats write through to it instead of the sidebar querying the db each time. each list is kept along with
+# the chats_version it is current at, so a change made by another process (e.g. the http api next to streamlit)
+# is noticed with a one row lookup and the list is read again
+
+_chats_cache = {}  # user_id -> {"version": chats_version, "chats": chats ordered by last_interaction DESC}
+_chats_cache_lock = threading.Lock()
 
+
+def get_chats_version(conn):
+    return conn.execute("select version from chats_version").fetchone()[0]
+
+
+def write_through_chats(versions, update):
+    # after a change to chats made in one immediate transaction going from chats_version versions[0] to
+    # versions[1]: update(chats) is applied to the cached lists that were current before it, the others missed a
+    # change of another process and are read again by get_chats anyway
+    with _chats_cache_lock:
+        for user_id, cached in _chats_cache.items():
+            if cached["version"] == versions[0]:
+                update(user_id, cached["chats"])
+                cached["version"] = versions[1]
+
+
+def create_chat(name: str, user_id: int) -> int:
     query = """
-    insert into chats (name, user_id) values (?, ?) returning id
+    insert into chats (name, user_id) values (?, ?) returning id, last_interaction
     """
-    cursor.execute(query, (name, user_id))
-    new_id = cursor.fetchone()[0]
+    with get_conn() as conn, conn:
+        conn.execute("BEGIN IMMEDIATE")
+        version = get_chats_version(conn)
+        new_id, last_interaction = conn.execute(query, (name, user_id)).fetchone()
+        versions = (version, get_chats_version(conn))
 
-    conn.commit()
-    conn.close()
+    def update(cached_user_id, chats):
+        if cached_user_id == user_id:
+            chats.insert(0, {"id": new_id, "user_id": user_id, "name": name, "last_interaction": last_interaction})
 
+    write_through_chats(versions, update)
     return new_id
 
 
 def delete_chat(id: int):
-    conn = get_conn()
-    cursor = conn.cursor()
-
     query = """
     delete from chats where id = ?
     """
-    cursor.execute(query, (id,))
+    with get_conn() as conn, conn:
+        conn.execute("BEGIN IMMEDIATE")
+        version = get_chats_version(conn)
+        conn.execute(query, (id,))
+        versions = (version, get_chats_version(conn))
+        # the chat's attachments no longer refer to their blobs
+        conn.execute(
+            """
+            update blobs set ref_count = ref_count - refs.count
+            from (
+                select json_extract(file.value, '$.sha256') as hash, count(*) as count
+                from chat_messages join json_each(chat_messages.files_info) as file
+                where chat_messages.chat_id = ? and json_extract(file.value, '$.blob_ref')
+                group by hash
+            ) as refs
+            where blobs.hash = refs.hash
+            """,
+            (id,),
+        )
+        conn.execute("delete from chat_messages where chat_id = ?", (id,))
+        conn.execute("delete from chat_summaries where chat_id = ?", (id,))
+        conn.execute("delete from chat_chunk_counts where chat_id = ?", (id,))
+        conn.execute("delete from chunks_fts where chat_id = ?", (id,))
+        conn.execute(
+            "delete from ingestion_files where job_id in (select id from ingestion_jobs where chat_id = ?)", (id,)
+        )
+        conn.execute("delete from ingestion_jobs where chat_id = ?", (id,))
+        conn.execute("delete from chat_documents where chat_id = ?", (id,))
 
-    conn.commit()
-    conn.close()
+    def update(user_id, chats):
+        chats[:] = [chat for chat in chats if chat["id"] != id]
 
+    write_through_chats(versions, update)
 
-def get_chats(user_id: int):
-    conn = get_conn()
-    cursor = conn.cursor()
 
+def get_chats(user_id: int):
     query = """
     select id, user_id, name, last_interaction from chats
     where user_id = ?
     order by last_interaction DESC
     """
-    cursor.execute(query, (user_id,))
-    rows = cursor.fetchall()
+    with get_conn() as conn:
+        version = get_chats_version(conn)
+        with _chats_cache_lock:
+            cached = _chats_cache.get(user_id)
+            if cached is not None and cached["version"] == version:
+                return [dict(chat) for chat in cached["chats"]]  # copies so callers can't change the cache
 
-    conn.commit()
-    conn.close()
+        # in one read transaction with the version, so the list is never older than the version it's cached at
+        with conn:
+            conn.execute("BEGIN")
+            version = get_chats_version(conn)
+            rows = conn.execute(query, (user_id,)).fetchall()
 
     return_data = []
     for id, user_id, name, last_interaction in rows:
         return_data.append({"id": id, "user_id": user_id, "name": name, "last_interaction": last_interaction})
 
+    with _chats_cache_lock:
+        _chats_cache[user_id] = {"version": version, "chats": [dict(chat) for chat in return_data]}
+
     return return_data
 
 
 def get_chat_messages(chat_id: int):
-    conn = get_conn()
-    cursor = conn.cursor()
-
     query = """
-    select id, chat_id, content, role, files_info, statuses, sent_at from chat_messages
+    select id, chat_id, content, role, files_info, statuses, timings, sent_at from chat_messages
     where chat_id = ?
-    order by sent_at ASC
+    order by sent_at ASC, id ASC
     """
-    cursor.execute(query, (chat_id,))
-    rows = cursor.fetchall()
+    with get_conn() as conn:
+        rows = conn.execute(query, (chat_id,)).fetchall()
 
-    conn.commit()
-    conn.close()
+    return [message_row_to_dict(row) for row in rows]
 
-    return_data = []
-    for id, chat_id, content, role, files_info, statuses, sent_at in rows:
-        return_data.append(
-            {
-                "id": id,
-                "chat_id": chat_id,
-                "content": content,
-                "role": role,
-                "files_info": json.loads(files_info),
-                "statuses": json.loads(statuses),
-                "sent_at": sent_at,
-            }
-        )
 
-    return return_data
+def get_chat_messages_page(chat_id: int, limit: int, before=None):
+    # keyset pagination: the latest `limit` messages older than the (sent_at, id) cursor `before` (or the latest
+    # ones if None), oldest first, along with the cursor for the page before them (None if there is nothing older)
+    if before is None:
+        query = """
+        select id, chat_id, content, role, files_info, statuses, timings, sent_at from chat_messages
+        where chat_id = ?
+        order by sent_at DESC, id DESC
+        limit ?
+        """
+        params = (chat_id, limit + 1)
+    else:
+        query = """
+        select id, chat_id, content, role, files_info, statuses, timings, sent_at from chat_messages
+        where chat_id = ? and (sent_at, id) < (?, ?)
+        order by sent_at DESC, id DESC
+        limit ?
+        """
+        params = (chat_id, before[0], before[1], limit + 1)
+
+    with get_conn() as conn:
+        rows = conn.execute(query, params).fetchall()
+
+    has_older = len(rows) > limit
+    messages = [message_row_to_dict(row) for row in reversed(rows[:limit])]
+    cursor = (messages[0]["sent_at"], messages[0]["id"]) if has_older else None
+
+    return messages, cursor
+
+
+def get_chat_history(chat_id: int, after=None):
+    # only what the model needs, without decoding files_info and statuses of every message
+    # after is a (sent_at, id) cursor, messages up to and including it are skipped
+    query = """
+    select id, sent_at, role, content from chat_messages
+    where chat_id = ? and (sent_at, id) > (?, ?)
+    order by sent_at ASC, id ASC
+    """
+    after = after or (-1, -1)
+    with get_conn() as conn:
+        rows = conn.execute(query, (chat_id, after[0], after[1])).fetchall()
 
+    return [{"id": id, "sent_at": sent_at, "role": role, "content": content} for id, sent_at, role, content in rows]
 
-from typing import List, Literal
+
+def message_row_to_dict(row):
+    id, chat_id, content, role, files_info, statuses, timings, sent_at = row
+    return {
+        "id": id,
+        "chat_id": chat_id,
+        "content": content,
+        "role": role,
+        "files_info": json.loads(files_info),
+        "statuses": json.loads(statuses),
+        "timings": json.loads(timings) if timings else None,
+        "sent_at": sent_at,
+    }
+
+
+from typing import List, Literal, Optional
 import json
 
 
 def insert_chat_message(
-    chat_id: int, content: str, role: Literal["system", "ai", "human"], files_info: List[dict], statuses: List[dict]
+    chat_id: int,
+    content: str,
+    role: Literal["system", "ai", "human"],
+    files_info: List[dict],
+    statuses: List[dict],
+    timings: Optional[dict] = None,
 ):
-    conn = get_conn()
-    cursor = conn.cursor()
-
-    files_info_json = json.dumps(files_info)
     statuses_json = json.dumps(statuses)
+    timings_json = json.dumps(timings) if timings else None
 
     query = """
-    insert into chat_messages (chat_id, content, role, files_info, statuses) values (?, ?, ?, ?, ?)
+    insert into chat_messages (chat_id, content, role, files_info, statuses, timings) values (?, ?, ?, ?, ?, ?)
     """
-    cursor.execute(query, (chat_id, content, role, files_info_json, statuses_json))
+    with get_conn() as conn, conn:
+        # attachments refer to their blobs, the entries counted are marked blob_ref so that only those are released
+        # by delete_chat (files_info from before the blob store has sha256s too, but no blob)
+        counted_files_info = []
+        for file_info in files_info:
+            file_info = {key: value for key, value in file_info.items() if key != "blob_ref"}
+            if file_info.get("sha256") and conn.execute(
+                "update blobs set ref_count = ref_count + 1 where hash = ?", (file_info["sha256"],)
+            ).rowcount:
+                file_info["blob_ref"] = True
+            counted_files_info.append(file_info)
 
-    conn.commit()
-    conn.close()
+        conn.execute(query, (chat_id, content, role, json.dumps(counted_files_info), statuses_json, timings_json))
 
 
 def update_last_interaction(chat_id: int, new_time: int):
-    conn = get_conn()
-    cursor = conn.cursor()
-
     query = """
     update chats set last_interaction = ? where id = ?
     """
-    cursor.execute(query, (new_time, chat_id))
+    with get_conn() as conn, conn:
+        conn.execute("BEGIN IMMEDIATE")
+        version = get_chats_version(conn)
+        conn.execute(query, (new_time, chat_id))
+        versions = (version, get_chats_version(conn))
 
-    conn.commit()
-    conn.close()
+    def update(user_id, chats):
+        for chat in chats:
+            if chat["id"] == chat_id:
+                chat["last_interaction"] = new_time
+                chats.sort(key=lambda c: c["last_interaction"], reverse=True)
+                break
 
+    write_through_chats(versions, update)
 
-def update_user_preferences(id, chat_model, embedding_model, temperature, style):
-    conn = get_conn()
-    cursor = conn.cursor()
 
-    query = f"""
+def update_user_preferences(id, chat_model, embedding_model, temperature, style):
+    query = """
     update users set chat_model = ?, embedding_model = ?, temperature = ?, style = ? where id = ?
     """
-    cursor.execute(query, (chat_model, embedding_model, temperature, style, id))
-
-    conn.commit()
-    conn.close()
-
+    with get_conn() as conn, conn:
+        conn.execute(query, (chat_model, embedding_model, temperature, style, id))
 
 
 def get_user_info(user_id: int):
-    conn = get_conn()
-    cursor = conn.cursor()
-
     query = """
     select name, temperature, embedding_model, chat_model, style from users
     where id = ?
     """
-    cursor.execute(query, (user_id,))
-    name, temperature, embedding_model, chat_model, style = cursor.fetchone()
-
-    conn.commit()
-    conn.close()
+    with get_conn() as conn:
+        name, temperature, embedding_model, chat_model, style = conn.execute(query, (user_id,)).fetchone()
 
     return {
         "name": name,
@@ -213,3 +619,479 @@ def get_user_info(user_id: int):
         "chat_model": chat_model,
         "style": style,
     }
+
+
+# ----------------- DOCUMENT CACHE (content addressed by sha256) -----------------
+
+
+def get_document_chunks(hash: str):
+    query = """
+    select content, metadata from document_chunks
+    where hash = ?
+    order by position ASC
+    """
+    with get_conn() as conn:
+        row = conn.execute("select chunk_count from documents where hash = ?", (hash,)).fetchone()
+        if row is None:
+            return None
+
+        rows = conn.execute(query, (hash,)).fetchall()
+
+    if len(rows) != row[0]:
+        return None  # partially saved, treat as not cached
+
+    return [{"content": content, "metadata": json.loads(metadata)} for content, metadata in rows]
+
+
+def add_document_chunks(hash: str, start: int, chunks: List[dict]):
+    # chunks are added batch by batch while ingesting, the document is only cached once complete_document is called
+    query = """
+    insert or replace into document_chunks (hash, position, content, metadata) values (?, ?, ?, ?)
+    """
+    with get_conn() as conn, conn:
+        conn.executemany(
+            query,
+            [(hash, start + i, chunk["content"], json.dumps(chunk["metadata"])) for i, chunk in enumerate(chunks)],
+        )
+
+
+def complete_document(hash: str, ext: str, chunk_count: int):
+    with get_conn() as conn, conn:
+        # leftovers of an earlier interrupted ingest
+        conn.execute("delete from document_chunks where hash = ? and position >= ?", (hash, chunk_count))
+        conn.execute("delete from chunk_embeddings where hash = ? and position >= ?", (hash, chunk_count))
+        conn.execute(
+            "insert or replace into documents (hash, ext, chunk_count) values (?, ?, ?)",
+            (hash, ext, chunk_count),
+        )
+
+
+def get_chunk_embeddings(hash: str, embedding_model: str):
+    query = """
+    select documents.chunk_count, chunk_embeddings.embedding from documents
+    join chunk_embeddings on chunk_embeddings.hash = documents.hash
+    where documents.hash = ? and chunk_embeddings.embedding_model = ?
+    order by chunk_embeddings.position ASC
+    """
+    with get_conn() as conn:
+        rows = conn.execute(query, (hash, embedding_model)).fetchall()
+
+    if not rows or len(rows) != rows[0][0]:
+        return None
+
+    return [array("f", embedding).tolist() for _, embedding in rows]
+
+
+def get_saved_chunk_embeddings(hash: str, embedding_model: str):
+    # position -> embedding of whatever has been saved so far, for resuming a file embedded part way
+    query = """
+    select position, embedding from chunk_embeddings where hash = ? and embedding_model = ?
+    """
+    with get_conn() as conn:
+        rows = conn.execute(query, (hash, embedding_model)).fetchall()
+
+    return {position: array("f", embedding).tolist() for position, embedding in rows}
+
+
+def save_chunk_embeddings(hash: str, embedding_model: str, embeddings: List[List[float]], start: int = 0):
+    query = """
+    insert or replace into chunk_embeddings (hash, position, embedding_model, embedding) values (?, ?, ?, ?)
+    """
+    with get_conn() as conn, conn:
+        conn.executemany(
+            query,
+            [
+                (hash, start + i, embedding_model, array("f", embedding).tobytes())
+                for i, embedding in enumerate(embeddings)
+            ],
+        )
+
+
+# ----------------- CHAT SUMMARIES -----------------
+
+
+def get_chat_summary(chat_id: int):
+    query = """
+    select summary, until_sent_at, until_id from chat_summaries where chat_id = ?
+    """
+    with get_conn() as conn:
+        row = conn.execute(query, (chat_id,)).fetchone()
+
+    if row is None:
+        return None
+
+    summary, until_sent_at, until_id = row
+    return {"summary": summary, "until": (until_sent_at, until_id)}
+
+
+def save_chat_summary(chat_id: int, summary: str, until):
+    query = """
+    insert or replace into chat_summaries (chat_id, summary, until_sent_at, until_id, updated_at)
+    values (?, ?, ?, ?, unixepoch())
+    """
+    with get_conn() as conn, conn:
+        conn.execute(query, (chat_id, summary, until[0], until[1]))
+
+
+# ----------------- CHUNK COUNTS -----------------
+
+
+def get_chunk_count(user_id: int, chat_id: int, embedding_model: str):
+    # None if never counted (chats from before counting was added)
+    query = """
+    select count from chat_chunk_counts where user_id = ? and chat_id = ? and embedding_model = ?
+    """
+    with get_conn() as conn:
+        row = conn.execute(query, (user_id, chat_id, embedding_model)).fetchone()
+
+    return row[0] if row else None
+
+
+def add_chunk_count(user_id: int, chat_id: int, embedding_model: str, count: int):
+    query = """
+    insert into chat_chunk_counts (user_id, chat_id, embedding_model, count) values (?, ?, ?, ?)
+    on conflict (user_id, chat_id, embedding_model) do update set count = count + excluded.count
+    """
+    with get_conn() as conn, conn:
+        conn.execute(query, (user_id, chat_id, embedding_model, count))
+
+
+# ----------------- FULL TEXT SEARCH -----------------
+
+
+def add_chunks_fts(chunks: List[dict]):
+    # chunks: [{chunk_id, user_id, chat_id, embedding_model, content, metadata}]
+    query = """
+    insert into chunks_fts (chunk_id, user_id, chat_id, embedding_model, content, metadata) values (?, ?, ?, ?, ?, ?)
+    """
+    with get_conn() as conn, conn:
+        conn.executemany(
+            query,
+            [
+                (
+                    chunk["chunk_id"],
+                    chunk["user_id"],
+                    chunk["chat_id"],
+                    chunk["embedding_model"],
+                    chunk["content"],
+                    json.dumps(chunk["metadata"]),
+                )
+                for chunk in chunks
+            ],
+        )
+
+
+def get_fts_chunk_ids(embedding_model: str, user_id: Optional[int] = None, chat_id: Optional[int] = None):
+    # ids of the chunks of embedding_model in the full text index, of the user's / chat's only if given
+    query = "select chunk_id from chunks_fts where embedding_model = ?"
+    params = [embedding_model]
+    if user_id is not None:
+        query += " and user_id = ?"
+        params.append(user_id)
+    if chat_id is not None:
+        query += " and chat_id = ?"
+        params.append(chat_id)
+
+    with get_conn() as conn:
+        rows = conn.execute(query, params).fetchall()
+
+    return {chunk_id for (chunk_id,) in rows}
+
+
+def search_chunks_fts(match: str, user_id: int, chat_id: int, embedding_model: str, k: int):
+    # match is an fts5 query, results are best first (bm25 is lower for better matches)
+    query = """
+    select chunk_id, content, metadata, bm25(chunks_fts) as score from chunks_fts
+    where chunks_fts match ? and user_id = ? and chat_id = ? and embedding_model = ?
+    order by score
+    limit ?
+    """
+    with get_conn() as conn:
+        rows = conn.execute(query, (match, user_id, chat_id, embedding_model, k)).fetchall()
+
+    return [
+        {"chunk_id": chunk_id, "content": content, "metadata": json.loads(metadata), "score": score}
+        for chunk_id, content, metadata, score in rows
+    ]
+
+
+def get_file_chunk_ids(user_id: int, chat_id: int, embedding_model: str, file_hash: str):
+    # ids of the chunks of a file indexed into the chat with embedding_model (every chunk added to a vector store
+    # is in the full text index with its metadata)
+    query = """
+    select chunk_id from chunks_fts
+    where user_id = ? and chat_id = ? and embedding_model = ? and json_extract(metadata, '$.file_hash') = ?
+    """
+    with get_conn() as conn:
+        rows = conn.execute(query, (user_id, chat_id, embedding_model, file_hash)).fetchall()
+
+    return [chunk_id for (chunk_id,) in rows]
+
+
+def delete_file_chunks_fts(user_id: int, chat_id: int, embedding_model: str, file_hash: str):
+    # the file's chunks are no longer in the chat's store (see get_file_chunk_ids), also taken off its chunk count
+    query = """
+    delete from chunks_fts
+    where user_id = ? and chat_id = ? and embedding_model = ? and json_extract(metadata, '$.file_hash') = ?
+    """
+    with get_conn() as conn, conn:
+        deleted = conn.execute(query, (user_id, chat_id, embedding_model, file_hash)).rowcount
+        conn.execute(
+            """
+            update chat_chunk_counts set count = max(0, count - ?)
+            where user_id = ? and chat_id = ? and embedding_model = ?
+            """,
+            (deleted, user_id, chat_id, embedding_model),
+        )
+
+
+# ----------------- INGESTION QUEUE -----------------
+
+
+def create_ingestion_job(
+    user_id: int,
+    chat_id: int,
+    embedding_model: str,
+    files_info: List[dict],
+    kind: Literal["upload", "reembed"] = "upload",
+) -> int:
+    with get_conn() as conn, conn:
+        (job_id,) = conn.execute(
+            "insert into ingestion_jobs (user_id, chat_id, embedding_model, kind) values (?, ?, ?, ?) returning id",
+            (user_id, chat_id, embedding_model, kind),
+        ).fetchone()
+        conn.executemany(
+            "insert into ingestion_files (job_id, position, file_info) values (?, ?, ?)",
+            [(job_id, position, json.dumps(file_info)) for position, file_info in enumerate(files_info)],
+        )
+
+    return job_id
+
+
+def claim_ingestion_job(owner: str, lease_seconds: int):
+    # the oldest queued job, or running one whose owner stopped renewing its lease (uploads before re-embedding),
+    # leased to owner in the same statement so that two workers (of any process) never get the same one
+    query = """
+    update ingestion_jobs set state = 'running', started_at = coalesce(started_at, unixepoch()), owner = ?,
+    lease_expires_at = unixepoch() + ?
+    where id = (
+        select id from ingestion_jobs
+        where state = 'queued' or (state = 'running' and coalesce(lease_expires_at, 0) < unixepoch())
+        order by kind = 'reembed', id
+        limit 1
+    )
+    returning id, user_id, chat_id, embedding_model, kind
+    """
+    with get_conn() as conn, conn:
+        row = conn.execute(query, (owner, lease_seconds)).fetchone()
+
+    if row is None:
+        return None
+
+    id, user_id, chat_id, embedding_model, kind = row
+    return {"id": id, "user_id": user_id, "chat_id": chat_id, "embedding_model": embedding_model, "kind": kind}
+
+
+def finish_ingestion_job(id: int, owner: str, state: Literal["done", "error"], error: Optional[str] = None):
+    # only while owner still holds the job's lease
+    query = """
+    update ingestion_jobs set state = ?, error = ?, finished_at = unixepoch(), lease_expires_at = null
+    where id = ? and owner = ? and state = 'running'
+    """
+    with get_conn() as conn, conn:
+        conn.execute(query, (state, error, id, owner))
+
+
+def renew_ingestion_leases(owner: str, job_ids: List[int], lease_seconds: int):
+    placeholders = ", ".join("?" * len(job_ids))
+    query = f"""
+    update ingestion_jobs set lease_expires_at = unixepoch() + ?
+    where owner = ? and state = 'running' and id in ({placeholders})
+    """
+    with get_conn() as conn, conn:
+        conn.execute(query, (lease_seconds, owner, *job_ids))
+
+
+def holds_ingestion_lease(job_id: int, owner: str):
+    query = """
+    select 1 from ingestion_jobs where id = ? and owner = ? and state = 'running'
+    """
+    with get_conn() as conn:
+        return conn.execute(query, (job_id, owner)).fetchone() is not None
+
+
+def update_ingestion_file(
+    job_id: int, position: int, state: str, docs_read=None, chunks_added=None, chunks_per_second=None, error=None
+):
+    query = """
+    update ingestion_files set state = ?, docs_read = coalesce(?, docs_read), chunks_added = coalesce(?, chunks_added),
+    chunks_per_second = coalesce(?, chunks_per_second), error = ? where job_id = ? and position = ?
+    """
+    with get_conn() as conn, conn:
+        conn.execute(query, (state, docs_read, chunks_added, chunks_per_second, error, job_id, position))
+
+
+def ingestion_file_from_row(row):
+    position, file_info, state, docs_read, chunks_added, chunks_per_second, error = row
+    return {
+        "position": position,
+        "file_info": json.loads(file_info),
+        "state": state,
+        "docs_read": docs_read,
+        "chunks_added": chunks_added,
+        "chunks_per_second": chunks_per_second,
+        "error": error,
+    }
+
+
+def get_ingestion_files(job_id: int):
+    query = """
+    select position, file_info, state, docs_read, chunks_added, chunks_per_second, error from ingestion_files
+    where job_id = ?
+    order by position ASC
+    """
+    with get_conn() as conn:
+        rows = conn.execute(query, (job_id,)).fetchall()
+
+    return [ingestion_file_from_row(row) for row in rows]
+
+
+def get_ingestion_jobs(chat_id: int, unfinished_only: bool = False):
+    # the chat's jobs with their files, oldest first, for polling progress
+    query = """
+    select id, user_id, chat_id, embedding_model, kind, state, error, created_at, started_at, finished_at
+    from ingestion_jobs
+    where chat_id = ?
+    """
+    if unfinished_only:
+        query += " and state in ('queued', 'running')"
+    query += " order by id ASC"
+
+    # the files of all of them at once rather than a query per job
+    files_query = f"""
+    select job_id, position, file_info, state, docs_read, chunks_added, chunks_per_second, error from ingestion_files
+    where job_id in (select id from ({query}))
+    order by job_id ASC, position ASC
+    """
+
+    with get_conn() as conn:
+        # in one read transaction, so the files are those of the jobs read
+        with conn:
+            conn.execute("BEGIN")
+            rows = conn.execute(query, (chat_id,)).fetchall()
+            file_rows = conn.execute(files_query, (chat_id,)).fetchall()
+
+    files_by_job = {}
+    for job_id, *file_row in file_rows:
+        files_by_job.setdefault(job_id, []).append(ingestion_file_from_row(file_row))
+
+    jobs = []
+    for id, user_id, chat_id, embedding_model, kind, state, error, created_at, started_at, finished_at in rows:
+        jobs.append(
+            {
+                "id": id,
+                "user_id": user_id,
+                "chat_id": chat_id,
+                "embedding_model": embedding_model,
+                "kind": kind,
+                "state": state,
+                "error": error,
+                "created_at": created_at,
+                "started_at": started_at,
+                "finished_at": finished_at,
+                "files": files_by_job.get(id, []),
+            }
+        )
+
+    return jobs
+
+
+# ----------------- CHAT DOCUMENTS -----------------
+
+
+def add_chat_documents(user_id: int, chat_id: int, embedding_model: str, files_info: List[dict]):
+    query = """
+    insert or ignore into chat_documents (user_id, chat_id, hash, embedding_model, file_info) values (?, ?, ?, ?, ?)
+    """
+    with get_conn() as conn, conn:
+        conn.executemany(
+            query,
+            [
+                (user_id, chat_id, file_info["sha256"], embedding_model, json.dumps(file_info))
+                for file_info in files_info
+            ],
+        )
+
+
+def get_missing_chat_documents(chat_id: int, embedding_model: str):
+    # files_info (with their number of chunks) of the chat's documents not in embedding_model's store yet
+    query = """
+    select chat_documents.file_info, documents.chunk_count from chat_documents
+    join documents on documents.hash = chat_documents.hash
+    where chat_documents.chat_id = ? and chat_documents.hash not in (
+        select hash from chat_documents where chat_id = ? and embedding_model = ?
+    )
+    group by chat_documents.hash
+    order by min(chat_documents.added_at) ASC
+    """
+    with get_conn() as conn:
+        rows = conn.execute(query, (chat_id, chat_id, embedding_model)).fetchall()
+
+    return [{**json.loads(file_info), "chunk_count": chunk_count} for file_info, chunk_count in rows]
+
+
+def get_chat_document_models(chat_id: int):
+    # embedding models the chat's documents are in, the one with most of them (then the latest) first
+    query = """
+    select embedding_model, count(*) as documents from chat_documents
+    where chat_id = ?
+    group by embedding_model
+    order by documents DESC, max(added_at) DESC
+    """
+    with get_conn() as conn:
+        rows = conn.execute(query, (chat_id,)).fetchall()
+
+    return [{"embedding_model": embedding_model, "documents": documents} for embedding_model, documents in rows]
+
+
+def get_legacy_attachments(chat_id: int, embedding_model: str):
+    # filenames of the chat's attachments from before documents were cached by sha256, which can't be re-embedded,
+    # if the chat has chunks in the store of another embedding model than embedding_model (theirs may be in it)
+    query = """
+    select json_extract(file.value, '$.filename') from chat_messages
+    join json_each(chat_messages.files_info) as file
+    where chat_messages.chat_id = ? and json_extract(file.value, '$.sha256') is null
+    and exists (
+        select 1 from chat_chunk_counts
+        where chat_chunk_counts.chat_id = ? and chat_chunk_counts.embedding_model != ? and chat_chunk_counts.count > 0
+    )
+    order by chat_messages.sent_at ASC, chat_messages.id ASC
+    """
+    with get_conn() as conn:
+        rows = conn.execute(query, (chat_id, chat_id, embedding_model)).fetchall()
+
+    return [filename for (filename,) in rows]
+
+
+# ----------------- BLOBS -----------------
+
+
+def add_blob(hash: str, size: int):
+    # a blob uploaded (again), refs are added with the message its files_info is saved in
+    query = """
+    insert into blobs (hash, size) values (?, ?)
+    on conflict (hash) do update set uploaded_at = unixepoch()
+    """
+    with get_conn() as conn, conn:
+        conn.execute(query, (hash, size))
+
+
+def delete_unreferenced_blobs(uploaded_before: int):
+    # returns the hashes of the blobs deleted, their files are removed by the caller
+    query = """
+    delete from blobs where ref_count <= 0 and uploaded_at < ? returning hash
+    """
+    with get_conn() as conn, conn:
+        rows = conn.execute(query, (uploaded_before,)).fetchall()
+
+    return [hash for (hash,) in rows]
@@ -0,0 +1,156 @@
+import hashlib
+import sqlite3
+import threading
+import time
+from array import array
+from typing import List
+
+from langchain_core.embeddings import Embeddings
+
+
+# ----------------- ON DISK EMBEDDING CACHE -----------------
+# sits in front of any langchain Embeddings (OllamaEmbeddings here) so the same text is never embedded twice
+# under the same model. vectors are stored as float32 blobs keyed by (model, sha256 of text) and the least
+# recently used ones are evicted once max_entries is crossed.
+
+EMBEDDING_CACHE_PATH = "embedding_cache.db"
+
+
+class CachedEmbeddings(Embeddings):
+    def __init__(self, embeddings: Embeddings, model: str, path=EMBEDDING_CACHE_PATH, max_entries=200_000):
+        self.embeddings = embeddings
+        self.model = model
+        self.path = path
+        self.max_entries = max_entries
+
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript(
+            """
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = NORMAL;
+
+            create table if not exists embeddings (
+                model TEXT NOT NULL,
+                text_hash TEXT NOT NULL,
+                embedding BLOB NOT NULL,
+                last_used INTEGER NOT NULL,
+                PRIMARY KEY (model, text_hash)
+            ) without rowid;
+
+            create index if not exists embeddings_last_used on embeddings (last_used);
+            """
+        )
+        self._entries = self._conn.execute("select count(*) from embeddings").fetchone()[0]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        text_hashes = [hash_text(text) for text in texts]
+        found = self._get(text_hashes)
+
+        missing = {}  # text_hash -> text, also dedups repeated texts within the same call
+        for text, text_hash in zip(texts, text_hashes):
+            if text_hash not in found:
+                missing[text_hash] = text
+
+        with self._lock:
+            hits = sum(1 for text_hash in text_hashes if text_hash in found)
+            self.hits += hits
+            self.misses += len(texts) - hits
+
+        if missing:
+            new_embeddings = self.embeddings.embed_documents(list(missing.values()))
+            new_found = dict(zip(missing.keys(), new_embeddings))
+            self._put(new_found)
+            found.update(new_found)
+
+        return [found[text_hash] for text_hash in text_hashes]
+
+    def embed_query(self, text: str) -> List[float]:
+        # OllamaEmbeddings embeds queries and documents the same way, so both share one cache
+        text_hash = hash_text(text)
+        found = self._get([text_hash])
+
+        if text_hash in found:
+            with self._lock:
+                self.hits += 1
+            return found[text_hash]
+
+        with self._lock:
+            self.misses += 1
+
+        embedding = self.embeddings.embed_query(text)
+        self._put({text_hash: embedding})
+        return embedding
+
+    def stats(self):
+        # since the process started (entries excepted), served by the metrics server (see metrics.py)
+        with self._lock:
+            hits, misses, entries = self.hits, self.misses, self._entries
+        total = hits + misses
+        return {
+            "model": self.model,
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / total if total else 0.0,
+            "entries": entries,
+        }
+
+    def _get(self, text_hashes: List[str]):
+        found = {}
+        unique_hashes = list(dict.fromkeys(text_hashes))
+
+        with self._lock:
+            # sqlite has a limit on the number of bound parameters so looking up in slices
+            for i in range(0, len(unique_hashes), 500):
+                batch = unique_hashes[i : i + 500]
+                placeholders = ", ".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"select text_hash, embedding from embeddings where model = ? and text_hash in ({placeholders})",
+                    (self.model, *batch),
+                ).fetchall()
+                for text_hash, embedding in rows:
+                    found[text_hash] = array("f", embedding).tolist()
+
+            if found:
+                now = time.time_ns()
+                self._conn.executemany(
+                    "update embeddings set last_used = ? where model = ? and text_hash = ?",
+                    [(now, self.model, text_hash) for text_hash in found],
+                )
+                self._conn.commit()
+
+        return found
+
+    def _put(self, embeddings: dict):
+        now = time.time_ns()
+        with self._lock:
+            cursor = self._conn.executemany(
+                "insert or ignore into embeddings (model, text_hash, embedding, last_used) values (?, ?, ?, ?)",
+                [
+                    (self.model, text_hash, array("f", embedding).tobytes(), now)
+                    for text_hash, embedding in embeddings.items()
+                ],
+            )
+            self._entries += cursor.rowcount
+
+            if self._entries > self.max_entries:
+                # evicting a bit more than needed so that eviction doesn't run on every single insert
+                to_evict = self._entries - int(self.max_entries * 0.9)
+                cursor = self._conn.execute(
+                    """
+                    delete from embeddings where (model, text_hash) in (
+                        select model, text_hash from embeddings order by last_used ASC limit ?
+                    )
+                    """,
+                    (to_evict,),
+                )
+                self._entries -= cursor.rowcount
+
+            self._conn.commit()
+
+
+def hash_text(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
@@ -0,0 +1,70 @@
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+from ollama import ResponseError
+
+
+# ----------------- CONCURRENT BATCHED EMBEDDING -----------------
+# keeps up to max_in_flight embedding requests running against ollama at once. batches are pulled from the
+# given iterable only when there is room, so a fast producer (parsing, splitting) waits for the embedder
+# instead of piling batches up in memory.
+
+
+class EmbeddingExecutor:
+    def __init__(self, embeddings, max_in_flight=4, retries=3, retry_delay=1.0):
+        self.embeddings = embeddings
+        self.max_in_flight = max_in_flight
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+        self.chunks_embedded = 0
+        self.started_at = None
+
+    def map(self, batches):
+        # yields (batch, embeddings) in the same order as batches, each batch being a list of Documents
+        self.started_at = time.time()
+
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as executor:
+            pending = deque()
+            for batch in batches:
+                pending.append((batch, executor.submit(self.embed, [chunk.page_content for chunk in batch])))
+                if len(pending) >= self.max_in_flight:
+                    yield self._collect(pending.popleft())
+
+            while pending:
+                yield self._collect(pending.popleft())
+
+    def embed(self, texts):
+        attempt = 0
+        while True:
+            try:
+                return self.embeddings.embed_documents(texts)
+            except Exception as e:
+                attempt += 1
+                if attempt > self.retries or not is_transient(e):
+                    raise
+                time.sleep(self.retry_delay * 2 ** (attempt - 1))
+
+    def throughput(self):
+        # chunks per second since map was called
+        if not self.started_at:
+            return 0.0
+        elapsed = time.time() - self.started_at
+        return self.chunks_embedded / elapsed if elapsed > 0 else 0.0
+
+    def _collect(self, item):
+        batch, future = item
+        embeddings = future.result()
+        self.chunks_embedded += len(batch)
+        return batch, embeddings
+
+
+def is_transient(e: Exception):
+    # network hiccups, timeouts and ollama being overloaded or restarting are worth retrying
+    if isinstance(e, (ConnectionError, TimeoutError, httpx.TransportError)):
+        return True
+    if isinstance(e, ResponseError):
+        return e.status_code == 429 or e.status_code >= 500
+    return False
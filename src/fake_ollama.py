@@ -0,0 +1,186 @@
+import hashlib
+import json
+import re
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+# ----------------- FAKE OLLAMA SERVER (for benchmarks) -----------------
+# answers the few endpoints the app uses (/api/tags, /api/embed, /api/chat, /api/generate) so that the whole
+# pipeline can run without ollama or any model. embeddings are deterministic hashed bags of words (texts sharing
+# words are similar, so retrieval behaves sensibly) and chat responses are streamed at a fixed token rate.
+
+EMBEDDING_DIMENSIONS = 384
+RESPONSE_WORDS = (
+    "the document describes how the system stores chunks and retrieves the most relevant passages for a query "
+    "before the model writes an answer that cites its sources"
+).split()
+
+
+def fake_embedding(text: str, dimensions: int = EMBEDDING_DIMENSIONS):
+    vector = np.zeros(dimensions, dtype=np.float32)
+    for word in re.findall(r"\w+", text.lower()):
+        digest = hashlib.md5(word.encode()).digest()
+        vector[int.from_bytes(digest[:4], "little") % dimensions] += 1.0 if digest[4] & 1 else -1.0
+    if not vector.any():
+        vector[0] = 1.0
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+class FakeOllama:
+    def __init__(
+        self,
+        models=("fake-chat", "fake-embedding"),
+        tokens_per_second: float = 50.0,
+        first_token_delay: float = 0.2,
+        response_tokens: int = 60,
+        embed_delay: float = 0.0,
+        host: str = "127.0.0.1",
+        port: int = 0,
+    ):
+        self.models = list(models)
+        self.tokens_per_second = tokens_per_second
+        self.first_token_delay = first_token_delay
+        self.response_tokens = response_tokens
+        self.embed_delay = embed_delay  # seconds per embed request, on top of computing the vectors
+
+        self.requests = {}  # path -> count
+        self._requests_lock = threading.Lock()
+
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                fake.count(self.path)
+                if self.path == "/api/tags":
+                    self.send_json({"models": [fake.model_info(model) for model in fake.models]})
+                elif self.path == "/api/ps":
+                    self.send_json({"models": []})
+                elif self.path == "/api/version":
+                    self.send_json({"version": "0.0.0-fake"})
+                else:
+                    self.send_json({"error": "not found"}, status=404)
+
+            def do_POST(self):
+                fake.count(self.path)
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+                if self.path == "/api/embed":
+                    self.send_json(fake.embed(body))
+                elif self.path == "/api/generate":
+                    self.send_json({"model": body.get("model"), "created_at": now(), "response": "", "done": True})
+                elif self.path == "/api/chat":
+                    if body.get("stream", True):
+                        self.send_stream(fake.chat_stream(body))
+                    else:
+                        self.send_json(fake.chat(body))
+                else:
+                    self.send_json({"error": "not found"}, status=404)
+
+            def send_json(self, data, status=200):
+                payload = json.dumps(data).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def send_stream(self, lines):
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-ndjson")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                for line in lines:
+                    payload = (json.dumps(line) + "\n").encode()
+                    self.wfile.write(f"{len(payload):X}\r\n".encode() + payload + b"\r\n")
+                    self.wfile.flush()
+                self.wfile.write(b"0\r\n\r\n")
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self._thread = threading.Thread(target=self.server.serve_forever, name="fake-ollama", daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def count(self, path: str):
+        with self._requests_lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+
+    def model_info(self, model: str):
+        return {
+            "name": model,
+            "model": model,
+            "modified_at": now(),
+            "size": 0,
+            "digest": hashlib.sha256(model.encode()).hexdigest(),
+            "details": {},
+        }
+
+    def embed(self, body):
+        texts = body.get("input", "")
+        texts = [texts] if isinstance(texts, str) else texts
+        if self.embed_delay:
+            time.sleep(self.embed_delay)
+        return {"model": body.get("model"), "embeddings": [fake_embedding(text) for text in texts]}
+
+    def response_text(self):
+        return [RESPONSE_WORDS[i % len(RESPONSE_WORDS)] + " " for i in range(self.response_tokens)]
+
+    def chat(self, body):
+        time.sleep(self.first_token_delay + self.response_tokens / self.tokens_per_second)
+        return {
+            "model": body.get("model"),
+            "created_at": now(),
+            "message": {"role": "assistant", "content": "".join(self.response_text())},
+            "done": True,
+            "done_reason": "stop",
+            "eval_count": self.response_tokens,
+        }
+
+    def chat_stream(self, body):
+        time.sleep(self.first_token_delay)
+        for token in self.response_text():
+            yield {
+                "model": body.get("model"),
+                "created_at": now(),
+                "message": {"role": "assistant", "content": token},
+                "done": False,
+            }
+            time.sleep(1 / self.tokens_per_second)
+
+        yield {
+            "model": body.get("model"),
+            "created_at": now(),
+            "message": {"role": "assistant", "content": ""},
+            "done": True,
+            "done_reason": "stop",
+            "eval_count": self.response_tokens,
+        }
+
+
+def now():
+    return datetime.now(timezone.utc).isoformat()
@@ -1,13 +1,26 @@
 from langchain_community.document_loaders import TextLoader, UnstructuredWordDocumentLoader, PyPDFLoader, CSVLoader
-import tempfile
-from pathlib import Path
 from langchain_text_splitters import MarkdownHeaderTextSplitter
-from langchain_chroma import Chroma
 import streamlit as st
-from ddgs import DDGS
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from datetime import datetime
 from langchain_core.documents import Document
+from langchain_core.document_loaders import BaseLoader
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+from collections import deque
+from pypdf import PdfReader
+import os
+from uuid import uuid4
+import hashlib
+import db
+from blob_store import write_blob
+from embedding_executor import EmbeddingExecutor
+from retrieval import hybrid_search, merge_results, FETCH_K
+from vector_stores import VectorPartition, get_ephemeral_partition
+from web_search import search_web
+from metrics import Timings
+from typing import Optional
+import time
 
 mime_types = {
     "pdf": "application/pdf",
@@ -18,177 +31,516 @@ mime_types = {
 }
 
 
-def alter_metadata(doc, filename, user_id, chat_id):
+def alter_metadata(doc, filename, user_id, chat_id, file_hash=None):
     doc.metadata["source"] = filename  # to replace the actual temp file path with the name as was provided
     doc.metadata["user_id"] = user_id
     doc.metadata["chat_id"] = chat_id
+    if file_hash:
+        doc.metadata["file_hash"] = file_hash  # to remember chunks of this file for later uploads of the same bytes
 
 
 def save_files(files):
-    # making sure files/ exists
-    dir = "uploaded_files"
-    Path(dir).mkdir(parents=True, exist_ok=True)
-    # parents=True to ensure all parent folders are also created and exist_ok means dont throw error if exists
-
+    # each file goes to the blob store (stored once per content, streamed in chunks), see blob_store.py
     files_info = []
     for file in files:
-        ext = file.name.split(".")[-1].lower()
+        hash, path, size = write_blob(file)
+        files_info.append(make_file_info(file.name, hash, path, size))
 
-        with tempfile.NamedTemporaryFile(delete=False, dir=dir) as tf:
-            tf.write(file.getbuffer())
+    return files_info
 
-        files_info.append(
-            {
-                "filename": file.name,
-                "file_size": file.size,
-                "mime_type": mime_types.get(ext, "UNKNOWN"),
-                "file_path": tf.name,
-                "ext": ext,
-            }
-        )
 
-    return files_info
+def unique_files(files_info):
+    # the same file attached more than once (same sha256) is only parsed and indexed once
+    seen = set()
+    unique_files_info = []
+    for file_info in files_info:
+        key = file_info.get("sha256") or file_info["file_path"]
+        if key not in seen:
+            seen.add(key)
+            unique_files_info.append(file_info)
+
+    return unique_files_info
+
+
+def make_file_info(filename: str, hash: str, path: str, size: int):
+    ext = filename.split(".")[-1].lower()
+    return {
+        "filename": filename,
+        "file_size": size,
+        "mime_type": mime_types.get(ext, "UNKNOWN"),
+        "file_path": path,
+        "ext": ext,
+        "sha256": hash,
+    }
+
+
+# number of processes used to parse attachments, 1 parses everything in the script thread
+PARSE_WORKERS = os.cpu_count() or 1
+# pdfs with more pages than this are parsed as page ranges of this size in different processes
+PDF_PAGES_PER_TASK = 20
+# parsing processes are started from a clean server process (or spawned where there's no forkserver) instead of
+# forked from the app, which by then runs ingestion threads, chroma and ollama clients that don't survive a fork
+PARSE_MP_CONTEXT = multiprocessing.get_context(
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+)
+
 
+def read_files_and_extract_chunks(files_info, user_id: int, chat_id: int, workers: int = PARSE_WORKERS):
+    return list(iter_file_chunks(files_info, user_id, chat_id, workers))
 
-def read_files_and_extract_chunks(files_info, user_id: int, chat_id: int):
-    all_chunks = []
 
+def iter_file_chunks(files_info, user_id: int, chat_id: int, workers: int = PARSE_WORKERS):
+    # yields docs file by file (or page range by page range) so that the whole upload is never held in memory
+    tasks = []  # (file_info, pages) where pages is None for the whole file
     for file_info in files_info:
-        ext = file_info["ext"]
-        file_path = file_info["file_path"]
-        filename = file_info["filename"]
-
-        if ext == "pdf":
-            loader = PyPDFLoader(file_path)
-        elif ext == "txt":
-            loader = TextLoader(file_path)
-        elif ext == "md":
-            loader = None  # handling here especially
-            with open(file_path, "r", encoding="utf-8") as f:
-                content = f.read()
-
-            splitter = MarkdownHeaderTextSplitter(
-                headers_to_split_on=[("#", "Header 1"), ("##", "Header 2"), ("###", "Header 3")]
-            )
+        if file_info["ext"] == "pdf" and workers > 1:
+            total_pages = len(PdfReader(file_info["file_path"]).pages)
+            if total_pages > PDF_PAGES_PER_TASK:
+                for start in range(0, total_pages, PDF_PAGES_PER_TASK):
+                    tasks.append((file_info, range(start, min(start + PDF_PAGES_PER_TASK, total_pages))))
+                continue
+
+        tasks.append((file_info, None))
+
+    if workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(tasks)), mp_context=PARSE_MP_CONTEXT) as executor:
+            # only a few tasks are submitted ahead of the consumer so finished results don't pile up in memory,
+            # and results are yielded in the order of tasks so chunks stay in the same order as a sequential read
+            pending = deque()
+            for file_info, pages in tasks:
+                pending.append(executor.submit(load_file, file_info, pages, user_id, chat_id))
+                if len(pending) >= workers * 2:
+                    yield from pending.popleft().result()
+
+            while pending:
+                yield from pending.popleft().result()
+    else:
+        for file_info, pages in tasks:
+            yield from lazy_load_file(file_info, pages, user_id, chat_id)
+
+
+def load_file(file_info, pages, user_id: int, chat_id: int):
+    # kept at module level so that it can be pickled and run in a worker process
+    return list(lazy_load_file(file_info, pages, user_id, chat_id))
+
+
+def lazy_load_file(file_info, pages, user_id: int, chat_id: int):
+    ext = file_info["ext"]
+    file_path = file_info["file_path"]
+    filename = file_info["filename"]
+    file_hash = file_info.get("sha256")
+
+    if ext == "pdf":
+        loader = PyPDFLoader(file_path) if pages is None else PdfPagesLoader(file_path, pages)
+    elif ext == "txt":
+        loader = TextLoader(file_path)
+    elif ext == "md":
+        loader = None  # handling here especially
+        with open(file_path, "r", encoding="utf-8") as f:
+            content = f.read()
+
+        splitter = MarkdownHeaderTextSplitter(
+            headers_to_split_on=[("#", "Header 1"), ("##", "Header 2"), ("###", "Header 3")]
+        )
 
-            docs = splitter.split_text(content)
-            for doc in docs:
-                alter_metadata(doc, filename, user_id, chat_id)
-                print(doc, "\n\n")
-                all_chunks.append(doc)
-
-        elif ext == "docx" or ext == "doc":
-            loader = loader = UnstructuredWordDocumentLoader(
-                file_path,
-                mode="single",
-                strategy="fast",
-            )
-        elif ext == "csv":
-            loader = CSVLoader(file_path)
-        else:
-            loader = None
+        docs = splitter.split_text(content)
+        for doc in docs:
+            alter_metadata(doc, filename, user_id, chat_id, file_hash)
+            yield doc
+
+    elif ext == "docx" or ext == "doc":
+        loader = UnstructuredWordDocumentLoader(
+            file_path,
+            mode="single",
+            strategy="fast",
+        )
+    elif ext == "csv":
+        loader = CSVLoader(file_path)
+    else:
+        loader = None
+
+    if loader:
+        docs_generator = loader.lazy_load()
+        for doc in docs_generator:
+            # doc.metadata["download_location"] = doc.metadata["source"]
+            alter_metadata(doc, filename, user_id, chat_id, file_hash)
+
+            # flattening complex fields so that vector store doesnt complain when adding the docs
+            for field in doc.metadata:
+                if isinstance(doc.metadata[field], list):
+                    doc.metadata[field] = ", ".join(map(str, doc.metadata[field]))
+
+            yield doc
+
+
+class PdfPagesLoader(BaseLoader):
+    # loads only the given pages of a pdf, extracted the same way as PyPDFLoader (plain mode, stripped) and with the
+    # same metadata, so that page ranges parsed in different processes give the same docs as a sequential read
+    def __init__(self, file_path: str, pages: range):
+        self.file_path = file_path
+        self.pages = pages
+
+    def lazy_load(self):
+        reader = PdfReader(self.file_path)
+
+        doc_metadata = pdf_metadata(
+            {"producer": "PyPDF", "creator": "PyPDF", "creationdate": ""}
+            | dict(reader.metadata or {})
+            | {"source": self.file_path, "total_pages": len(reader.pages)}
+        )
 
-        if loader:
-            docs_generator = loader.lazy_load()
-            for doc in docs_generator:
-                # doc.metadata["download_location"] = doc.metadata["source"]
-                alter_metadata(doc, filename, user_id, chat_id)
+        for page_number in self.pages:
+            yield Document(
+                page_content=reader.pages[page_number].extract_text(extraction_mode="plain").strip(),
+                metadata={**doc_metadata, "page": page_number, "page_label": reader.page_labels[page_number]},
+            )
 
-                # flattening complex fields so that vector store doesnt complain when adding the docs
-                for field in doc.metadata:
-                    if isinstance(doc.metadata[field], list):
-                        doc.metadata[field] = ", ".join(map(str, doc.metadata[field]))
 
-                print(doc, "\n\n")
-                all_chunks.append(doc)
+def pdf_metadata(metadata: dict):
+    # a pdf's document info normalized the way PyPDFLoader does it: keys without their leading "/" and lower case,
+    # dates as iso strings, values other than str and int as str
+    normalized = {}
+    for key, value in metadata.items():
+        if type(value) not in (str, int):
+            value = str(value)
+        key = key.removeprefix("/").lower()
+
+        if key in ("creationdate", "moddate"):
+            try:
+                normalized[key] = datetime.strptime(value.replace("'", ""), "D:%Y%m%d%H%M%S%z").isoformat("T")
+            except ValueError:
+                normalized[key] = value
+        elif key in ("page_count", "file_path"):
+            normalized[{"page_count": "total_pages", "file_path": "source"}[key]] = value
+            normalized[key] = value
+        elif isinstance(value, str):
+            normalized[key] = value.strip()
+        else:
+            normalized[key] = value
 
-    return all_chunks
+    return normalized
 
 
 def get_web_results(prompt: str, user_id: int, chat_id: int):
+    # prompt can be the raw "/search ..." message, search_web normalizes it (and caches by the normalized query)
     chunks = []
 
-    with DDGS() as ddgs:
-        results = ddgs.text(prompt, max_results=7)
-        for result in results:
-            chunk = Document(
-                page_content=result["body"],
-                metadata={
-                    "source": result["href"],
-                    "title": result["title"],
-                    "type": "web_search",
-                    "chat_id": chat_id,
-                    "user_id": user_id,
-                    "timestamp": datetime.now().isoformat(),
-                },
-            )
+    for result in search_web(prompt):
+        chunk = Document(
+            page_content=result["body"],
+            metadata={
+                "source": result["href"],
+                "title": result["title"],
+                "type": "web_search",
+                "chat_id": chat_id,
+                "user_id": user_id,
+                "timestamp": datetime.now().isoformat(),
+            },
+        )
 
-            chunks.append(chunk)
+        chunks.append(chunk)
 
     return chunks
 
 
-def get_context_from_attachments(vector_store: Chroma, original_prompt_text: str, user_id: int, chat_id: int):
-    count = vector_store._collection.count()
-    if count == 0:
-        return ""
+def add_web_results_to_index(chunks, vector_store: VectorPartition, user_id: int, chat_id: int):
+    # web results only go to the chat's in memory partition for a while, never into the persistent store
+    if not chunks:
+        return
 
-    k = 10
+    web_index = get_ephemeral_partition(vector_store.embeddings, user_id, chat_id, create=True)
+    texts = [chunk.page_content for chunk in chunks]
+    # ids from the page and text, so the same result found by a later search isn't added twice
+    ids = [hashlib.sha256((chunk.metadata["source"] + chunk.page_content).encode()).hexdigest() for chunk in chunks]
+    web_index.add(ids, texts, vector_store.embeddings.embed_documents(texts), [chunk.metadata for chunk in chunks])  # pyright: ignore
 
-    context_string = ""
-    with st.status(":material/document_search: Finding relevant context"):
-        results = vector_store.similarity_search_with_score(
-            query=original_prompt_text,
-            k=k,
-            filter={"$and": [{"user_id": user_id}, {"chat_id": chat_id}]},  # pyright: ignore
-        )
 
-        # context = "\n\n".join([doc.page_content + " [" + doc.metadata["source"] + "]" for doc in results])
-        context_chunk_arr = []
-        for i, (doc, score) in enumerate(results, start=1):
-            print("\nSCORE TESTING", score, doc.page_content)
-            fields = [
-                "source",
-                "page",
-                "page_number",
-                "header",
-                "title",
-                "description",
-                "section",
-                "category",
-                "author",
-                "language",
-                "last_modified",
-                "Header 1",
-                "Header 2",
-                "Header 3",
-                "depth",
-            ]
-
-            metadata_strs = []
-            for key in fields:
-                if key in doc.metadata:
-                    metadata_strs.append(
-                        f"- **{key.upper()}**: {doc.metadata[key] if key != 'source' else '`' + doc.metadata[key] + '`'}"
-                    )
-
-            chunk_context_string = f"#### [{i}]\n" f"{'\n'.join(metadata_strs)}\n" f"- **CONTENT**:\n{doc.page_content}"
-            st.info(chunk_context_string)
-            context_chunk_arr.append(chunk_context_string)
+def retrieve_documents(vector_store: VectorPartition, prompt: str, user_id: int, chat_id: int):
+    # [(doc, score, relevance)] from the chat's documents. no st.* calls, so it can run off the script thread
+    if get_chat_chunk_count(vector_store, user_id, chat_id) == 0:
+        return []  # nothing indexed for this chat, no need to embed the prompt or query the store
 
-        context_string = "\n---\n\n".join(context_chunk_arr)
-        # print("<CCCOOONTEXT>" + context_string + "</CCCOOONTEXT>")
+    return hybrid_search(vector_store, prompt, user_id, chat_id, k=FETCH_K)
+
+
+def retrieve_context(vector_store: VectorPartition, prompt: str, user_id: int, chat_id: int, document_results=None):
+    # the chat's document results (retrieved here unless already given) fused with its web results
+    if document_results is None:
+        document_results = retrieve_documents(vector_store, prompt, user_id, chat_id)
+
+    web_index = get_ephemeral_partition(vector_store.embeddings, user_id, chat_id)
+    if web_index is None:
+        return document_results
+
+    return merge_results(document_results, web_index.search(prompt, FETCH_K, user_id, chat_id))
+
+
+def format_context(passages):
+    # one markdown block per passage (numbered for citations) with its metadata and content
+    # context = "\n\n".join([doc.page_content + " [" + doc.metadata["source"] + "]" for doc in results])
+    context_chunk_arr = []
+    for i, doc in enumerate(passages, start=1):
+        fields = [
+            "source",
+            "page",
+            "page_number",
+            "header",
+            "title",
+            "description",
+            "section",
+            "category",
+            "author",
+            "language",
+            "last_modified",
+            "Header 1",
+            "Header 2",
+            "Header 3",
+            "depth",
+        ]
+
+        metadata_strs = []
+        for key in fields:
+            if key in doc.metadata:
+                metadata_strs.append(
+                    f"- **{key.upper()}**: {doc.metadata[key] if key != 'source' else '`' + doc.metadata[key] + '`'}"
+                )
 
-        return context_string
+        chunk_context_string = f"#### [{i}]\n" f"{'\n'.join(metadata_strs)}\n" f"- **CONTENT**:\n{doc.page_content}"
+        context_chunk_arr.append(chunk_context_string)
 
+    return context_chunk_arr
 
-def split_and_add_to_store(chunks, vector_store: Chroma):
-    if chunks:
-        with st.status(":material/split_scene_left: Splitting into chunks"):
-            splitter = RecursiveCharacterTextSplitter(chunk_size=800, chunk_overlap=110)
-            chunks = splitter.split_documents(chunks)
-            # chunks[0].page_content, chunks[0].metadata
 
-        if chunks:
-            with st.status(":material/splitscreen_add: Adding chunks to vector store"):
-                vector_store.add_documents(chunks)
+def join_context(context_chunk_arr):
+    return "\n---\n\n".join(context_chunk_arr)
+
+
+def get_context_from_attachments(passages):
+    # renders the passages picked for the prompt (see pipeline.Turn.context) and returns the prompt's context string
+    if not passages:
+        return ""
+
+    with st.status(":material/document_search: Finding relevant context"):
+        context_chunk_arr = format_context(passages)
+        for chunk_context_string in context_chunk_arr:
+            st.info(chunk_context_string)
+
+        # print("<CCCOOONTEXT>" + context_string + "</CCCOOONTEXT>")
+        return join_context(context_chunk_arr)
+
+
+# number of chunks embedded and added to the vector store at once while ingesting
+EMBED_BATCH_SIZE = 64
+# number of embedding requests sent to ollama at the same time while ingesting
+EMBED_MAX_IN_FLIGHT = 4
+
+
+def reuse_cached_files(
+    files_info,
+    vector_store: VectorPartition,
+    user_id: int,
+    chat_id: int,
+    on_reused=None,
+    on_batch=None,
+    pause: float = 0.0,
+):
+    # files processed before (same sha256) are added without parsing them again, on_reused(file_info, chunk_count)
+    # is called for each. returns files_info of the files that still need to be parsed.
+    # chunks without embeddings of this model are embedded (resuming from the batches saved before, if any) with
+    # pause seconds between the batches sent to ollama, on_batch(file_info, chunks_done, chunk_count) after each
+    embedding_model = vector_store.embeddings.model  # pyright: ignore
+
+    uncached_files_info = []
+    for file_info in unique_files(files_info):
+        stored_chunks = db.get_document_chunks(file_info["sha256"])
+        if stored_chunks is None:
+            uncached_files_info.append(file_info)
+            continue
+
+        chunks = []
+        for stored_chunk in stored_chunks:
+            chunk = Document(page_content=stored_chunk["content"], metadata=stored_chunk["metadata"])
+            alter_metadata(chunk, file_info["filename"], user_id, chat_id, file_info["sha256"])
+            chunks.append(chunk)
+
+        # embeddings are only missing if the file was uploaded before with a different embedding model
+        embeddings = db.get_chunk_embeddings(file_info["sha256"], embedding_model)
+        saved = db.get_saved_chunk_embeddings(file_info["sha256"], embedding_model) if embeddings is None else {}
+        for start in range(0, len(chunks), EMBED_BATCH_SIZE):
+            batch = chunks[start : start + EMBED_BATCH_SIZE]
+            positions = range(start, start + len(batch))
+            if embeddings is not None:
+                embed_and_add_to_store(batch, vector_store, embeddings[start : start + EMBED_BATCH_SIZE])
+            elif all(position in saved for position in positions):
+                embed_and_add_to_store(batch, vector_store, [saved[position] for position in positions])
+            else:
+                batch_embeddings = embed_and_add_to_store(batch, vector_store)
+                db.save_chunk_embeddings(file_info["sha256"], embedding_model, batch_embeddings, start)
+                if pause:
+                    time.sleep(pause)
+
+            if on_batch:
+                on_batch(file_info, start + len(batch), len(chunks))
+
+        vector_store.flush()
+        if on_reused:
+            on_reused(file_info, len(chunks))
+
+    return uncached_files_info
+
+
+def remove_file_chunks(file_info, vector_store: VectorPartition, user_id: int, chat_id: int):
+    # the chunks of a file indexed into the chat so far (e.g. by an ingest stopped part way), so that indexing it
+    # again doesn't add them twice. returns how many were removed
+    embedding_model = vector_store.embeddings.model  # pyright: ignore
+    chunk_ids = db.get_file_chunk_ids(user_id, chat_id, embedding_model, file_info["sha256"])
+    if chunk_ids:
+        vector_store.delete(chunk_ids)
+        db.delete_file_chunks_fts(user_id, chat_id, embedding_model, file_info["sha256"])
+
+    return len(chunk_ids)
+
+
+def embed_and_add_to_store(chunks, vector_store: VectorPartition, embeddings=None):
+    embedding_model = vector_store.embeddings.model  # pyright: ignore
+    texts = [chunk.page_content for chunk in chunks]
+    if embeddings is None:
+        embeddings = vector_store.embeddings.embed_documents(texts)  # pyright: ignore
+
+    ids = [str(uuid4()) for _ in chunks]
+
+    # adding with precomputed embeddings so that they can be cached per file as well
+    vector_store.add(ids, texts, embeddings, [chunk.metadata for chunk in chunks])
+
+    # same chunks in the full text index, under the same ids, for hybrid retrieval
+    db.add_chunks_fts(
+        [
+            {
+                "chunk_id": id,
+                "user_id": chunk.metadata["user_id"],
+                "chat_id": chunk.metadata["chat_id"],
+                "embedding_model": embedding_model,
+                "content": chunk.page_content,
+                "metadata": chunk.metadata,
+            }
+            for id, chunk in zip(ids, chunks)
+        ]
+    )
+
+    counts = {}
+    for chunk in chunks:
+        key = (chunk.metadata["user_id"], chunk.metadata["chat_id"])
+        counts[key] = counts.get(key, 0) + 1
+    for (user_id, chat_id), count in counts.items():
+        db.add_chunk_count(user_id, chat_id, embedding_model, count)
+
+    return embeddings
+
+
+def ingest_chunks(
+    chunks,
+    vector_store: VectorPartition,
+    batch_size: int = EMBED_BATCH_SIZE,
+    max_in_flight: int = EMBED_MAX_IN_FLIGHT,
+    on_progress=None,
+    timings: Optional[Timings] = None,
+):
+    # streams docs through the splitter into fixed size embed + add batches, so memory stays bounded by a few
+    # batches no matter how big the upload is. batches are embedded concurrently (up to max_in_flight requests)
+    # and added to the store in order. on_progress(docs_read, chunks_added, chunks_per_second) is called after
+    # every batch. timings gets parse (waiting for docs, i.e. for the parsing processes), split, embed (waiting
+    # for embeddings) and vector_add
+    embedding_model = vector_store.embeddings.model  # pyright: ignore
+    splitter = RecursiveCharacterTextSplitter(chunk_size=800, chunk_overlap=110)
+    executor = EmbeddingExecutor(vector_store.embeddings, max_in_flight=max_in_flight)
+    timings = timings or Timings()
+
+    docs_read = 0
+    chunks_added = 0
+    file_positions = {}  # file_hash -> (ext, number of chunks cached so far)
+    produced_seconds = 0.0  # parse + split time, spent inside executor.map when it pulls the next batch
+
+    def split_into_batches():
+        nonlocal docs_read, produced_seconds
+
+        docs = iter(chunks)
+        batch = []
+        while True:
+            started_at = time.perf_counter()
+            doc = next(docs, None)
+            parsed_at = time.perf_counter()
+            timings.add("parse", parsed_at - started_at)
+            if doc is None:
+                break
+
+            docs_read += 1
+            for chunk in splitter.split_documents([doc]):
+                batch.append(chunk)
+            split_at = time.perf_counter()
+            timings.add("split", split_at - parsed_at)
+            produced_seconds += split_at - started_at
+
+            while len(batch) >= batch_size:
+                yield batch[:batch_size]
+                batch = batch[batch_size:]
+
+        if batch:
+            yield batch
+
+    batches = executor.map(split_into_batches())
+    while True:
+        started_at = time.perf_counter()
+        produced_before = produced_seconds
+        item = next(batches, None)
+        # whatever wasn't spent producing batches was spent waiting for ollama
+        timings.add("embed", time.perf_counter() - started_at - (produced_seconds - produced_before))
+        if item is None:
+            break
+
+        batch, embeddings = item
+        with timings.span("vector_add"):
+            embed_and_add_to_store(batch, vector_store, embeddings)
+            remember_file_chunks(batch, embeddings, embedding_model, file_positions)
+
+        chunks_added += len(batch)
+        if on_progress:
+            on_progress(docs_read, chunks_added, executor.throughput())
+
+    vector_store.flush()
+
+    # only now are the files complete and can be reused by later uploads
+    for file_hash, (ext, count) in file_positions.items():
+        db.complete_document(file_hash, ext, count)
+
+    return chunks_added
+
+
+def remember_file_chunks(chunks, embeddings, embedding_model: str, file_positions: dict):
+    by_hash = {}
+    for chunk, embedding in zip(chunks, embeddings):
+        file_hash = chunk.metadata.get("file_hash")
+        if file_hash:  # web results etc. are not cached
+            by_hash.setdefault(file_hash, []).append((chunk, embedding))
+
+    for file_hash, items in by_hash.items():
+        stored_chunks = []
+        for chunk, _ in items:
+            # user_id and chat_id are re-tagged on each reuse
+            metadata = {k: v for k, v in chunk.metadata.items() if k not in {"user_id", "chat_id"}}
+            stored_chunks.append({"content": chunk.page_content, "metadata": metadata})
+
+        ext, start = file_positions.get(file_hash, (items[0][0].metadata["source"].split(".")[-1].lower(), 0))
+        db.add_document_chunks(file_hash, start, stored_chunks)
+        db.save_chunk_embeddings(file_hash, embedding_model, [embedding for _, embedding in items], start)
+        file_positions[file_hash] = (ext, start + len(items))
+
+
+def get_chat_chunk_count(vector_store: VectorPartition, user_id: int, chat_id: int):
+    embedding_model = vector_store.embeddings.model  # pyright: ignore
+    count = db.get_chunk_count(user_id, chat_id, embedding_model)
+    if count is None:
+        # chats indexed before counts were kept, counting once from the store's metadata (no embedding needed)
+        count = vector_store.count(user_id, chat_id)
+        db.add_chunk_count(user_id, chat_id, embedding_model, count)
+
+    return count
@@ -0,0 +1,123 @@
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.output_parsers import StrOutputParser
+import db
+
+# tokens of chat history sent to the model each turn (load_chat_model uses num_ctx=8192, the rest is left for
+# the system prompt, attachments context, the prompt itself and the response)
+HISTORY_TOKEN_BUDGET = 2500
+# when the history overflows, older messages are folded into the summary until they fit in this fraction of the
+# budget, so that summarizing happens once every few turns instead of on every turn
+COMPACT_TO = 0.6
+# fraction of the budget the summary itself may take, it's condensed once it grows past that (so the summary and
+# the messages kept fit in the budget together however long the chat gets)
+SUMMARY_SHARE = 0.25
+
+
+summary_prompt_template = ChatPromptTemplate.from_messages(
+    [
+        (
+            "system",
+            "You maintain a running summary of a conversation between a user and ChatDocs, a document assistant.\n"
+            "- Merge the existing summary and the new messages into one updated summary\n"
+            "- Keep facts, names, numbers, decisions, open questions and which documents were discussed\n"
+            "- Write plain concise notes, no preamble\n",
+        ),
+        ("human", "Existing summary:\n{summary}\n\n---\n\nNew messages:\n{messages}"),
+    ]
+)
+
+
+condense_prompt_template = ChatPromptTemplate.from_messages(
+    [
+        (
+            "system",
+            "You shorten the running summary of a conversation between a user and ChatDocs, a document assistant.\n"
+            "- Keep the most important facts, names, numbers, decisions and open questions\n"
+            "- Use at most {max_words} words of plain concise notes, no preamble\n",
+        ),
+        ("human", "{summary}"),
+    ]
+)
+
+
+def estimate_tokens(text: str) -> int:
+    # roughly 4 characters per token for english text, good enough for budgeting without loading a tokenizer
+    return len(text) // 4 + 1
+
+
+def get_model_history(chat_id: int, chat_model, token_budget: int = HISTORY_TOKEN_BUDGET, summarize_overflow=True):
+    # most recent messages, preceded by a summary of everything older, within token_budget together.
+    # the summary is stored in the db with a cursor, so only messages that newly fall out of the window are
+    # ever summarized. with summarize_overflow=False (no time to call the model) they are just left out
+    if chat_id == 0:
+        return []
+
+    stored = db.get_chat_summary(chat_id)
+    summary = stored["summary"] if stored else ""
+    messages = db.get_chat_history(chat_id, after=stored["until"] if stored else None)
+
+    total = estimate_tokens(summary) + sum(estimate_tokens(message["content"]) for message in messages)
+    if total > token_budget:
+        # keeping the latest messages that fit in the compacted budget, the rest goes into the summary
+        kept_tokens = 0
+        first_kept = len(messages)
+        while first_kept > 0:
+            tokens = estimate_tokens(messages[first_kept - 1]["content"])
+            if kept_tokens + tokens > token_budget * COMPACT_TO:
+                break
+            kept_tokens += tokens
+            first_kept -= 1
+
+        evicted = messages[:first_kept]
+        messages = messages[first_kept:]
+
+        if evicted and summarize_overflow:
+            summary = fit_summary(chat_model, summarize(chat_model, summary, evicted), token_budget)
+            db.save_chat_summary(chat_id, summary, (evicted[-1]["sent_at"], evicted[-1]["id"]))
+
+    if estimate_tokens(summary) > token_budget * SUMMARY_SHARE:
+        # a summary stored before it was kept within its share. without time to condense it, it's cut for this
+        # turn only
+        if summarize_overflow:
+            summary = fit_summary(chat_model, summary, token_budget)
+            db.save_chat_summary(chat_id, summary, stored["until"])  # pyright: ignore
+        else:
+            summary = truncate_to_tokens(summary, int(token_budget * SUMMARY_SHARE))
+
+    history = []
+    if summary:
+        history.append({"role": "system", "content": f"Summary of the earlier conversation:\n{summary}"})
+    history.extend({"role": message["role"], "content": message["content"]} for message in messages)
+
+    return history
+
+
+def fit_summary(chat_model, summary: str, token_budget: int = HISTORY_TOKEN_BUDGET) -> str:
+    # the summary condensed by the model if it's over its share of the budget (and cut if it still is)
+    max_tokens = int(token_budget * SUMMARY_SHARE)
+    if estimate_tokens(summary) <= max_tokens:
+        return summary
+
+    chain = condense_prompt_template | chat_model | StrOutputParser()
+    condensed = chain.invoke({"summary": summary, "max_words": max_tokens * 3 // 4}).strip()
+    return truncate_to_tokens(condensed, max_tokens)
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    # the start of text within max_tokens (as counted by estimate_tokens), cut at a line or word boundary
+    if estimate_tokens(text) <= max_tokens:
+        return text
+
+    cut = text[: max(0, (max_tokens - 1) * 4)]
+    boundary = max(cut.rfind("\n"), cut.rfind(" "))
+    return cut[:boundary].rstrip() if boundary > 0 else cut
+
+
+def summarize(chat_model, summary: str, messages) -> str:
+    chain = summary_prompt_template | chat_model | StrOutputParser()
+    return chain.invoke(
+        {
+            "summary": summary or "(none yet)",
+            "messages": "\n\n".join(f"{message['role'].upper()}: {message['content']}" for message in messages),
+        }
+    ).strip()
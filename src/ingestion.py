@@ -0,0 +1,199 @@
+import os
+import socket
+import threading
+import time
+import traceback
+from uuid import uuid4
+
+import db
+from handle_docs import unique_files, remove_file_chunks
+from metrics import Timings, record as record_timings
+from pipeline import ingest_files
+
+# ----------------- BACKGROUND INGESTION QUEUE -----------------
+# attachments are saved during the turn, everything else (parsing, splitting, embedding, adding to the vector
+# store) is a job in the ingestion_jobs table, picked up by worker threads in the server process. parsing still
+# runs in the process pool of iter_file_chunks, the threads mostly wait for it and for ollama. chunk counts are
+# updated batch by batch, so a chat answers from whatever has been indexed so far. a job is leased by the queue
+# running it, which renews the lease while it runs, so queues of other processes (streamlit and the http api run
+# side by side) leave it alone. jobs survive restarts: one whose lease ran out (its process stopped) is taken over
+# by whichever queue claims it next, which removes what the file it stopped on had added before indexing that
+# again. reembed jobs add a chat's documents to the store of another embedding model (see embedding_model_for).
+
+# jobs indexed at once
+INGESTION_WORKERS = 2
+# seconds a worker sleeps when the queue is empty, submit wakes workers up right away
+INGESTION_POLL_INTERVAL = 5.0
+# seconds a job stays leased to its queue without being renewed, leases are renewed every third of that
+INGESTION_LEASE_SECONDS = 60
+# seconds a prompt sent with attachments waits for them to be indexed before answering from what's there
+ATTACHMENT_WAIT_SECONDS = 10.0
+# seconds between the batches of chunks sent to ollama when re-embedding a chat's documents
+REEMBED_PAUSE_SECONDS = 0.25
+# seconds before a failed re-embedding (e.g. the model isn't pulled) is tried again
+REEMBED_RETRY_SECONDS = 5 * 60
+
+
+class IngestionQueue:
+    def __init__(self, load_vector_store, workers: int = INGESTION_WORKERS, poll_interval: float = INGESTION_POLL_INTERVAL):
+        # load_vector_store(embedding_model) -> PartitionedVectorStore, e.g. main.load_vector_store
+        self.load_vector_store = load_vector_store
+        self.poll_interval = poll_interval
+        # the owner of the jobs this queue runs, unique per queue (and process)
+        self.owner = f"{socket.gethostname()}-{os.getpid()}-{uuid4().hex[:8]}"
+
+        self._wake = threading.Event()
+        self._lock = threading.Lock()  # so that a chat's documents are queued for re-embedding only once
+        self._active = set()  # ids of the jobs the workers are running, whose leases are renewed
+        self._threads = [
+            threading.Thread(target=self._run, name=f"ingestion-{i}", daemon=True) for i in range(workers)
+        ]
+        self._threads.append(threading.Thread(target=self._renew_leases, name="ingestion-leases", daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, user_id: int, chat_id: int, embedding_model: str, files_info, kind: str = "upload"):
+        # files_info as returned by save_files, returns the job's id
+        job_id = db.create_ingestion_job(user_id, chat_id, embedding_model, unique_files(files_info), kind)
+        self._wake.set()
+        return job_id
+
+    def wait(self, job_id: int, chat_id: int, timeout: float = ATTACHMENT_WAIT_SECONDS):
+        # True if the job finished within timeout
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if not any(job["id"] == job_id for job in db.get_ingestion_jobs(chat_id, unfinished_only=True)):
+                return True
+            time.sleep(0.2)
+        return False
+
+    def _run(self):
+        while True:
+            # any error (e.g. the database staying locked past its busy timeout while other processes write) is
+            # logged and the worker carries on after a while. a job it couldn't finish is no longer renewed, so
+            # it's claimed again once its lease runs out
+            try:
+                self._wake.clear()
+                job = db.claim_ingestion_job(self.owner, INGESTION_LEASE_SECONDS)
+                if job is None:
+                    self._wake.wait(timeout=self.poll_interval)
+                    continue
+
+                with self._lock:
+                    self._active.add(job["id"])
+                try:
+                    self.process(job)
+                except Exception as e:
+                    traceback.print_exc()
+                    db.finish_ingestion_job(job["id"], self.owner, "error", str(e))
+                finally:
+                    with self._lock:
+                        self._active.discard(job["id"])
+            except Exception:
+                traceback.print_exc()
+                time.sleep(self.poll_interval)
+
+    def _renew_leases(self):
+        while True:
+            time.sleep(INGESTION_LEASE_SECONDS / 3)
+            try:
+                with self._lock:
+                    job_ids = list(self._active)
+                if job_ids:
+                    db.renew_ingestion_leases(self.owner, job_ids, INGESTION_LEASE_SECONDS)
+            except Exception:
+                traceback.print_exc()
+
+    def process(self, job):
+        job_id, user_id, chat_id = job["id"], job["user_id"], job["chat_id"]
+        vector_store = self.load_vector_store(job["embedding_model"]).get(user_id, chat_id)
+        timings = Timings()
+
+        # file by file so that each one has its own progress, and a file that fails doesn't fail the others
+        errors = 0
+        for file in db.get_ingestion_files(job_id):
+            if not db.holds_ingestion_lease(job_id, self.owner):
+                return  # lease ran out (e.g. the process was suspended), another queue has taken the job over
+
+            if file["state"] == "done":
+                continue  # indexed before a restart
+
+            position = file["position"]
+            if file["state"] != "queued":
+                # left part way by a queue that stopped
+                remove_file_chunks(file["file_info"], vector_store, user_id, chat_id)
+            db.update_ingestion_file(job_id, position, "indexing", docs_read=0, chunks_added=0, chunks_per_second=0.0)
+
+            def on_batch(file_info, chunks_done, chunk_count):
+                db.update_ingestion_file(job_id, position, "indexing", chunks_added=chunks_done)
+
+            def on_progress(docs_read, chunks_added, chunks_per_second):
+                db.update_ingestion_file(
+                    job_id,
+                    position,
+                    "indexing",
+                    docs_read=docs_read,
+                    chunks_added=chunks_added,
+                    chunks_per_second=chunks_per_second,
+                )
+
+            try:
+                ingest_files(
+                    [file["file_info"]],
+                    vector_store,
+                    user_id,
+                    chat_id,
+                    timings,
+                    on_progress=on_progress,
+                    on_batch=on_batch,
+                    # re-embedding leaves ollama some room for the prompts (and uploads) of the meantime
+                    pause=REEMBED_PAUSE_SECONDS if job["kind"] == "reembed" else 0.0,
+                )
+            except Exception as e:
+                traceback.print_exc()
+                errors += 1
+                db.update_ingestion_file(job_id, position, "error", error=str(e))
+            else:
+                db.update_ingestion_file(job_id, position, "done")
+                if file["file_info"].get("sha256"):
+                    db.add_chat_documents(user_id, chat_id, job["embedding_model"], [file["file_info"]])
+
+        record_timings(timings)
+        if errors:
+            db.finish_ingestion_job(job_id, self.owner, "error", f"{errors} file(s) could not be indexed")
+        else:
+            db.finish_ingestion_job(job_id, self.owner, "done")
+
+    def embedding_model_for(self, user_id: int, chat_id: int, embedding_model: str):
+        # the embedding model to search the chat's documents with. once the chat is used with a new embedding
+        # model, its documents are re-embedded with it in the background (from the chunks kept in the db, nothing
+        # is parsed again) and the model most of them are in is used until that's complete
+        with self._lock:
+            missing_files_info = db.get_missing_chat_documents(chat_id, embedding_model)
+            if not missing_files_info:
+                return embedding_model
+
+            reembed_jobs = [
+                job
+                for job in db.get_ingestion_jobs(chat_id)
+                if job["kind"] == "reembed" and job["embedding_model"] == embedding_model
+            ]
+            last_job = reembed_jobs[-1] if reembed_jobs else None
+            if (
+                last_job is None
+                or last_job["state"] == "done"  # documents uploaded with another model since
+                or (last_job["state"] == "error" and time.time() - last_job["finished_at"] >= REEMBED_RETRY_SECONDS)
+            ):
+                self.submit(user_id, chat_id, embedding_model, missing_files_info, kind="reembed")
+
+        for chat_document_model in db.get_chat_document_models(chat_id):
+            if chat_document_model["embedding_model"] != embedding_model:
+                return chat_document_model["embedding_model"]
+
+        return embedding_model
+
+
+def ingestion_progress(jobs):
+    # (files done, files in total) over the given jobs (see db.get_ingestion_jobs)
+    files = [file for job in jobs for file in job["files"]]
+    return sum(file["state"] in {"done", "error"} for file in files), len(files)
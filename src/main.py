@@ -1,22 +1,60 @@
 from langchain_ollama import ChatOllama
-from langchain_chroma import Chroma
 from langchain_ollama import OllamaEmbeddings
+from embedding_cache import CachedEmbeddings
+from metrics import add_embedding_cache
+from vector_stores import PartitionedVectorStore
+from warmup import ModelWarmer, KEEP_ALIVE, CHAT_NUM_CTX
+from ingestion import IngestionQueue
+import db
 
 import streamlit as st
 
 
 # ----------------- LOAD CHAT MODEL -----------------
 @st.cache_resource(show_spinner=False)
-def load_chat_model(model, temperature=0.6, num_ctx=8192, reasoning=None):
-    return ChatOllama(model=model, temperature=temperature, num_ctx=num_ctx, reasoning=reasoning, validate_model_on_init=True)
+def load_chat_model(model, temperature=0.6, num_ctx=CHAT_NUM_CTX, reasoning=None):
+    return ChatOllama(
+        model=model,
+        temperature=temperature,
+        num_ctx=num_ctx,
+        reasoning=reasoning,
+        keep_alive=KEEP_ALIVE,
+        validate_model_on_init=True,
+    )
 
 
 # ----------------- LOAD VECTOR DB -----------------
 @st.cache_resource(show_spinner=False)
 def load_vector_store(embedding_model: str):
-    embeddings = OllamaEmbeddings(model=embedding_model, validate_model_on_init=True)
-    collection_name = embedding_model.replace(":", "-")
-    return Chroma(persist_directory="vector_store", collection_name=collection_name, embedding_function=embeddings)
+    # a chat's own store is then opened with load_vector_store(embedding_model).get(user_id, chat_id)
+    embeddings = CachedEmbeddings(
+        OllamaEmbeddings(model=embedding_model, keep_alive=KEEP_ALIVE, validate_model_on_init=True), model=embedding_model
+    )
+    add_embedding_cache(embeddings)
+    return PartitionedVectorStore(embeddings, embedding_model)
+
+
+# ----------------- MODEL WARM-UP -----------------
+@st.cache_resource(show_spinner=False)
+def get_model_warmer():
+    # one per server process, keeps the models in use loaded in ollama (see warmup.py)
+    return ModelWarmer()
+
+
+def warm_up_preferred_models(user_id: int = 0):
+    # called when a server process starts, so that the user's models are loaded before their first prompt
+    preferences = db.get_user_info(user_id)
+    warmer = get_model_warmer()
+    warmer.watch(preferences["chat_model"], "chat")
+    warmer.watch(preferences["embedding_model"], "embedding")
+    return warmer
+
+
+# ----------------- BACKGROUND INGESTION -----------------
+@st.cache_resource(show_spinner=False)
+def get_ingestion_queue():
+    # one per server process, indexes attachments in the background (see ingestion.py)
+    return IngestionQueue(load_vector_store)
 
 
 # vector_store.reset_collection()
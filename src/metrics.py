@@ -0,0 +1,186 @@
+import json
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# ----------------- PER STAGE TIMINGS AND METRICS -----------------
+# each turn collects how long its stages took in a Timings (stored with the ai message in chat_messages.timings)
+# and, once done, adds them to in process histograms served in prometheus text format on /metrics and as json
+# on /metrics.json by a small http server next to streamlit, along with the embedding caches' hits and misses.
+# attachments are indexed by the ingestion queue, each
+# job records its own Timings (parse, split, embed, vector_add) into the same histograms, not into a turn's.
+
+# stages of a turn and of indexing, in the order they happen
+STAGES = [
+    "save_files",
+    "parse",
+    "split",
+    "embed",
+    "vector_add",
+    "web_search",
+    "history",
+    "retrieval",
+    "time_to_first_token",
+    "generation",
+    "total",
+]
+
+SECONDS_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300]
+TOKENS_PER_SECOND_BUCKETS = [1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200, 500]
+
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9464
+
+
+class Timings:
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.seconds = {}  # stage -> seconds, summed when a stage runs more than once in a turn
+        self.tokens_per_second = None
+
+    @contextmanager
+    def span(self, stage: str):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - started_at)
+
+    def add(self, stage: str, seconds: float):
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+
+    def mark(self, stage: str):
+        # time from the start of the turn until now, e.g. time_to_first_token
+        self.seconds[stage] = time.perf_counter() - self.started_at
+
+    def to_dict(self):
+        data = {stage: round(seconds, 4) for stage, seconds in self.seconds.items()}
+        if self.tokens_per_second is not None:
+            data["tokens_per_second"] = round(self.tokens_per_second, 2)
+        return data
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets + [float("inf")], self.counts):
+            total += count
+            yield bound, total
+
+
+_stage_seconds = {}  # stage -> Histogram
+_tokens_per_second = Histogram(TOKENS_PER_SECOND_BUCKETS)
+_embedding_caches = []  # CachedEmbeddings of this process, their hits and misses are read when served
+_lock = threading.Lock()
+
+
+def record(timings: Timings):
+    with _lock:
+        for stage, seconds in timings.seconds.items():
+            _stage_seconds.setdefault(stage, Histogram(SECONDS_BUCKETS)).observe(seconds)
+        if timings.tokens_per_second is not None:
+            _tokens_per_second.observe(timings.tokens_per_second)
+
+
+def add_embedding_cache(cache):
+    # cache is an embedding_cache.CachedEmbeddings (anything with stats())
+    with _lock:
+        _embedding_caches.append(cache)
+
+
+def render_prometheus():
+    lines = [
+        "# HELP chatdocs_stage_seconds Time spent in each stage of a chat turn.",
+        "# TYPE chatdocs_stage_seconds histogram",
+    ]
+    with _lock:
+        ordered = sorted(_stage_seconds.items(), key=lambda item: STAGES.index(item[0]) if item[0] in STAGES else 99)
+        for stage, histogram in ordered:
+            lines.extend(histogram_lines("chatdocs_stage_seconds", histogram, f'stage="{stage}"'))
+
+        lines.extend(
+            [
+                "# HELP chatdocs_tokens_per_second Generation speed of a chat turn.",
+                "# TYPE chatdocs_tokens_per_second histogram",
+                *histogram_lines("chatdocs_tokens_per_second", _tokens_per_second),
+            ]
+        )
+
+        cache_stats = [cache.stats() for cache in _embedding_caches]
+
+    for name, key, type, help in (
+        ("chatdocs_embedding_cache_hits_total", "hits", "counter", "Texts whose embedding was found in the cache."),
+        ("chatdocs_embedding_cache_misses_total", "misses", "counter", "Texts that had to be embedded by the model."),
+        ("chatdocs_embedding_cache_entries", "entries", "gauge", "Embeddings kept in the cache."),
+    ):
+        lines.extend([f"# HELP {name} {help}", f"# TYPE {name} {type}"])
+        lines.extend(f'{name}{{model="{stats["model"]}"}} {stats[key]}' for stats in cache_stats)
+
+    return "\n".join(lines) + "\n"
+
+
+def histogram_lines(name: str, histogram: Histogram, labels: str = ""):
+    separator = "," if labels else ""
+    for bound, count in histogram.cumulative():
+        le = "+Inf" if bound == float("inf") else f"{bound:g}"
+        yield f'{name}_bucket{{{labels}{separator}le="{le}"}} {count}'
+    suffix = f"{{{labels}}}" if labels else ""
+    yield f"{name}_sum{suffix} {histogram.sum:.6f}"
+    yield f"{name}_count{suffix} {histogram.count}"
+
+
+def snapshot():
+    def histogram_dict(histogram: Histogram):
+        return {
+            "count": histogram.count,
+            "sum": histogram.sum,
+            "mean": histogram.sum / histogram.count if histogram.count else None,
+            "buckets": {("+Inf" if bound == float("inf") else f"{bound:g}"): count for bound, count in histogram.cumulative()},
+        }
+
+    with _lock:
+        return {
+            "stage_seconds": {stage: histogram_dict(histogram) for stage, histogram in _stage_seconds.items()},
+            "tokens_per_second": histogram_dict(_tokens_per_second),
+            "embedding_cache": [cache.stats() for cache in _embedding_caches],
+        }
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            self.send(render_prometheus().encode(), "text/plain; version=0.0.4")
+        elif self.path == "/metrics.json":
+            self.send(json.dumps(snapshot()).encode(), "application/json")
+        else:
+            self.send_error(404)
+
+    def send(self, payload: bytes, content_type: str):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def start_metrics_server(host: str = METRICS_HOST, port: int = METRICS_PORT):
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
@@ -0,0 +1,191 @@
+import time
+
+import db
+from handle_docs import (
+    reuse_cached_files,
+    iter_file_chunks,
+    ingest_chunks,
+    get_web_results,
+    add_web_results_to_index,
+    retrieve_documents,
+    retrieve_context,
+    format_context,
+    join_context,
+)
+from history import get_model_history
+from metrics import Timings, record as record_timings
+from pregeneration import PregenerationStage
+from retrieval import assemble_context
+
+# ----------------- TURN PIPELINE -----------------
+# everything a prompt goes through, from indexing its attachments to saving the answer, without any ui. the
+# streamlit app (chat_area) and the http api (api.py) both drive a Turn, rendering its steps their own way.
+# steps are separate methods so that the caller can put its ui (or events) between them.
+
+
+def reasoning_option(selected: str):
+    # the preferences' "Default" / "Off" / "Low" ... to ChatOllama's reasoning argument
+    return None if selected == "Default" else False if selected == "Off" else selected.lower()
+
+
+def ingest_files(
+    files_info,
+    vector_store,
+    user_id: int,
+    chat_id: int,
+    timings=None,
+    on_reused=None,
+    on_progress=None,
+    on_batch=None,
+    pause: float = 0.0,
+):
+    # files_info as returned by save_files. files seen before are reused, the rest parsed, split, embedded and
+    # added. on_reused(file_info, chunk_count), on_progress(docs_read, chunks_added, chunks_per_second).
+    # on_batch and pause are for files seen before, see reuse_cached_files
+    timings = timings or Timings()
+    with timings.span("vector_add"):
+        new_files_info = reuse_cached_files(files_info, vector_store, user_id, chat_id, on_reused, on_batch, pause)
+
+    chunks = iter_file_chunks(new_files_info, user_id, chat_id)
+    return ingest_chunks(chunks, vector_store, on_progress=on_progress, timings=timings)
+
+
+class Turn:
+    def __init__(self, user_id: int, chat_id: int, prompt: str, chat_model, vector_stores, style: str = "Normal"):
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.prompt = prompt
+        self.chat_model = chat_model
+        self.vector_stores = vector_stores
+        self.style = style
+
+        self.is_web_search = prompt.startswith("/search")
+        self.vector_store = vector_stores.get(user_id, chat_id) if chat_id else None
+
+        # per stage latency of this turn, stored with the ai message and added to the metrics
+        self.timings = Timings()
+        # history, web search and document retrieval run concurrently and are joined before generation
+        self.stage = PregenerationStage()
+        self.tokens = 0
+
+    # ----------------- BEFORE GENERATION -----------------
+
+    def start_history(self):
+        # history for the model (within its token budget, older turns summarized)
+        self.stage.start("history", get_model_history, self.chat_id, self.chat_model)
+
+    def create_chat(self, name: str):
+        self.chat_id = db.create_chat(name, self.user_id)
+        self.vector_store = self.vector_stores.get(self.user_id, self.chat_id)
+        return self.chat_id
+
+    def start_web_search(self):
+        # fetched and indexed while attachments are handled
+        if not self.is_web_search:
+            return
+
+        vector_store = self.vector_store
+
+        def search_web_and_index(prompt, user_id, chat_id):
+            chunks = get_web_results(prompt, chat_id=chat_id, user_id=user_id)
+            add_web_results_to_index(chunks, vector_store, user_id, chat_id)
+
+        self.stage.start("web_search", search_web_and_index, self.prompt, self.user_id, self.chat_id)
+
+    def ingest(self, files_info, on_reused=None, on_progress=None):
+        return ingest_files(
+            files_info, self.vector_store, self.user_id, self.chat_id, self.timings, on_reused, on_progress
+        )
+
+    def start_document_search(self):
+        # after this turn's files are indexed
+        self.stage.start("documents", retrieve_documents, self.vector_store, self.prompt, self.user_id, self.chat_id)
+
+    def web_search_state(self):
+        # "complete" or "error", None if this isn't a web search
+        if not self.is_web_search:
+            return None
+
+        self.stage.result("web_search")
+        self.timings.add("web_search", self.stage.durations.get("web_search", 0.0))
+        return "error" if self.stage.failed("web_search") else "complete"
+
+    def context(self):
+        # passages for the prompt: the chat's documents and web results after relevance cutoff, mmr, merging of
+        # overlapping neighbours and token cap
+        document_results = self.stage.result("documents", default=[])
+        self.timings.add("retrieval", self.stage.durations.get("documents", 0.0))
+
+        with self.timings.span("retrieval"):
+            results = retrieve_context(
+                self.vector_store, self.prompt, self.user_id, self.chat_id, document_results=document_results
+            )
+            return assemble_context(results)
+
+    def history(self):
+        model_chat_history = self.stage.result("history")
+        self.timings.add("history", self.stage.durations.get("history", 0.0))
+        if model_chat_history is None:
+            # summarizing didn't finish in time, going on with the recent messages only this turn
+            model_chat_history = get_model_history(self.chat_id, self.chat_model, summarize_overflow=False)
+
+        return model_chat_history
+
+    def chain_input(self, context_string: str, model_chat_history, has_files: bool = False):
+        return {
+            "style_rule": f"- Adopt a {self.style} tone" if self.style != "Normal" else "",
+            "attachments": (
+                f"Following contents were found from documents attached. Use them to answer user query. Also reference them.\n\n---\n{context_string.strip()}"
+                if context_string.strip()
+                else ""
+            ),
+            "human_input": ("I have attached some attachments" if has_files and not self.prompt else self.prompt),
+            "chat_history": model_chat_history,
+        }
+
+    def prepare(self, files_info=None):
+        # all of the above for callers without anything to render in between, returns (chain input, context string)
+        self.start_web_search()
+        if files_info:
+            self.ingest(files_info)
+        self.start_document_search()
+        self.web_search_state()
+        context_string = join_context(format_context(self.context()))
+        return self.chain_input(context_string, self.history(), has_files=bool(files_info)), context_string
+
+    # ----------------- GENERATION AND SAVING -----------------
+
+    def on_token(self):
+        # called for every streamed piece of the answer
+        if self.tokens == 0:
+            self.timings.mark("time_to_first_token")
+        self.tokens += 1
+
+    def save_prompt(self, files_info):
+        db.insert_chat_message(
+            chat_id=self.chat_id, content=self.prompt, role="human", files_info=files_info, statuses=[]
+        )
+        new_time = int(time.time())
+        db.update_last_interaction(chat_id=self.chat_id, new_time=new_time)
+        return new_time
+
+    def finish(self):
+        timings = self.timings
+        timings.mark("total")
+        if "time_to_first_token" in timings.seconds:
+            generation_seconds = timings.seconds["total"] - timings.seconds["time_to_first_token"]
+            timings.add("generation", generation_seconds)
+            if generation_seconds > 0:
+                timings.tokens_per_second = self.tokens / generation_seconds
+        record_timings(timings)
+
+    def save_answer(self, response: str, statuses):
+        self.finish()
+        db.insert_chat_message(
+            chat_id=self.chat_id,
+            content=response,
+            role="ai",
+            files_info=[],
+            statuses=statuses,
+            timings=self.timings.to_dict(),
+        )
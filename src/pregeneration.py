@@ -0,0 +1,55 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+# ----------------- CONCURRENT PRE-GENERATION STAGE -----------------
+# the steps before generation that don't depend on each other (web search, embedding the query and searching
+# the chat's documents, trimming / summarizing the history) are started as soon as their inputs are known and
+# joined right before building the prompt, so the turn waits for roughly the slowest of them instead of their sum.
+# tasks run off the streamlit script thread, so they must not touch st.*; their results are rendered on join.
+
+# seconds each task may take, counted from when it was started. a task that takes longer is left running in
+# the background (web results still get indexed, summaries still get saved) and the turn goes on without it
+PREGENERATION_TIMEOUTS = {
+    "history": 30.0,
+    "web_search": 12.0,
+    "documents": 15.0,
+}
+PREGENERATION_WORKERS = 8
+
+# shared by all sessions, tasks that outlive their turn keep running here
+_executor = ThreadPoolExecutor(max_workers=PREGENERATION_WORKERS, thread_name_prefix="pregeneration")
+
+
+class PregenerationStage:
+    def __init__(self, timeouts=None):
+        self.timeouts = {**PREGENERATION_TIMEOUTS, **(timeouts or {})}
+        self.tasks = {}  # name -> (future, started_at)
+        self.errors = {}  # name -> exception (TimeoutError when it ran out of time)
+        self.durations = {}  # name -> seconds it ran for (or until it was given up on)
+
+    def start(self, name: str, fn, *args, **kwargs):
+        started_at = time.time()
+        future = _executor.submit(fn, *args, **kwargs)
+        future.add_done_callback(lambda _: self.durations.setdefault(name, time.time() - started_at))
+        self.tasks[name] = (future, started_at)
+
+    def result(self, name: str, default=None):
+        # waits for the task for what's left of its timeout. returns default if it wasn't started, failed or
+        # didn't finish in time (the reason is kept in self.errors)
+        if name not in self.tasks:
+            return default
+
+        future, started_at = self.tasks[name]
+        remaining = max(0.0, self.timeouts.get(name, 30.0) - (time.time() - started_at))
+        try:
+            return future.result(timeout=remaining)
+        except FutureTimeoutError:
+            self.errors[name] = TimeoutError(f"{name} took more than {self.timeouts.get(name)}s")
+            self.durations.setdefault(name, time.time() - started_at)
+            return default
+        except Exception as e:
+            self.errors[name] = e
+            return default
+
+    def failed(self, name: str):
+        return name in self.errors
@@ -0,0 +1,194 @@
+import re
+from langchain_core.documents import Document
+import db
+from history import estimate_tokens
+from vector_stores import VectorPartition
+
+# ----------------- HYBRID RETRIEVAL (bm25 + vector, reciprocal rank fusion) -----------------
+
+# constant of reciprocal rank fusion, a higher value flattens the difference between top and lower ranks
+RRF_K = 60
+
+# words that are never worth a full text match on their own
+STOP_WORDS = {
+    "a", "an", "the", "is", "are", "was", "were", "be", "of", "to", "in", "on", "for", "and", "or", "with", "what",
+    "which", "who", "how", "why", "when", "where", "does", "do", "did", "can", "could", "about", "this", "that",
+    "it", "its", "me", "my", "i", "you", "your", "please", "tell", "explain", "search",
+}  # fmt: skip
+
+
+def hybrid_search(vector_store: VectorPartition, query: str, user_id: int, chat_id: int, k: int = 10):
+    # returns [(doc, score, relevance)] best first, doc.id being the chunk id in the vector store. score is the
+    # fused rank score, relevance the 0..1 vector relevance (None for chunks only found by the full text index)
+    embedding_model = vector_store.embeddings.model  # pyright: ignore
+
+    lexical_results = []
+    match = to_fts_query(query)
+    if match:
+        lexical_results = [
+            Document(id=row["chunk_id"], page_content=row["content"], metadata=row["metadata"])
+            for row in db.search_chunks_fts(match, user_id, chat_id, embedding_model, k)
+        ]
+
+    # part numbers, function names, clause ids etc. are found by the full text index alone, so there's no need to
+    # embed the query
+    if lexical_results and is_keyword_query(query):
+        return [(doc, 1 / (RRF_K + rank), None) for rank, doc in enumerate(lexical_results, start=1)]
+
+    vector_results = vector_store.search(query, k, user_id, chat_id)
+    relevances = {doc.id: relevance for doc, relevance in vector_results}
+    lexical_ids = {doc.id for doc in lexical_results}
+
+    fused = reciprocal_rank_fusion([lexical_results, [doc for doc, _ in vector_results]])[:k]
+    # chunks matched by the full text index are kept regardless of vector relevance, so they get None
+    return [(doc, score, None if doc.id in lexical_ids else relevances.get(doc.id)) for doc, score in fused]
+
+
+def reciprocal_rank_fusion(rankings):
+    # rankings: lists of docs, each best first. a doc's score is the sum of 1 / (RRF_K + rank) over the lists
+    scores = {}
+    docs = {}
+    for ranking in rankings:
+        for rank, doc in enumerate(ranking, start=1):
+            key = doc.id or doc.page_content
+            scores[key] = scores.get(key, 0) + 1 / (RRF_K + rank)
+            docs.setdefault(key, doc)
+
+    return sorted(((docs[key], score) for key, score in scores.items()), key=lambda item: item[1], reverse=True)
+
+
+def merge_results(results, other_results):
+    # results: [(doc, score, relevance)] from hybrid_search, other_results: [(doc, relevance)] from another store
+    # (the chat's web results). both rankings are fused the same way lexical and vector results are
+    relevances = {doc.id: relevance for doc, _, relevance in results}
+    relevances.update((doc.id, relevance) for doc, relevance in other_results)
+
+    fused = reciprocal_rank_fusion([[doc for doc, _, _ in results], [doc for doc, _ in other_results]])
+    return [(doc, score, relevances.get(doc.id)) for doc, score in fused]
+
+
+def query_terms(query: str):
+    # quoted phrases are kept together, everything else is split into terms like `foo_bar`, `3.2.1`, `AB-123`
+    phrases = re.findall(r'"([^"]+)"', query)
+    rest = re.sub(r'"[^"]+"', " ", query)
+    terms = [term for term in re.findall(r"\w+(?:[.\-:/]+\w+)*", rest) if term.lower() not in STOP_WORDS]
+    return phrases, terms
+
+
+def to_fts_query(query: str):
+    phrases, terms = query_terms(query)
+
+    match_parts = []
+    for text in phrases + terms:
+        # tokens of a term have to appear next to each other, e.g. `AB-123` matches "AB 123" but not "AB ... 123"
+        tokens = re.findall(r"\w+", text)
+        if tokens:
+            match_parts.append('"' + " ".join(tokens) + '"')
+
+    return " OR ".join(match_parts)
+
+
+def is_keyword_query(query: str):
+    # a quoted phrase only, or a few terms that all look like identifiers / codes rather than natural language
+    phrases, terms = query_terms(query)
+    if phrases and not terms:
+        return True
+
+    return 0 < len(terms) <= 3 and all(looks_like_identifier(term) for term in terms)
+
+
+def looks_like_identifier(term: str):
+    return bool(
+        re.search(r"\d", term)  # part numbers, clause ids, versions
+        or re.search(r"[_.:/\-]", term)  # snake_case, module.function, AB-123
+        or re.search(r"[a-z][A-Z]", term)  # camelCase
+        or (term.isupper() and len(term) > 1)  # acronyms
+    )
+
+
+# ----------------- CONTEXT ASSEMBLY -----------------
+# retrieved chunks are cut down before they go into the prompt: irrelevant ones are dropped, near duplicates
+# (neighbouring chunks share chunk_overlap characters) are avoided with maximal marginal relevance, overlapping
+# neighbours from the same source/page are merged back into one passage, and the total is capped in tokens
+
+# candidates fetched from the stores before assembly
+FETCH_K = 20
+# vector relevance (0..1) below which a chunk is dropped, unless the full text index matched it too
+MIN_RELEVANCE = 0.3
+# 1 picks purely by retrieval score, lower values favour chunks unlike the ones already picked
+MMR_LAMBDA = 0.7
+# tokens of retrieved content sent to the model
+CONTEXT_TOKEN_BUDGET = 2500
+
+
+def assemble_context(results, token_budget: int = CONTEXT_TOKEN_BUDGET, min_relevance: float = MIN_RELEVANCE):
+    # results: [(doc, score, relevance)] as returned by hybrid_search. returns passages as docs, best first
+    candidates = [
+        (doc, score) for doc, score, relevance in results if relevance is None or relevance >= min_relevance
+    ]
+    if not candidates:
+        return []
+
+    top_score = candidates[0][1]
+    words = {id(doc): set(re.findall(r"\w+", doc.page_content.lower())) for doc, _ in candidates}
+
+    selected = []
+    passages = []
+    while candidates:
+        best, best_mmr = None, None
+        for doc, score in candidates:
+            redundancy = max((jaccard(words[id(doc)], words[id(other)]) for other in selected), default=0)
+            mmr = MMR_LAMBDA * score / top_score - (1 - MMR_LAMBDA) * redundancy
+            if best_mmr is None or mmr > best_mmr:
+                best, best_mmr = (doc, score), mmr
+
+        candidates.remove(best)  # pyright: ignore
+
+        merged = merge_overlapping(selected + [best[0]])  # pyright: ignore
+        if sum(estimate_tokens(passage.page_content) for passage in merged) > token_budget:
+            if not selected:
+                # even the best chunk alone is too big, sending it cut down rather than nothing
+                doc = best[0]  # pyright: ignore
+                passages = [Document(page_content=doc.page_content[: token_budget * 4], metadata=doc.metadata)]
+            break
+
+        selected.append(best[0])  # pyright: ignore
+        passages = merged
+
+    return passages
+
+
+def merge_overlapping(docs):
+    # joins chunks of the same source and page that overlap (the splitter's chunk_overlap) into one passage,
+    # keeping the order in which passages were first picked
+    passages = []
+    for doc in docs:
+        for i, passage in enumerate(passages):
+            if passage.metadata.get("source") != doc.metadata.get("source"):
+                continue
+            if passage.metadata.get("page") != doc.metadata.get("page"):
+                continue
+
+            joined = join_if_overlapping(passage, doc) or join_if_overlapping(doc, passage)
+            if joined:
+                passages[i] = joined
+                break
+        else:
+            passages.append(doc)
+
+    return passages
+
+
+def join_if_overlapping(first, second, min_overlap: int = 20):
+    # second continues first if the end of first is repeated at the start of second
+    a, b = first.page_content, second.page_content
+    for length in range(min(len(a), len(b)), min_overlap - 1, -1):
+        if a.endswith(b[:length]):
+            return Document(id=first.id, page_content=a + b[length:], metadata=first.metadata)
+    return None
+
+
+def jaccard(a: set, b: set):
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
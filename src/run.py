@@ -4,6 +4,32 @@ from chat_area import main
 import time
 from random import randint
 import db
+from metrics import start_metrics_server
+from blob_store import remove_unreferenced_blobs
+from main import warm_up_preferred_models
+
+
+@st.cache_resource(show_spinner=False)
+def migrate_db():
+    # once per server process, brings databases created by an older setup up to date
+    db.migrate()
+    remove_unreferenced_blobs()
+
+
+@st.cache_resource(show_spinner=False)
+def start_metrics():
+    # /metrics (prometheus) and /metrics.json with per stage latency histograms of chat turns
+    try:
+        return start_metrics_server()
+    except OSError as e:
+        print("Metrics server not started:", e)  # e.g. port taken by another instance
+        return None
+
+
+@st.cache_resource(show_spinner=False)
+def warm_up_models():
+    # once per server process, the user's models start loading in ollama right away (see warmup.py)
+    return warm_up_preferred_models()
 
 
 def initialize_session_state():
@@ -37,6 +63,9 @@ def initialize_session_state():
 
 if __name__ == "__main__":
     st.set_page_config("ChatDocs", page_icon=":material/borg:")
+    migrate_db()
+    start_metrics()
+    warm_up_models()
     initialize_session_state()
     sidebar()
     main()
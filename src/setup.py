@@ -1,8 +1,11 @@
 import pathlib
 import db
+from embedding_cache import EMBEDDING_CACHE_PATH
 import shutil
 
-pathlib.Path("chatdocs.db").unlink(missing_ok=True)
+for path in [db.DB_PATH, EMBEDDING_CACHE_PATH]:
+    for suffix in ["", "-wal", "-shm"]:
+        pathlib.Path(path + suffix).unlink(missing_ok=True)
 db.setup()
 
 try:
@@ -4,6 +4,7 @@ import time
 from random import randint
 from coolname import generate_slug
 import db
+from main import get_model_warmer
 
 
 def generate_unique_name():
@@ -25,10 +26,27 @@ def create_new_chat():
         st.session_state["chats"].insert(0, {"id": new_id, "name": generate_unique_name(), "last_interaction": time.time()})
     st.session_state["current_chat_id"] = new_id
     st.session_state["current_chat_history"] = []
+    st.session_state["history_cursor"] = None
     # st.session_state["max_chat_id"] = new_id
     st.rerun()
 
 
+@st.fragment(run_every=10)
+def model_status():
+    # models in use are warmed up in the background (see warmup.py), this shows whether they are loaded yet
+    warmer = get_model_warmer()
+    for model, kind in ((st.session_state["chat_model"], "chat"), (st.session_state["embedding_model"], "embedding")):
+        warmer.watch(model, kind)
+        status = warmer.status(model) or {}
+
+        if status.get("state") == "ready":
+            st.caption(f":material/check_circle: `{model}` ready", help=f"Loaded in {status['load_seconds']:.1f}s")
+        elif status.get("state") == "error":
+            st.caption(f":material/error: `{model}` unavailable", help=status["error"])
+        else:
+            st.caption(f":material/hourglass_top: `{model}` loading")
+
+
 def sidebar():
     with st.sidebar:
         st.title(":material/borg: ChatDocs", text_alignment="center")
@@ -38,10 +56,13 @@ def sidebar():
         if new_chat_btn:
             create_new_chat()
 
+        model_status()
+
         # st.markdown("### Chats")
         with st.spinner():
-            # getting latest chats from db
+            # getting latest chats (served from db's in memory chat list cache)
             saved_chats = db.get_chats(st.session_state["user_id"])
+            st.session_state["sidebar_chat_ids"] = [c["id"] for c in saved_chats]
             new_chat = None
             for c in st.session_state["chats"]:
                 if c["id"] == 0:
@@ -68,6 +89,6 @@ def sidebar():
                             break
 
                     st.session_state["current_chat_id"] = chat_id
-                    st.session_state["current_chat_history"] = db.get_chat_messages(chat_id)
+                    st.session_state.pop("current_chat_history", None)  # latest page is loaded by chat_area
                     st.session_state["disabled"] = False
                     st.rerun()
@@ -0,0 +1,632 @@
+import json
+import os
+import re
+import shutil
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from pathlib import Path
+
+import chromadb
+import faiss
+import numpy as np
+from chromadb.errors import NotFoundError
+from filelock import FileLock
+from langchain_chroma import Chroma
+from langchain_core.documents import Document
+
+import db
+
+# ----------------- PARTITIONED VECTOR STORES -----------------
+# instead of one collection per embedding model holding every user's and chat's chunks (filtered on each query),
+# chunks can be kept in one collection per chat or per user, so a query only searches that chat's own chunks
+# and deleting a chat is dropping its collection.
+#   "chat": collection per (embedding model, user, chat)
+#   "user": collection per (embedding model, user)
+#   "none": collection per embedding model (how it used to be)
+VECTOR_PARTITIONING = "chat"
+# partitions kept open at once (least recently used ones are closed)
+MAX_OPEN_PARTITIONS = 32
+# held while a partition is opened for the first time in a process (see PartitionedVectorStore.get)
+PARTITION_LOCK_PATH = "vector_store.lock"
+
+# "chroma" or "faiss"
+VECTOR_BACKEND = "chroma"
+PERSIST_DIRECTORY = "vector_store"
+FAISS_DIRECTORY = "vector_store_faiss"
+# "flat" (exact), "ivf" (clustered, searched exactly until there are enough vectors to train it) or "hnsw" (graph)
+FAISS_INDEX_TYPE = "flat"
+FAISS_IVF_NLIST = 64
+FAISS_IVF_NPROBE = 8
+# vectors per cluster an ivf index needs before it's trained (faiss warns about fewer than 39)
+FAISS_IVF_TRAIN_PER_LIST = 39
+FAISS_HNSW_M = 32
+# vectors added to a faiss partition are kept in memory and written to its index file once there are this many (or
+# a quarter of the index, whichever is more), before a search and when an ingest ends (flush), instead of the file
+# being rewritten for every batch
+FAISS_FLUSH_SIZE = 4096
+
+_client = None
+_client_lock = threading.Lock()
+
+_open = OrderedDict()  # partition name -> partition, shared by all embedding models' stores
+_open_lock = threading.Lock()
+
+
+def get_client():
+    # one chroma client per process, shared by every embedding model's partitions
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = chromadb.PersistentClient(path=PERSIST_DIRECTORY)
+        return _client
+
+
+def collection_base_name(embedding_model: str):
+    return re.sub(r"[^a-zA-Z0-9._-]", "-", embedding_model)
+
+
+def chat_suffix(user_id: int, chat_id: int):
+    return f"-u{user_id}-c{chat_id}"
+
+
+def chat_filter(user_id: int, chat_id: int):
+    return {"$and": [{"user_id": user_id}, {"chat_id": chat_id}]}
+
+
+def cosine_relevance(similarity: float):
+    # 0..1 relevance from the cosine similarity of two embeddings (1 - their normalized l2 distance / sqrt 2), the
+    # same for every backend so that retrieval.MIN_RELEVANCE cuts off the same chunks whichever holds the vectors
+    return 1.0 - max(0.0, 2 - 2 * similarity) ** 0.5 / 2**0.5
+
+
+def index_ids(index):
+    # the ids of every vector of a faiss index (an IndexIDMap2, or an ivf index keeping them in its lists)
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexIDMap2):
+        return faiss.vector_to_array(index.id_map)
+
+    invlists = faiss.extract_index_ivf(index).invlists
+    return np.concatenate(
+        [np.zeros(0, dtype=np.int64)]
+        + [
+            faiss.rev_swig_ptr(invlists.get_ids(list_no), invlists.list_size(list_no)).copy()
+            for list_no in range(invlists.nlist)
+        ]
+    )
+
+
+# ----------------- BACKENDS -----------------
+# handle_docs and retrieval only use these methods, so they don't depend on which backend holds the vectors. a
+# backend missing one of them can't be instantiated
+
+
+class VectorPartition(ABC):
+    embeddings = None  # the (cached) Embeddings used for queries, has .model
+
+    @abstractmethod
+    def add(self, ids, texts, embeddings, metadatas): ...
+
+    @abstractmethod
+    def count(self, user_id: int, chat_id: int) -> int: ...
+
+    @abstractmethod
+    def search(self, query: str, k: int, user_id: int, chat_id: int):
+        # [(doc, relevance)] best first, relevance being 0..1 and doc.id the chunk id
+        ...
+
+    @abstractmethod
+    def delete(self, ids): ...
+
+    def flush(self):
+        # writes out whatever add buffered, called once an ingest is over
+        pass
+
+    @abstractmethod
+    def drop(self): ...
+
+
+class ChromaPartition(VectorPartition):
+    def __init__(self, name: str, embeddings):
+        self.name = name
+        self.embeddings = embeddings
+        self.store = Chroma(client=get_client(), collection_name=name, embedding_function=embeddings)
+
+    def add(self, ids, texts, embeddings, metadatas):
+        # adding with precomputed embeddings so that they can be cached per file as well
+        self.store._collection.add(
+            ids=ids,
+            embeddings=embeddings,  # pyright: ignore
+            documents=texts,
+            metadatas=metadatas,
+        )
+
+    def count(self, user_id: int, chat_id: int) -> int:
+        # only metadata is read, nothing is embedded
+        return len(self.store._collection.get(where=chat_filter(user_id, chat_id), include=[])["ids"])  # pyright: ignore
+
+    def search(self, query: str, k: int, user_id: int, chat_id: int):
+        # ranked by chroma, relevance from the cosine similarity (chroma's own relevance is from the squared l2
+        # distance of unnormalized embeddings, so on a different scale than the other backends)
+        vector = np.asarray(self.embeddings.embed_query(query), dtype=np.float32)  # pyright: ignore
+        result = self.store._collection.query(
+            query_embeddings=[vector.tolist()],
+            n_results=k,
+            where=chat_filter(user_id, chat_id),  # pyright: ignore
+            include=["documents", "metadatas", "embeddings"],  # pyright: ignore
+        )
+        if not result["ids"] or not result["ids"][0]:
+            return []
+
+        vectors = np.asarray(result["embeddings"][0], dtype=np.float32)  # pyright: ignore
+        norms = np.linalg.norm(vectors, axis=1) * np.linalg.norm(vector)
+        similarities = vectors @ vector / np.maximum(norms, 1e-12)
+
+        return [
+            (Document(id=id, page_content=content, metadata=metadata), cosine_relevance(float(similarity)))  # pyright: ignore
+            for id, content, metadata, similarity in zip(
+                result["ids"][0], result["documents"][0], result["metadatas"][0], similarities  # pyright: ignore
+            )
+        ]
+
+    def delete(self, ids):
+        for start in range(0, len(ids), 1000):  # within chroma's batch size
+            self.store._collection.delete(ids=ids[start : start + 1000])
+
+    def drop(self):
+        get_client().delete_collection(self.name)
+
+
+class FaissPartition(VectorPartition):
+    # index.faiss holds the vectors (ids are faiss int64 ids) and meta.sqlite maps them to chunk id, text and
+    # metadata. searches use a memory mapped, read only copy of the index so opening a partition doesn't read it
+    # into ram. added vectors are buffered (their rows are in meta.sqlite right away) and flushed by loading the
+    # index fully, adding them and atomically replacing the file, see FAISS_FLUSH_SIZE.
+    def __init__(self, name: str, embeddings, index_type: str = FAISS_INDEX_TYPE):
+        self.name = name
+        self.embeddings = embeddings
+        self.index_type = index_type
+
+        self.directory = Path(FAISS_DIRECTORY) / name
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.index_path = self.directory / "index.faiss"
+
+        self._lock = threading.Lock()
+        # the index file is rewritten (read, changed, replaced) one at a time by every process (the streamlit app and
+        # the http api share the store) and every object of the partition, so none of them writes over the others'
+        self._write_lock = FileLock(self.directory / "index.lock")
+        self._reader = None
+        self._reader_mtime = None
+        self._pending = []  # (faiss ids, vectors) added but not in the index file yet
+        self._pending_count = 0
+
+        self._conn = sqlite3.connect(self.directory / "meta.sqlite", check_same_thread=False)
+        self._conn.executescript(
+            """
+            PRAGMA journal_mode = WAL;
+            create table if not exists chunks (
+                faiss_id INTEGER PRIMARY KEY,
+                id TEXT UNIQUE NOT NULL,
+                content TEXT NOT NULL,
+                metadata TEXT NOT NULL,
+                user_id INTEGER,
+                chat_id INTEGER
+            );
+            create index if not exists chunks_user_id_chat_id on chunks (user_id, chat_id);
+            create table if not exists next_faiss_id (value INTEGER NOT NULL);
+            """
+        )
+        with self._conn:
+            if self._conn.execute("select 1 from next_faiss_id").fetchone() is None:
+                self._conn.execute("insert into next_faiss_id (value) values (?)", (self._first_free_id(),))
+
+    def _first_free_id(self):
+        # faiss ids are taken from a counter that only goes up (next_faiss_id), so that the vector of a deleted chunk
+        # left in an hnsw index never maps to a chunk added later. partitions from before it start after every id
+        # in use, their index's included
+        (max_row_id,) = self._conn.execute("select coalesce(max(faiss_id), -1) from chunks").fetchone()
+        max_index_id = -1
+        if self.index_path.exists():
+            index = self._read_mapped()
+            if index.ntotal:
+                max_index_id = int(index_ids(index).max())
+        return max(max_row_id, max_index_id) + 1
+
+    def add(self, ids, texts, embeddings, metadatas):
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        faiss.normalize_L2(vectors)
+
+        with self._lock:
+            with self._conn:
+                (end,) = self._conn.execute(
+                    "update next_faiss_id set value = value + ? returning value", (len(ids),)
+                ).fetchone()
+                start = end - len(ids)
+                faiss_ids = np.arange(start, start + len(ids), dtype=np.int64)
+                self._conn.executemany(
+                    "insert into chunks (faiss_id, id, content, metadata, user_id, chat_id) values (?, ?, ?, ?, ?, ?)",
+                    [
+                        (int(faiss_id), id, text, json.dumps(metadata), metadata.get("user_id"), metadata.get("chat_id"))
+                        for faiss_id, id, text, metadata in zip(faiss_ids, ids, texts, metadatas)
+                    ],
+                )
+
+            self._pending.append((faiss_ids, vectors))
+            self._pending_count += len(faiss_ids)
+            reader = self._open_reader()
+            if self._pending_count >= max(FAISS_FLUSH_SIZE, (reader.ntotal if reader else 0) // 4):
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def count(self, user_id: int, chat_id: int) -> int:
+        with self._lock:
+            return self._conn.execute(
+                "select count(*) from chunks where user_id = ? and chat_id = ?", (user_id, chat_id)
+            ).fetchone()[0]
+
+    def search(self, query: str, k: int, user_id: int, chat_id: int):
+        with self._lock:
+            self._flush()  # so that what this process added is searched too
+            reader = self._open_reader()
+        if reader is None or reader.ntotal == 0:
+            return []
+
+        vector = np.asarray([self.embeddings.embed_query(query)], dtype=np.float32)  # pyright: ignore
+        faiss.normalize_L2(vector)
+
+        # partitions shared by several chats (per user / unpartitioned) are filtered after searching, so fetching more
+        fetch_k = k if VECTOR_PARTITIONING == "chat" else k * 4
+        similarities, faiss_ids = reader.search(vector, min(fetch_k, reader.ntotal))
+
+        hits = [(int(faiss_id), float(sim)) for faiss_id, sim in zip(faiss_ids[0], similarities[0]) if faiss_id != -1]
+        if not hits:
+            return []
+
+        placeholders = ", ".join("?" * len(hits))
+        with self._lock:
+            rows = self._conn.execute(
+                f"""
+                select faiss_id, id, content, metadata from chunks
+                where faiss_id in ({placeholders}) and user_id = ? and chat_id = ?
+                """,
+                (*[faiss_id for faiss_id, _ in hits], user_id, chat_id),
+            ).fetchall()
+        by_faiss_id = {row[0]: row for row in rows}
+
+        results = []
+        for faiss_id, similarity in hits:
+            if faiss_id in by_faiss_id:
+                _, id, content, metadata = by_faiss_id[faiss_id]
+                doc = Document(id=id, page_content=content, metadata=json.loads(metadata))
+                results.append((doc, cosine_relevance(similarity)))
+
+        return results[:k]
+
+    def delete(self, ids):
+        # their rows and vectors are deleted. hnsw graphs can't remove vectors, those stay in the index until the
+        # partition is dropped and search skips them (nothing maps them to a chunk and their ids are never reused)
+        with self._lock:
+            faiss_ids = []
+            with self._conn:
+                for start in range(0, len(ids), 500):
+                    batch = ids[start : start + 500]
+                    placeholders = ", ".join("?" * len(batch))
+                    faiss_ids += [
+                        faiss_id
+                        for (faiss_id,) in self._conn.execute(
+                            f"delete from chunks where id in ({placeholders}) returning faiss_id", batch
+                        )
+                    ]
+            if not faiss_ids:
+                return
+
+            faiss_ids = np.asarray(faiss_ids, dtype=np.int64)
+            self._pending = [
+                (pending_ids[keep], vectors[keep])
+                for pending_ids, vectors in self._pending
+                if (keep := ~np.isin(pending_ids, faiss_ids)).any()
+            ]
+            self._pending_count = sum(len(pending_ids) for pending_ids, _ in self._pending)
+
+            if self.index_type == "hnsw" or not self.index_path.exists():
+                return
+            with self._write_lock:
+                index = faiss.read_index(str(self.index_path))
+                index.remove_ids(faiss_ids)  # pyright: ignore
+                self._write_index(index)
+            self._reader = None
+
+    def drop(self):
+        with self._lock:
+            self._conn.close()
+            self._reader = None
+            self._pending, self._pending_count = [], 0
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _open_reader(self):
+        # with self._lock held
+        if not self.index_path.exists():
+            return None
+
+        # reopening if another process (or partition object) has written the index since
+        mtime = self.index_path.stat().st_mtime_ns
+        if self._reader is None or mtime != self._reader_mtime:
+            self._reader = self._read_mapped()
+            if isinstance(faiss.downcast_index(self._reader), faiss.IndexIVF):
+                faiss.extract_index_ivf(self._reader).nprobe = FAISS_IVF_NPROBE
+            self._reader_mtime = mtime
+
+        return self._reader
+
+    def _read_mapped(self):
+        # IO_FLAG_MMAP only maps ivf lists, flat (and hnsw's) vectors need IO_FLAG_MMAP_IFC
+        mmap_flag = faiss.IO_FLAG_MMAP if self.index_type == "ivf" else faiss.IO_FLAG_MMAP_IFC
+        return faiss.read_index(str(self.index_path), mmap_flag | faiss.IO_FLAG_READ_ONLY)
+
+    def _flush(self):
+        # with self._lock held
+        if not self._pending:
+            return
+
+        faiss_ids = np.concatenate([faiss_ids for faiss_ids, _ in self._pending])
+        vectors = np.vstack([vectors for _, vectors in self._pending])
+
+        with self._write_lock:
+            index = faiss.read_index(str(self.index_path)) if self.index_path.exists() else None
+            if index is None:
+                index = self._new_index(vectors)
+            index.add_with_ids(vectors, faiss_ids)  # pyright: ignore
+            if (
+                self.index_type == "ivf"
+                and not isinstance(faiss.downcast_index(index), faiss.IndexIVF)
+                and index.ntotal >= FAISS_IVF_NLIST * FAISS_IVF_TRAIN_PER_LIST
+            ):
+                index = self._train_ivf(index)
+
+            self._write_index(index)
+
+        self._pending, self._pending_count = [], 0
+        self._reader = None  # reopened (memory mapped) on the next search
+
+    def _write_index(self, index):
+        # replaces the index file atomically, so searches never map a half written one
+        tmp_path = self.index_path.with_suffix(".tmp")
+        faiss.write_index(index, str(tmp_path))
+        os.replace(tmp_path, self.index_path)
+
+    def _new_index(self, first_vectors):
+        dimensions = first_vectors.shape[1]
+        if self.index_type == "hnsw":
+            return faiss.IndexIDMap2(faiss.IndexHNSWFlat(dimensions, FAISS_HNSW_M, faiss.METRIC_INNER_PRODUCT))
+        # ivf starts out flat as well, see _train_ivf
+        return faiss.IndexIDMap2(faiss.IndexFlatIP(dimensions))
+
+    def _train_ivf(self, flat_index):
+        # the flat index an ivf partition starts with, moved into an ivf index trained on all of its vectors once
+        # there are enough of them for FAISS_IVF_NLIST clusters
+        vectors = flat_index.index.reconstruct_n(0, flat_index.ntotal)  # pyright: ignore
+        faiss_ids = faiss.vector_to_array(flat_index.id_map)  # pyright: ignore
+
+        quantizer = faiss.IndexFlatIP(vectors.shape[1])
+        index = faiss.IndexIVFFlat(quantizer, vectors.shape[1], FAISS_IVF_NLIST, faiss.METRIC_INNER_PRODUCT)
+        index.train(vectors)  # pyright: ignore
+        index.add_with_ids(vectors, faiss_ids)  # pyright: ignore
+        return index
+
+
+class EphemeralPartition(VectorPartition):
+    # in memory only, for chunks that shouldn't be persisted (web search results). nothing is written to disk and
+    # the whole partition is dropped once it expires
+    def __init__(self, embeddings, ttl: float):
+        self.embeddings = embeddings
+        self.ttl = ttl
+        self.expires_at = time.time() + ttl
+
+        self._lock = threading.Lock()
+        self._docs = []
+        self._ids = set()
+        self._vectors = None
+
+    def add(self, ids, texts, embeddings, metadatas):
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        faiss.normalize_L2(vectors)
+
+        with self._lock:
+            keep = [i for i, id in enumerate(ids) if id not in self._ids]  # same result fetched again
+            for i in keep:
+                self._docs.append(Document(id=ids[i], page_content=texts[i], metadata=metadatas[i]))
+                self._ids.add(ids[i])
+            if keep:
+                new_vectors = vectors[keep]
+                self._vectors = new_vectors if self._vectors is None else np.vstack([self._vectors, new_vectors])
+            self.expires_at = time.time() + self.ttl
+
+    def count(self, user_id: int, chat_id: int) -> int:
+        with self._lock:
+            return len(self._docs)
+
+    def search(self, query: str, k: int, user_id: int, chat_id: int):
+        with self._lock:
+            if self._vectors is None:
+                return []
+            docs, vectors = list(self._docs), self._vectors
+
+        vector = np.asarray(self.embeddings.embed_query(query), dtype=np.float32)  # pyright: ignore
+        vector /= np.linalg.norm(vector) or 1.0
+
+        similarities = vectors @ vector
+        best = np.argsort(-similarities)[:k]
+        return [(docs[i], cosine_relevance(float(similarities[i]))) for i in best]
+
+    def delete(self, ids):
+        ids = set(ids)
+        with self._lock:
+            keep = [i for i, doc in enumerate(self._docs) if doc.id not in ids]
+            self._docs = [self._docs[i] for i in keep]
+            self._ids = {doc.id for doc in self._docs}
+            self._vectors = self._vectors[keep] if keep and self._vectors is not None else None
+
+    def drop(self):
+        with self._lock:
+            self._docs, self._ids, self._vectors = [], set(), None
+
+
+# ----------------- EPHEMERAL (per chat, short lived) PARTITIONS -----------------
+
+# seconds web results stay searchable in a chat after they were last added
+EPHEMERAL_TTL = 30 * 60
+
+_ephemeral = {}  # (embedding model, user_id, chat_id) -> EphemeralPartition
+_ephemeral_lock = threading.Lock()
+
+
+def get_ephemeral_partition(embeddings, user_id: int, chat_id: int, create: bool = False):
+    # None if the chat has no (unexpired) ephemeral partition and create is False
+    key = (embeddings.model, user_id, chat_id)
+    now = time.time()
+
+    with _ephemeral_lock:
+        for expired in [key for key, partition in _ephemeral.items() if partition.expires_at < now]:
+            del _ephemeral[expired]
+
+        if key not in _ephemeral and create:
+            _ephemeral[key] = EphemeralPartition(embeddings, EPHEMERAL_TTL)
+        return _ephemeral.get(key)
+
+
+# ----------------- PARTITIONED STORE -----------------
+
+
+class PartitionedVectorStore:
+    def __init__(
+        self,
+        embeddings,
+        embedding_model: str,
+        partitioning: str = VECTOR_PARTITIONING,
+        backend: str = VECTOR_BACKEND,
+    ):
+        self.embeddings = embeddings
+        self.embedding_model = embedding_model
+        self.partitioning = partitioning
+        self.backend = backend
+
+    def partition_name(self, user_id: int, chat_id: int):
+        base = collection_base_name(self.embedding_model)
+        if self.partitioning == "chat":
+            return base + chat_suffix(user_id, chat_id)
+        if self.partitioning == "user":
+            return f"{base}-u{user_id}"
+        return base
+
+    def get(self, user_id: int, chat_id: int) -> VectorPartition:
+        # the partition holding this chat's chunks, opened lazily and kept in an lru cache
+        name = self.partition_name(user_id, chat_id)
+        key = (self.backend, name)
+
+        with _open_lock:
+            if key in _open:
+                _open.move_to_end(key)
+                return _open[key]
+
+        # a partition is created (and filled from the unpartitioned collection) by one thread of one process at a
+        # time, so that two first opens of the same chat don't both copy its chunks
+        with FileLock(PARTITION_LOCK_PATH):
+            with _open_lock:
+                if key in _open:
+                    _open.move_to_end(key)
+                    return _open[key]
+
+            if self.backend == "faiss":
+                is_new = not (Path(FAISS_DIRECTORY) / name).exists()
+                partition = FaissPartition(name, self.embeddings)
+            else:
+                try:
+                    get_client().get_collection(name)
+                    is_new = False
+                except NotFoundError:
+                    is_new = True
+                partition = ChromaPartition(name, self.embeddings)
+
+            if is_new and (self.partitioning != "none" or self.backend != "chroma"):
+                self._copy_from_unpartitioned(partition, user_id, chat_id)
+
+            with _open_lock:
+                _open[key] = partition
+                _open.move_to_end(key)
+                while len(_open) > MAX_OPEN_PARTITIONS:
+                    _open.popitem(last=False)
+
+        return partition
+
+    def _copy_from_unpartitioned(self, partition: VectorPartition, user_id: int, chat_id: int):
+        # chats indexed before partitioning have their chunks in the per embedding model chroma collection, moving
+        # a copy of them (embeddings included, so nothing is embedded again) into the new partition once
+        try:
+            old = get_client().get_collection(collection_base_name(self.embedding_model))
+        except NotFoundError:
+            return
+
+        if self.partitioning == "chat":
+            where = chat_filter(user_id, chat_id)
+        elif self.partitioning == "user":
+            where = {"user_id": user_id}
+        else:
+            where = None
+        data = old.get(where=where, include=["embeddings", "documents", "metadatas"])  # pyright: ignore
+        if not data["ids"]:
+            return
+
+        partition.add(data["ids"], data["documents"], data["embeddings"], data["metadatas"])
+        partition.flush()
+
+        # chunks from before the full text index aren't in it, so hybrid retrieval finds them by term as well
+        indexed = db.get_fts_chunk_ids(
+            self.embedding_model,
+            user_id if self.partitioning != "none" else None,
+            chat_id if self.partitioning == "chat" else None,
+        )
+        db.add_chunks_fts(
+            [
+                {
+                    "chunk_id": id,
+                    "user_id": metadata.get("user_id"),
+                    "chat_id": metadata.get("chat_id"),
+                    "embedding_model": self.embedding_model,
+                    "content": content,
+                    "metadata": metadata,
+                }
+                for id, content, metadata in zip(data["ids"], data["documents"], data["metadatas"])  # pyright: ignore
+                if id not in indexed
+            ]
+        )
+
+
+def drop_chat_vectors(user_id: int, chat_id: int):
+    # removes the chat's chunks from every embedding model's store: its own partitions are dropped, shared
+    # (per user / unpartitioned) chroma collections get its chunks deleted
+    suffix = chat_suffix(user_id, chat_id)
+
+    with _ephemeral_lock:
+        for key in [key for key in _ephemeral if key[1:] == (user_id, chat_id)]:
+            del _ephemeral[key]
+
+    with _open_lock:
+        for key in [key for key in _open if key[1].endswith(suffix)]:
+            del _open[key]
+
+    client = get_client()
+    for collection in client.list_collections():
+        if collection.name.endswith(suffix):
+            client.delete_collection(collection.name)
+        elif not re.search(r"-u\d+-c\d+$", collection.name):
+            collection.delete(where=chat_filter(user_id, chat_id))  # pyright: ignore
+
+    if Path(FAISS_DIRECTORY).exists():
+        for directory in Path(FAISS_DIRECTORY).iterdir():
+            if directory.name.endswith(suffix):
+                shutil.rmtree(directory, ignore_errors=True)
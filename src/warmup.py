@@ -0,0 +1,92 @@
+import threading
+import time
+
+import ollama
+
+# ----------------- MODEL WARM-UP AND KEEP-ALIVE -----------------
+# ollama loads a model on its first request and unloads it after keep_alive (5 minutes by default) of not being
+# used, so the first prompt after a restart or a quiet period pays for loading it. models in use are loaded in
+# the background when the app starts (or they're picked in preferences) and pinged again before ollama would
+# unload them. pinging is cheap when the model is already loaded.
+
+# seconds ollama keeps a model loaded after its last request, also sent with every chat / embedding request
+KEEP_ALIVE = 30 * 60
+# seconds between pings, well within KEEP_ALIVE
+WARMUP_INTERVAL = 5 * 60
+# context length chat models are loaded with, loading with another one would make ollama reload the model
+CHAT_NUM_CTX = 8192
+
+
+class ModelWarmer:
+    def __init__(self, keep_alive=KEEP_ALIVE, interval: float = WARMUP_INTERVAL):
+        self.keep_alive = keep_alive
+        self.interval = interval
+        self.client = ollama.Client()
+
+        self._models = {}  # model -> {"kind", "state", "error", "last_ping", "load_seconds"}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="model-warmer", daemon=True)
+        self._thread.start()
+
+    def watch(self, model: str, kind: str):
+        # kind is "chat" or "embedding". new models are warmed up right away
+        with self._lock:
+            if model in self._models:
+                return
+            self._models[model] = {"kind": kind, "state": "loading", "error": None, "last_ping": None, "load_seconds": None}
+        self._wake.set()
+
+    def status(self, model: str):
+        with self._lock:
+            status = self._models.get(model)
+            return dict(status) if status else None
+
+    def is_ready(self, model: str):
+        status = self.status(model)
+        return bool(status and status["state"] == "ready")
+
+    def ping(self, model: str):
+        with self._lock:
+            kind = self._models[model]["kind"]
+
+        started_at = time.time()
+        try:
+            if is_cloud_model(model):
+                pass  # runs on ollama's servers, nothing to load locally
+            elif kind == "embedding":
+                self.client.embed(model=model, input="warm up", keep_alive=self.keep_alive)
+            else:
+                # an empty prompt only loads the model, nothing is generated
+                self.client.generate(model=model, prompt="", keep_alive=self.keep_alive, options={"num_ctx": CHAT_NUM_CTX})
+            update = {"state": "ready", "error": None, "load_seconds": time.time() - started_at}
+        except Exception as e:
+            update = {"state": "error", "error": str(e)}
+
+        with self._lock:
+            self._models[model].update(update, last_ping=time.time())
+
+    def _run(self):
+        while True:
+            self._wake.clear()
+            with self._lock:
+                now = time.time()
+                due = [
+                    model
+                    for model, status in self._models.items()
+                    if status["last_ping"] is None
+                    or status["state"] == "error"
+                    or now - status["last_ping"] >= self.interval
+                ]
+
+            for model in due:
+                self.ping(model)
+
+            # failed models are retried sooner, ollama may have just been starting
+            with self._lock:
+                has_errors = any(status["state"] == "error" for status in self._models.values())
+            self._wake.wait(timeout=min(30, self.interval) if has_errors else self.interval)
+
+
+def is_cloud_model(model: str):
+    return model.endswith("-cloud") or model.endswith(":cloud")
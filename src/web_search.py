@@ -0,0 +1,138 @@
+import re
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from ddgs import DDGS
+
+# ----------------- WEB SEARCH (cached, parallel) -----------------
+# results are cached per normalized query for a few minutes, so repeating (or rewording the case / spacing of)
+# a search doesn't hit the network again. a search runs a few variants of the query at once and waits for
+# them only up to a time budget, whatever hasn't arrived by then is left out (and still cached when it lands).
+
+WEB_RESULTS_TTL = 10 * 60  # seconds
+WEB_CACHE_MAX_ENTRIES = 256
+WEB_MAX_RESULTS = 7
+WEB_SEARCH_WORKERS = 4
+# seconds a turn waits for web results
+WEB_SEARCH_TIMEOUT = 8.0
+
+# words dropped for the keyword variant of a query
+QUERY_FILLER_WORDS = {
+    "a", "an", "the", "is", "are", "was", "were", "of", "to", "in", "on", "for", "and", "or", "with", "what",
+    "which", "who", "how", "why", "when", "where", "does", "do", "did", "can", "could", "about", "me", "please",
+    "tell", "explain", "search", "find", "i", "you", "my",
+}  # fmt: skip
+
+
+class WebResultsCache:
+    def __init__(self, ttl: float = WEB_RESULTS_TTL, max_entries: int = WEB_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()  # query -> (stored_at, results)
+        self._lock = threading.Lock()
+
+    def get(self, query: str):
+        with self._lock:
+            entry = self._entries.get(query)
+            if entry is None or time.time() - entry[0] > self.ttl:
+                self._entries.pop(query, None)
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(query)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, query: str, results):
+        with self._lock:
+            self._entries[query] = (time.time(), results)
+            self._entries.move_to_end(query)
+
+            now = time.time()
+            for key in [key for key, (stored_at, _) in self._entries.items() if now - stored_at > self.ttl]:
+                del self._entries[key]
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+_cache = WebResultsCache()
+# long lived so that a search running past the budget finishes (and gets cached) in the background
+_executor = ThreadPoolExecutor(max_workers=WEB_SEARCH_WORKERS, thread_name_prefix="web-search")
+
+
+def normalize_query(prompt: str):
+    query = re.sub(r"^\s*/search\b", "", prompt)
+    query = re.sub(r"\s+", " ", query).strip().lower()
+    return query.rstrip("?!.")
+
+
+def query_variants(query: str):
+    # the query as typed plus its keywords only, which often gets different (more factual) pages
+    variants = [query]
+    keywords = " ".join(word for word in query.split() if word not in QUERY_FILLER_WORDS)
+    if keywords and keywords != query:
+        variants.append(keywords)
+    return variants
+
+
+def search_web(prompt: str, max_results: int = WEB_MAX_RESULTS, timeout: float = WEB_SEARCH_TIMEOUT):
+    # returns [{"title", "href", "body"}] without duplicate pages, results of the full query first
+    query = normalize_query(prompt)
+    if not query:
+        return []
+
+    variants = query_variants(query)
+    results_by_variant = {}
+    futures = {}
+    for variant in variants:
+        cached = _cache.get(variant)
+        if cached is not None:
+            results_by_variant[variant] = cached
+        else:
+            futures[_executor.submit(fetch_results, variant, max_results)] = variant
+
+    if futures:
+        done, not_done = wait(futures, timeout=timeout)
+        errors = []
+        for future in done:
+            try:
+                results_by_variant[futures[future]] = future.result()
+            except Exception as e:
+                traceback.print_exception(e)
+                errors.append(e)
+
+        # nothing at all: out of time if a variant is still running, otherwise what every variant failed with
+        if not results_by_variant:
+            if not_done:
+                raise TimeoutError(f"No web results within {timeout}s")
+            if len(errors) == 1:
+                raise errors[0]
+            raise ExceptionGroup("Every web search failed", errors)
+
+    seen = set()
+    results = []
+    for variant in variants:
+        for result in results_by_variant.get(variant, []):
+            if result["href"] not in seen:
+                seen.add(result["href"])
+                results.append(result)
+
+    return results
+
+
+def fetch_results(query: str, max_results: int):
+    with DDGS() as ddgs:
+        results = [
+            {"title": result["title"], "href": result["href"], "body": result["body"]}
+            for result in ddgs.text(query, max_results=max_results)
+        ]
+
+    _cache.put(query, results)
+    return results